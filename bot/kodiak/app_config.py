@@ -54,10 +54,83 @@ USAGE_REPORTING_EVENTS = set(
 USAGE_REPORTING_QUEUE_LENGTH = config(
     "USAGE_REPORTING_QUEUE_LENGTH", cast=int, default=10_000
 )
+# usage reporting events are buffered and pushed to Redis in batches.
+USAGE_REPORTING_FLUSH_INTERVAL_MS = config(
+    "USAGE_REPORTING_FLUSH_INTERVAL_MS", cast=int, default=5
+)
+USAGE_REPORTING_MAX_BUFFER_SIZE = config(
+    "USAGE_REPORTING_MAX_BUFFER_SIZE", cast=int, default=100
+)
+# optional zstd dictionary shared with the web api's event ingestion job.
+USAGE_REPORTING_ZSTD_DICTIONARY_PATH = config(
+    "USAGE_REPORTING_ZSTD_DICTIONARY_PATH", default=None
+)
 INGEST_QUEUE_LENGTH = config("INGEST_QUEUE_LENGTH", cast=int, default=1_000)
+# number of webhook events handled concurrently per installation. Events for the
+# same pull request, commit, or ref are always handled in order.
+INGEST_QUEUE_CONCURRENCY = config("INGEST_QUEUE_CONCURRENCY", cast=int, default=1)
+# optional zstd dictionary used to compress ingest queue entries. Create one with
+# `kodiak train-ingest-dictionary`. The ingest server and worker must use the
+# same dictionary.
+INGEST_QUEUE_ZSTD_DICTIONARY_PATH = config(
+    "INGEST_QUEUE_ZSTD_DICTIONARY_PATH", default=None
+)
+# webhook events for a pull request that arrive while it's being evaluated are
+# coalesced into one more evaluation once no events arrive for this long. 0
+# disables coalescing.
+WEBHOOK_COALESCE_WINDOW_SEC = config(
+    "WEBHOOK_COALESCE_WINDOW_SEC", cast=float, default=0
+)
+# re-evaluate coalesced pull requests after this long, even if events keep
+# arriving.
+WEBHOOK_COALESCE_MAX_DELAY_SEC = config(
+    "WEBHOOK_COALESCE_MAX_DELAY_SEC", cast=float, default=30
+)
+# evaluate up to this many queued webhook events for the same repository and
+# base branch together, fetching their pull requests with one GraphQL query.
+WEBHOOK_BATCH_SIZE = config("WEBHOOK_BATCH_SIZE", cast=int, default=10)
+# open pull request listings are cached for this long. Listings for a
+# repository are also invalidated when a pull request is opened, closed, or
+# retargeted. 0 disables caching.
+OPEN_PULL_REQUESTS_CACHE_TTL_SEC = config(
+    "OPEN_PULL_REQUESTS_CACHE_TTL_SEC", cast=float, default=15
+)
+# number of repositories to keep open pull request listings for per process.
+OPEN_PULL_REQUESTS_CACHE_SIZE = config(
+    "OPEN_PULL_REQUESTS_CACHE_SIZE", cast=int, default=1024
+)
+# while merging, a pull request waiting on CI is re-evaluated when a webhook
+# event arrives for it, or after this long.
+MERGE_POLL_FALLBACK_SEC = config("MERGE_POLL_FALLBACK_SEC", cast=float, default=30)
+# failed GitHub API calls are retried after an exponential backoff between
+# these bounds. See `kodiak.retry`.
+RETRY_BACKOFF_BASE_SEC = config("RETRY_BACKOFF_BASE_SEC", cast=float, default=1)
+RETRY_BACKOFF_MAX_SEC = config("RETRY_BACKOFF_MAX_SEC", cast=float, default=30)
+# retries allowed per installation per minute.
+RETRY_BUDGET_PER_MINUTE = config("RETRY_BUDGET_PER_MINUTE", cast=float, default=20)
+# pause an installation's queues after this many consecutive failures.
+RETRY_CIRCUIT_FAILURE_THRESHOLD = config(
+    "RETRY_CIRCUIT_FAILURE_THRESHOLD", cast=int, default=10
+)
+RETRY_CIRCUIT_OPEN_SEC = config("RETRY_CIRCUIT_OPEN_SEC", cast=float, default=60)
 REDIS_BLOCKING_POP_TIMEOUT_SEC = config(
     "REDIS_BLOCKING_POP_TIMEOUT_SEC", cast=int, default=10
 )
+# share webhook and merge queues between multiple worker processes by claiming
+# them with Redis leases. See `kodiak.leases`.
+WORKER_LEASES = config("WORKER_LEASES", cast=bool, default=False)
+# a dead worker's queues are claimed by other workers after this long.
+WORKER_LEASE_TTL_SEC = config("WORKER_LEASE_TTL_SEC", cast=float, default=10)
+WORKER_HEARTBEAT_INTERVAL_SEC = config(
+    "WORKER_HEARTBEAT_INTERVAL_SEC", cast=float, default=2
+)
+# set by `kodiak.entrypoints.launcher` for each worker process. Installations are
+# partitioned between `WORKER_SHARD_COUNT` processes.
+WORKER_SHARD_INDEX = config("WORKER_SHARD_INDEX", cast=int, default=0)
+WORKER_SHARD_COUNT = config("WORKER_SHARD_COUNT", cast=int, default=1)
+# number of worker processes started by `kodiak.entrypoints.launcher`. Inside a
+# container `os.cpu_count()` reports the host's cores, so we don't default to it.
+WORKER_PROCESSES = config("WORKER_PROCESSES", cast=int, default=1)
 # if we don't get a reply from Redis within a short period, we have an error because we always expect short response times from redis. We specify a timeout for blocking operations
 REDIS_SOCKET_TIMEOUT_SEC = config("REDIS_SOCKET_TIMEOUT_SEC", cast=int, default=90)
 # if we can't open a TCP connection quickly, we should raise a timeout.
@@ -77,6 +150,38 @@ GITHUB_V4_API_URL = config(
     "GITHUB_V4_API_URL", default="https://api.github.com/graphql"
 )
 
+# number of parsed `.kodiak.toml` files to keep per process.
+CONFIG_CACHE_SIZE = config("CONFIG_CACHE_SIZE", cast=int, default=1024)
+# number of base branches to remember the GraphQL edges needed for per process.
+QUERY_PROFILE_CACHE_SIZE = config("QUERY_PROFILE_CACHE_SIZE", cast=int, default=4096)
+# share config files between processes through Redis.
+CONFIG_CACHE_REDIS = config("CONFIG_CACHE_REDIS", cast=bool, default=False)
+# bytes of GitHub REST response bodies to keep per process for conditional
+# requests.
+HTTP_CACHE_MAX_BYTES = config("HTTP_CACHE_MAX_BYTES", cast=int, default=32_000_000)
+# seconds to cache the GraphQL schema features of the GitHub API, and to wait
+# before retrying after failing to fetch them.
+API_FEATURES_CACHE_TTL_SEC = config(
+    "API_FEATURES_CACHE_TTL_SEC", cast=float, default=24 * 60 * 60
+)
+API_FEATURES_ERROR_TTL_SEC = config(
+    "API_FEATURES_ERROR_TTL_SEC", cast=float, default=60
+)
+# share installation access tokens between processes through Redis.
+INSTALLATION_TOKEN_REDIS_CACHE = config(
+    "INSTALLATION_TOKEN_REDIS_CACHE", cast=bool, default=False
+)
+# limits for the connection pool shared by GitHub API clients in a process.
+GITHUB_HTTP_MAX_CONNECTIONS = config(
+    "GITHUB_HTTP_MAX_CONNECTIONS", cast=int, default=100
+)
+GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS = config(
+    "GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS", cast=int, default=20
+)
+GITHUB_HTTP_KEEPALIVE_EXPIRY_SEC = config(
+    "GITHUB_HTTP_KEEPALIVE_EXPIRY_SEC", cast=float, default=60
+)
+
 # An extra header to send with git API requests.
 GITHUB_API_HEADER_NAME = config("GITHUB_API_HEADER_NAME", default=None)
 GITHUB_API_HEADER_VALUE = config("GITHUB_API_HEADER_VALUE", default=None)
@@ -4,6 +4,7 @@ from typing import Any, Dict, List
 
 import click
 import requests
+import zstandard as zstd
 
 from kodiak import app_config as conf
 from kodiak.config import V1
@@ -85,6 +86,25 @@ def validate_config(config_path: str) -> None:
     click.echo(cfg_file.json(indent=2))
 
 
+@cli.command(help="train a zstd dictionary for compressing ingest queue entries")
+@click.argument("samples_dir", type=click.Path(exists=True, file_okay=False))
+@click.argument("output_path", type=click.Path(dir_okay=False))
+@click.option("--size", default=110 * 1024, help="maximum dictionary size in bytes")
+def train_ingest_dictionary(samples_dir: str, output_path: str, size: int) -> None:
+    """
+    Train a dictionary from a directory of webhook payload JSON files.
+
+    Set INGEST_QUEUE_ZSTD_DICTIONARY_PATH to the output path for both the
+    ingest server and the worker to use the dictionary.
+    """
+    samples = [path.read_bytes() for path in Path(samples_dir).rglob("*.json")]
+    dictionary = zstd.train_dictionary(size, samples)
+    Path(output_path).write_bytes(dictionary.as_bytes())
+    click.echo(
+        f"wrote dictionary {dictionary.dict_id()} trained on {len(samples)} samples"
+    )
+
+
 @cli.command(help="listen for messages and trigger pull request refreshes")
 def refresh_pull_requests() -> None:
     """
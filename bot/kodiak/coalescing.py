@@ -0,0 +1,199 @@
+"""
+Coalesce webhook events for a pull request while it's being evaluated.
+
+A CI run sends many check_run and status events for the same pull request
+within seconds. Events that arrive while the pull request is being evaluated
+are recorded instead of queued. Once the evaluation finishes and no more
+events arrive for `WEBHOOK_COALESCE_WINDOW_SEC`, we queue the pull request
+for one more evaluation.
+
+State is kept in Redis because the event may be enqueued by a different
+worker process than the one evaluating the pull request. Pull requests
+waiting for their quiet period are scheduled with `kodiak.delayed_queue`, so
+a pending evaluation survives a worker restarting.
+"""
+
+from __future__ import annotations
+
+import time
+from typing import List, Tuple
+
+import structlog
+
+from kodiak.delayed_queue import DELAYED_KEY, DelayedQueue, get_delayed_member
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+# if a worker dies mid-evaluation, events for the pull request are queued
+# normally once this expires.
+IN_FLIGHT_TTL_SEC = 120
+PENDING_TTL_SEC = 60 * 60
+# the `kodiak.delayed_queue` kind for pull requests waiting to be re-evaluated.
+COALESCE = "coalesce"
+
+# KEYS: in flight key, pending key, webhook queue, webhook queue names
+# ARGV: member, now, pending ttl ms
+ENQUEUE_SCRIPT = """
+if redis.call("exists", KEYS[1]) == 1 then
+    redis.call("hset", KEYS[2], "last_event_at", ARGV[2])
+    redis.call("hincrby", KEYS[2], "events", 1)
+    redis.call("pexpire", KEYS[2], ARGV[3])
+    return 0
+end
+redis.call("sadd", KEYS[4], KEYS[3])
+redis.call("zadd", KEYS[3], "NX", ARGV[2], ARGV[1])
+return 1
+"""
+
+# Called when an evaluation finishes and when the pull request is due. When
+# it's due, only the worker that finds the delayed member settles it.
+#
+# KEYS: in flight key, pending key, webhook queue, webhook queue names,
+#       delayed key
+# ARGV: member, now, in flight ttl ms, window sec, max delay sec,
+#       delayed member, pending ttl ms, due
+SETTLE_SCRIPT = """
+local now = tonumber(ARGV[2])
+if ARGV[8] == "1" and not redis.call("zscore", KEYS[5], ARGV[6]) then
+    return {"skipped", "0", ARGV[2]}
+end
+local events = tonumber(redis.call("hget", KEYS[2], "events") or "0")
+local coalesced = tonumber(redis.call("hget", KEYS[2], "coalesced") or "0") + events
+local started_at = tonumber(redis.call("hget", KEYS[2], "started_at") or ARGV[2])
+if coalesced == 0 then
+    redis.call("del", KEYS[1], KEYS[2])
+    redis.call("zrem", KEYS[5], ARGV[6])
+    return {"done", "0", ARGV[2]}
+end
+local last_event_at = tonumber(redis.call("hget", KEYS[2], "last_event_at") or ARGV[2])
+local due_at = math.min(last_event_at + tonumber(ARGV[4]), started_at + tonumber(ARGV[5]))
+if due_at > now then
+    redis.call(
+        "hset", KEYS[2],
+        "events", 0, "coalesced", coalesced, "started_at", tostring(started_at)
+    )
+    redis.call("pexpire", KEYS[2], ARGV[7])
+    redis.call("pexpire", KEYS[1], ARGV[3])
+    redis.call("zadd", KEYS[5], due_at, ARGV[6])
+    return {"waiting", tostring(coalesced), tostring(due_at)}
+end
+redis.call("del", KEYS[1], KEYS[2])
+redis.call("zrem", KEYS[5], ARGV[6])
+redis.call("sadd", KEYS[4], KEYS[3])
+redis.call("zadd", KEYS[3], "NX", ARGV[2], ARGV[1])
+return {"enqueued", tostring(coalesced), tostring(started_at)}
+"""
+
+
+def get_in_flight_key(member: str) -> str:
+    return f"kodiak:webhook_in_flight:{member}"
+
+
+def get_pending_key(member: str) -> str:
+    return f"kodiak:webhook_pending:{member}"
+
+
+class WebhookCoalescer:
+    def __init__(
+        self,
+        *,
+        queue_names_key: str,
+        delayed_queue: DelayedQueue,
+        window_sec: float,
+        max_delay_sec: float,
+    ) -> None:
+        self.queue_names_key = queue_names_key
+        self.window_sec = window_sec
+        # re-evaluate eventually even if events never stop.
+        self.max_delay_sec = max_delay_sec
+        self.coalesced_events = 0
+        self.reevaluations = 0
+        self._enqueue_script = redis_bot.register_script(ENQUEUE_SCRIPT)
+        self._settle_script = redis_bot.register_script(SETTLE_SCRIPT)
+        delayed_queue.register(COALESCE, self.settle_due)
+
+    @property
+    def saved_evaluations(self) -> int:
+        return self.coalesced_events - self.reevaluations
+
+    def _keys(self, queue_name: str, member: str) -> List[str]:
+        return [
+            get_in_flight_key(member),
+            get_pending_key(member),
+            queue_name,
+            self.queue_names_key,
+        ]
+
+    async def enqueue(self, *, queue_name: str, member: str) -> bool:
+        """
+        Queue `member` unless it's being evaluated. Returns whether the event
+        was queued.
+        """
+        res = await self._enqueue_script(
+            keys=self._keys(queue_name, member),
+            args=[member, time.time(), PENDING_TTL_SEC * 1000],
+        )
+        return bool(res)
+
+    async def start(self, *, member: str) -> None:
+        """
+        Mark `member` as being evaluated.
+        """
+        await redis_bot.set(get_in_flight_key(member), 1, ex=IN_FLIGHT_TTL_SEC)
+
+    async def finish(self, *, queue_name: str, member: str) -> None:
+        """
+        Mark the evaluation of `member` as complete. If events arrived during
+        the evaluation, we evaluate once more after a quiet period.
+        """
+        try:
+            await self.settle(queue_name, member)
+        except Exception:
+            # we don't know if events arrived, so evaluate again to be safe.
+            logger.exception("webhook_coalesce_failed", queue=queue_name, member=member)
+            async with redis_bot.pipeline(transaction=True) as pipe:
+                pipe.sadd(self.queue_names_key, queue_name)
+                pipe.zadd(queue_name, {member: time.time()}, nx=True)
+                pipe.delete(get_in_flight_key(member))
+                await pipe.execute()
+
+    async def settle_due(self, queue_name: str, member: str) -> None:
+        """
+        Queue `member` if its quiet period has passed.
+        """
+        await self.settle(queue_name, member, due=True)
+
+    async def settle(self, queue_name: str, member: str, *, due: bool = False) -> None:
+        state, events, timestamp = await self._settle(queue_name, member, due=due)
+        if state != "enqueued":
+            return
+        self.coalesced_events += events
+        self.reevaluations += 1
+        logger.info(
+            "webhook_events_coalesced",
+            queue=queue_name,
+            member=member,
+            events=events,
+            delay_sec=time.time() - timestamp,
+            coalesced_events=self.coalesced_events,
+            saved_evaluations=self.saved_evaluations,
+        )
+
+    async def _settle(
+        self, queue_name: str, member: str, *, due: bool
+    ) -> Tuple[str, int, float]:
+        state, events, timestamp = await self._settle_script(
+            keys=[*self._keys(queue_name, member), DELAYED_KEY],
+            args=[
+                member,
+                time.time(),
+                IN_FLIGHT_TTL_SEC * 1000,
+                self.window_sec,
+                self.max_delay_sec,
+                get_delayed_member(COALESCE, queue_name, member),
+                PENDING_TTL_SEC * 1000,
+                int(due),
+            ],
+        )
+        return state.decode(), int(events), float(timestamp)
@@ -0,0 +1,91 @@
+"""
+Cache parsed `.kodiak.toml` files by their git blob oid.
+
+Configs rarely change, so we fetch the blob oid with the event info query and
+only download and parse the config when we haven't seen its oid. Parsing runs
+`toml.loads` and the pydantic validation for `V1`, so we keep the parsed
+config, or the parse error, in an LRU.
+
+With `CONFIG_CACHE_REDIS`, config text is also shared between processes so a
+config is downloaded once per change instead of once per process.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Optional, Union
+
+import pydantic
+import structlog
+import toml
+
+from kodiak import app_config as conf
+from kodiak.config import V1
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+CONFIG_TEXT_TTL_SEC = 7 * 24 * 60 * 60
+
+
+@dataclass(frozen=True)
+class CachedConfig:
+    text: str
+    parsed: Union[V1, pydantic.ValidationError, toml.TomlDecodeError]
+
+
+def get_config_text_key(oid: str) -> str:
+    return f"kodiak:config_text:{oid}"
+
+
+class ConfigCache:
+    def __init__(self, *, max_size: int) -> None:
+        self.max_size = max_size
+        self.configs: OrderedDict[str, CachedConfig] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, oid: str) -> Optional[CachedConfig]:
+        cached = self.configs.get(oid)
+        if cached is not None:
+            self.configs.move_to_end(oid)
+            self.hits += 1
+            return cached
+        if conf.CONFIG_CACHE_REDIS:
+            text = await redis_bot.get(get_config_text_key(oid))
+            if text is not None:
+                self.hits += 1
+                return self.add(oid, text.decode())
+        self.misses += 1
+        return None
+
+    async def put(self, oid: Optional[str], text: str) -> CachedConfig:
+        """
+        Parse a downloaded config and cache it if we know its oid.
+        """
+        if oid is None:
+            return CachedConfig(text=text, parsed=V1.parse_toml(text))
+        cached = self.configs.get(oid)
+        if cached is not None:
+            return cached
+        if conf.CONFIG_CACHE_REDIS:
+            await redis_bot.set(get_config_text_key(oid), text, ex=CONFIG_TEXT_TTL_SEC)
+        return self.add(oid, text)
+
+    def add(self, oid: str, text: str) -> CachedConfig:
+        cached = CachedConfig(text=text, parsed=V1.parse_toml(text))
+        self.configs[oid] = cached
+        while len(self.configs) > self.max_size:
+            self.configs.popitem(last=False)
+        logger.info(
+            "config_cache_add",
+            oid=oid,
+            size=len(self.configs),
+            hits=self.hits,
+            misses=self.misses,
+        )
+        return cached
+
+
+config_cache = ConfigCache(max_size=conf.CONFIG_CACHE_SIZE)
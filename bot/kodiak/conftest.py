@@ -1,5 +1,9 @@
+from typing import AsyncIterator, List
+
 import pytest
 
+from kodiak.redis_client import redis_bot
+
 
 @pytest.fixture(autouse=True)
 def configure_structlog() -> None:
@@ -21,3 +25,16 @@ def configure_structlog() -> None:
         logger_factory=structlog.stdlib.LoggerFactory(),
         cache_logger_on_first_use=False,
     )
+
+
+@pytest.fixture
+async def clean_redis(redis_keys: List[str]) -> AsyncIterator[None]:
+    """
+    Delete `redis_keys` before and after the test. Modules using this fixture
+    define a `redis_keys` fixture.
+    """
+    await redis_bot.delete(*redis_keys)
+    yield
+    await redis_bot.delete(*redis_keys)
+    # each test has its own event loop, so we can't reuse connections.
+    await redis_bot.close()
@@ -0,0 +1,131 @@
+"""
+Run work for a webhook queue member once it's due.
+
+Entries are stored in one Redis sorted set scored by when they're due, and
+every worker sweeps the set once a second, so pending work survives a worker
+restarting. Each entry has a kind, and the sweeper calls the handler
+registered for that kind:
+
+- "requeue" puts the member back on its webhook queue. When evaluating a pull
+  request times out we retry after a backoff this way instead of sleeping in
+  the queue consumer, which would block every other pull request in the queue.
+- `kodiak.coalescing` uses its own kind to re-evaluate a pull request once
+  webhook events for it stop arriving.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+import time
+from typing import Awaitable, Callable, Dict, NoReturn
+
+import structlog
+
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+DELAYED_KEY = "kodiak:webhook_delayed"
+SWEEP_INTERVAL_SEC = 1
+SWEEP_BATCH_SIZE = 100
+REQUEUE = "requeue"
+
+# called with the queue name and member of a due entry.
+DueHandler = Callable[[str, str], Awaitable[None]]
+
+# Only the worker that removes the delayed event queues it.
+#
+# KEYS: delayed key, webhook queue, webhook queue names
+# ARGV: delayed member, member, now
+REQUEUE_SCRIPT = """
+if redis.call("zrem", KEYS[1], ARGV[1]) == 0 then
+    return 0
+end
+redis.call("sadd", KEYS[3], KEYS[2])
+redis.call("zadd", KEYS[2], "NX", ARGV[3], ARGV[2])
+return 1
+"""
+
+
+def get_delayed_member(kind: str, queue_name: str, member: str) -> str:
+    return json.dumps([kind, queue_name, member])
+
+
+class DelayedQueue:
+    def __init__(self, *, queue_names_key: str) -> None:
+        self.queue_names_key = queue_names_key
+        self.requeued = 0
+        self.handlers: Dict[str, DueHandler] = {REQUEUE: self._requeue}
+        self._requeue_script = redis_bot.register_script(REQUEUE_SCRIPT)
+
+    def register(self, kind: str, handler: DueHandler) -> None:
+        """
+        Call `handler` for due entries of `kind`. The handler is responsible
+        for removing the entry, e.g. with ZREM in a script, so only one worker
+        handles it.
+        """
+        self.handlers[kind] = handler
+
+    async def add(self, *, queue_name: str, member: str, delay: float) -> None:
+        """
+        Queue `member` on `queue_name` after `delay` seconds. If `member` is
+        already waiting, we keep the earlier retry.
+        """
+        await redis_bot.zadd(
+            DELAYED_KEY,
+            {get_delayed_member(REQUEUE, queue_name, member): time.time() + delay},
+            nx=True,
+        )
+
+    async def run(self) -> NoReturn:
+        """
+        Handle entries once they're due.
+        """
+        log = logger.bind(task="webhook_delayed_queue")
+        log.info("start webhook delayed queue")
+        while True:
+            await asyncio.sleep(SWEEP_INTERVAL_SEC)
+            try:
+                await self.sweep()
+            except Exception:
+                # due entries stay in the sorted set until we sweep them.
+                log.exception("webhook_delayed_sweep_failed")
+
+    async def sweep(self) -> None:
+        due = await redis_bot.zrangebyscore(
+            DELAYED_KEY, "-inf", time.time(), start=0, num=SWEEP_BATCH_SIZE
+        )
+        for delayed_member in due:
+            kind, queue_name, member = json.loads(delayed_member)
+            handler = self.handlers.get(kind)
+            if handler is not None:
+                await handler(queue_name, member)
+                continue
+            # e.g. coalescing was disabled. Evaluating the pull request again
+            # is always safe, and we don't want the entry to block the set.
+            logger.warning("webhook_delayed_unknown_kind", kind=kind)
+            await self.requeue(
+                delayed_member.decode(), queue_name=queue_name, member=member
+            )
+
+    async def _requeue(self, queue_name: str, member: str) -> None:
+        await self.requeue(
+            get_delayed_member(REQUEUE, queue_name, member),
+            queue_name=queue_name,
+            member=member,
+        )
+
+    async def requeue(
+        self, delayed_member: str, *, queue_name: str, member: str
+    ) -> None:
+        """
+        Remove `delayed_member` and put `member` back on its webhook queue.
+        """
+        requeued = await self._requeue_script(
+            keys=[DELAYED_KEY, queue_name, self.queue_names_key],
+            args=[delayed_member, member, time.time()],
+        )
+        if requeued:
+            self.requeued += 1
+            logger.info("webhook_delayed_requeue", queue=queue_name, member=member)
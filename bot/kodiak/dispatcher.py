@@ -0,0 +1,163 @@
+"""
+Pop work from many Redis sorted set queues with a single blocking command.
+
+Previously every webhook and merge queue had a coroutine blocking on its own
+BZPOPMIN, so every idle queue held a Redis connection and woke every
+`REDIS_BLOCKING_POP_TIMEOUT_SEC`. Now one dispatcher blocks on all of the
+idle queues at once. When an item is popped, the queue's handler drains the
+queue with non-blocking ZPOPMIN calls and then returns the queue to the idle
+set.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import uuid
+from typing import Awaitable, Callable, Dict, NoReturn, Set
+
+import structlog
+
+from kodiak import app_config as conf
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+QueueHandler = Callable[[str, bytes, float], Awaitable[None]]
+
+WAKEUP_MEMBER = b"wakeup"
+WAKEUP_KEY_TTL_SEC = 60
+
+
+class QueueDispatcher:
+    def __init__(self) -> None:
+        # checked before handling each event. See `kodiak.leases`.
+        self.can_handle: Callable[[str], bool] = lambda _: True
+        # each process gets its own key so we only interrupt our own blocking
+        # pop when the set of idle queues changes.
+        self.wakeup_key = f"kodiak:dispatcher:wakeup:{uuid.uuid4()}"
+        self.handlers: Dict[str, QueueHandler] = {}
+        self.idle: Set[str] = set()
+        self.active: Dict[str, asyncio.Task[None]] = {}
+        self.pops = 0
+        # queues included in the in progress blocking pop, if any.
+        self._blocking_on: Set[str] | None = None
+        self._wakeup_pending = False
+        self._wakeup_tasks: Set[asyncio.Task[None]] = set()
+
+    def register(self, queue_name: str, handler: QueueHandler) -> None:
+        """
+        Start watching `queue_name` for work. Registering a queue more than
+        once is a no-op.
+        """
+        if queue_name in self.handlers:
+            return
+        self.handlers[queue_name] = handler
+        self._mark_idle(queue_name)
+
+    def unregister(self, queue_name: str) -> None:
+        """
+        Stop handling `queue_name`. An in progress handler finishes its current
+        event and puts any event it pops back on the queue.
+        """
+        self.handlers.pop(queue_name, None)
+        self.idle.discard(queue_name)
+
+    def _mark_idle(self, queue_name: str) -> None:
+        self.idle.add(queue_name)
+        if self._blocking_on is not None and queue_name not in self._blocking_on:
+            self._wakeup()
+
+    def _wakeup(self) -> None:
+        """
+        Interrupt the in progress blocking pop so it's retried with the
+        current set of idle queues.
+        """
+        if self._wakeup_pending:
+            return
+        self._wakeup_pending = True
+        task = asyncio.create_task(self._send_wakeup())
+        self._wakeup_tasks.add(task)
+        task.add_done_callback(self._wakeup_tasks.discard)
+
+    async def _send_wakeup(self) -> None:
+        try:
+            async with redis_bot.pipeline(transaction=True) as pipe:
+                pipe.zadd(self.wakeup_key, {WAKEUP_MEMBER: 0})
+                pipe.expire(self.wakeup_key, WAKEUP_KEY_TTL_SEC)
+                await pipe.execute()
+        except Exception:
+            # the blocking pop will pick up the new queues on its next timeout.
+            logger.exception("queue_dispatcher_wakeup_failed")
+
+    async def run(self) -> NoReturn:
+        log = logger.bind(task="queue_dispatcher")
+        log.info("start queue dispatcher")
+        while True:
+            keys = [self.wakeup_key, *self.idle]
+            self._blocking_on = set(keys)
+            self._wakeup_pending = False
+            try:
+                res = await redis_bot.bzpopmin(
+                    keys, timeout=conf.REDIS_BLOCKING_POP_TIMEOUT_SEC
+                )
+            finally:
+                self._blocking_on = None
+            if res is None:
+                continue
+            key, value, score = res
+            queue_name = key.decode()
+            if queue_name == self.wakeup_key:
+                continue
+            self.pops += 1
+            self.idle.discard(queue_name)
+            self.active[queue_name] = asyncio.create_task(
+                self._drain(queue_name, value, score)
+            )
+            log.info(
+                "queue_dispatcher_popped",
+                queue=queue_name,
+                blocking_keys=len(keys),
+                active_queues=len(self.active),
+                idle_queues=len(self.idle),
+                pops=self.pops,
+            )
+
+    async def _drain(self, queue_name: str, value: bytes, score: float) -> None:
+        """
+        Handle the popped item and any remaining items in the queue.
+        """
+        # whether we hold an event that was popped but not handled.
+        holding_event = True
+        try:
+            while True:
+                handler = self.handlers.get(queue_name)
+                if handler is None or not self.can_handle(queue_name):
+                    # another worker owns this queue now, so return the event.
+                    self.unregister(queue_name)
+                    await redis_bot.zadd(queue_name, {value: score}, nx=True)
+                    holding_event = False
+                    logger.info("queue_event_returned", queue=queue_name)
+                    break
+                try:
+                    await handler(queue_name, value, score)
+                except Exception:
+                    logger.exception("queue_handler_failed", queue=queue_name)
+                holding_event = False
+                res = await redis_bot.zpopmin(queue_name)
+                if not res:
+                    break
+                ((value, score),) = res
+                holding_event = True
+        except asyncio.CancelledError:
+            if holding_event:
+                # we were cancelled mid event, e.g. by losing the queue's
+                # lease, so put the event back for the next owner.
+                await redis_bot.zadd(queue_name, {value: score}, nx=True)
+                logger.info("queue_event_returned", queue=queue_name)
+            raise
+        except Exception:
+            logger.exception("queue_drain_failed", queue=queue_name)
+        finally:
+            del self.active[queue_name]
+            if queue_name in self.handlers:
+                self._mark_idle(queue_name)
@@ -6,6 +6,8 @@ from __future__ import annotations
 
 import hashlib
 import hmac
+import json
+import time
 from typing import Any
 
 import structlog
@@ -17,12 +19,14 @@ from starlette.exceptions import HTTPException
 from starlette.requests import Request
 from starlette.responses import JSONResponse, PlainTextResponse, Response
 
-from kodiak import app_config as conf
+from kodiak import (
+    app_config as conf,
+    ingest_envelope,
+)
 from kodiak.entrypoints.worker import PubsubIngestQueueSchema
 from kodiak.logging import configure_logging
 from kodiak.queue import INGEST_QUEUE_NAMES, QUEUE_PUBSUB_INGEST, get_ingest_queue
 from kodiak.redis_client import redis_bot
-from kodiak.schemas import RawWebhookEvent
 
 configure_logging()
 
@@ -39,10 +43,6 @@ async def root(_: Request) -> Response:
 
 @app.route("/api/github/hook", methods=["POST"])
 async def github_webhook_event(request: Request) -> Response:
-    expected_sha = hmac.new(
-        key=conf.SECRET_KEY.encode(), msg=(await request.body()), digestmod=hashlib.sha1
-    ).hexdigest()
-
     try:
         github_event = request.headers["X-Github-Event"]
     except KeyError as e:
@@ -58,41 +58,60 @@ async def github_webhook_event(request: Request) -> Response:
             detail="missing required X-Hub-Signature header",
         ) from e
 
+    # hash the body as it streams in so we only make a single pass over it.
+    mac = hmac.new(key=conf.SECRET_KEY.encode(), digestmod=hashlib.sha1)
+    chunks = []
+    async for chunk in request.stream():
+        mac.update(chunk)
+        chunks.append(chunk)
+    body = b"".join(chunks)
+
     sha = hub_signature.replace("sha1=", "")
-    if not hmac.compare_digest(sha, expected_sha):
+    if not hmac.compare_digest(sha, mac.hexdigest()):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Invalid signature: X-Hub-Signature",
         )
-    event: dict[str, Any] = await request.json()
-
-    log = logger.bind(event_name=github_event, event=event)
-    installation_id: int | None = event.get("installation", {}).get("id")
 
     if github_event in {
         "github_app_authorization",
         "installation",
         "installation_repositories",
     }:
+        log = logger.bind(event_name=github_event, event=json.loads(body))
         log.info("administrative_event_received")
         return JSONResponse({"ok": True})
 
+    installation_id = ingest_envelope.find_installation_id(body)
     if installation_id is None:
-        log.warning("unexpected_event_skipped")
-        return JSONResponse({"ok": True})
+        # fall back to parsing the payload when the fast path can't find the id.
+        event: dict[str, Any] = json.loads(body)
+        installation_id = event.get("installation", {}).get("id")
+        if installation_id is None:
+            log = logger.bind(event_name=github_event, event=event)
+            log.warning("unexpected_event_skipped")
+            return JSONResponse({"ok": True})
 
     ingest_queue = get_ingest_queue(installation_id)
 
-    await redis_bot.rpush(
-        ingest_queue,
-        RawWebhookEvent(event_name=github_event, payload=event).json(),
-    )
-
-    await redis_bot.ltrim(ingest_queue, 0, conf.INGEST_QUEUE_LENGTH)
-    await redis_bot.sadd(INGEST_QUEUE_NAMES, ingest_queue)
-    await redis_bot.publish(
-        QUEUE_PUBSUB_INGEST,
-        PubsubIngestQueueSchema(installation_id=installation_id).json(),
+    # enqueue, trim, register and notify in a single MULTI/EXEC round trip.
+    start = time.monotonic()
+    async with redis_bot.pipeline(transaction=True) as pipe:
+        pipe.rpush(
+            ingest_queue, ingest_envelope.encode(event_name=github_event, body=body)
+        )
+        pipe.ltrim(ingest_queue, 0, conf.INGEST_QUEUE_LENGTH)
+        pipe.sadd(INGEST_QUEUE_NAMES, ingest_queue)
+        pipe.publish(
+            QUEUE_PUBSUB_INGEST,
+            PubsubIngestQueueSchema(installation_id=installation_id).json(),
+        )
+        await pipe.execute()
+    logger.info(
+        "webhook_event_queued",
+        event_name=github_event,
+        installation_id=installation_id,
+        redis_latency_ms=round((time.monotonic() - start) * 1000, 3),
     )
     return JSONResponse({"ok": True})
 
@@ -0,0 +1,125 @@
+"""
+Run `WORKER_PROCESSES` worker processes so we can use more than one core on a
+host.
+
+Installations are partitioned between the workers by a stable hash of the
+installation id (see `kodiak.leases.in_worker_shard`), so each installation's
+queues are handled by exactly one process. Workers that exit are restarted
+with a backoff.
+
+Use in place of `kodiak.entrypoints.worker`, e.g. in `supervisord.conf`:
+
+    [program:worker]
+    command=/var/app/.venv/bin/python -m kodiak.entrypoints.launcher
+    stopwaitsecs=30
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import os
+import signal
+import sys
+import time
+from typing import NoReturn
+
+import structlog
+
+from kodiak import app_config as conf
+from kodiak.logging import configure_logging
+from kodiak.supervisor import TaskSupervisor
+
+configure_logging()
+
+logger = structlog.get_logger()
+
+# time we give a worker to flush usage reporting events and release leases.
+SHUTDOWN_TIMEOUT_SEC = 20
+
+
+class WorkerExited(Exception):
+    pass
+
+
+class WorkerPool:
+    def __init__(self, *, process_count: int) -> None:
+        self.process_count = process_count
+        self.supervisor = TaskSupervisor(min_backoff_sec=1)
+
+    def start(self) -> None:
+        for shard in range(self.process_count):
+            self.supervisor.start(
+                f"shard-{shard}",
+                kind=f"shard-{shard}",
+                factory=functools.partial(self.run_worker, shard),
+            )
+
+    async def run_worker(self, shard: int) -> NoReturn:
+        log = logger.bind(
+            worker_shard=shard, restarts=self.supervisor.restarts[f"shard-{shard}"]
+        )
+        process = await asyncio.create_subprocess_exec(
+            sys.executable,
+            "-m",
+            "kodiak.entrypoints.worker",
+            env={
+                **os.environ,
+                "WORKER_SHARD_INDEX": str(shard),
+                "WORKER_SHARD_COUNT": str(self.process_count),
+            },
+        )
+        log.info("worker_process_started", pid=process.pid)
+        start = time.monotonic()
+        try:
+            returncode = await process.wait()
+        except asyncio.CancelledError:
+            await self.stop_worker(process)
+            raise
+        log.warning(
+            "worker_process_exited",
+            pid=process.pid,
+            returncode=returncode,
+            uptime_sec=time.monotonic() - start,
+        )
+        # the supervisor restarts the worker with a backoff.
+        raise WorkerExited(f"worker shard {shard} exited with {returncode}")
+
+    async def stop_worker(self, process: asyncio.subprocess.Process) -> None:
+        if process.returncode is not None:
+            return
+        process.terminate()
+        try:
+            await asyncio.wait_for(process.wait(), timeout=SHUTDOWN_TIMEOUT_SEC)
+        except asyncio.TimeoutError:
+            logger.warning("worker_process_killed", pid=process.pid)
+            process.kill()
+            await process.wait()
+
+    async def stop(self) -> None:
+        tasks = [
+            supervised.task
+            for supervised in self.supervisor.tasks.values()
+            if supervised.task is not None
+        ]
+        # cancelling a worker's task stops the worker process.
+        self.supervisor.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main() -> None:
+    pool = WorkerPool(process_count=conf.WORKER_PROCESSES)
+    shutdown = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, shutdown.set)
+    logger.info("start worker launcher", processes=pool.process_count)
+    pool.start()
+    try:
+        await shutdown.wait()
+    finally:
+        await pool.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -5,15 +5,23 @@ Process webhook events from the Redis queues.
 from __future__ import annotations
 
 import asyncio
+import dataclasses
+import functools
+import signal
+import time
 from asyncio.tasks import Task
-from typing import NoReturn
+from typing import Any, NoReturn
 
 import pydantic
-import sentry_sdk
 import structlog
 
-from kodiak import app_config as conf
-from kodiak.assertions import assert_never
+from kodiak import (
+    app_config as conf,
+    ingest_envelope,
+    queries,
+)
+from kodiak.http_cache import response_cache
+from kodiak.leases import in_worker_shard
 from kodiak.logging import configure_logging
 from kodiak.queue import (
     INGEST_QUEUE_NAMES,
@@ -22,47 +30,165 @@ from kodiak.queue import (
     WebhookQueueProtocol,
     get_ingest_queue,
     handle_webhook_event,
+    installation_id_from_ingest_queue,
 )
 from kodiak.redis_client import redis_bot
+from kodiak.retry import retry_policy
 from kodiak.schemas import RawWebhookEvent
+from kodiak.supervisor import TaskSupervisor
+from kodiak.usage_reporting import usage_reporter
 
 configure_logging()
 
 logger = structlog.get_logger()
 
+GITHUB_POOL_METRICS_INTERVAL_SEC = 60
 
-async def work_ingest_queue(queue: WebhookQueueProtocol, queue_name: str) -> NoReturn:
-    log = logger.bind(queue_name=queue_name, task="work_ingest_queue")
 
-    log.info("start working ingest_queue")
-    while True:
-        res = await redis_bot.blpop(
-            [queue_name], timeout=conf.REDIS_BLOCKING_POP_TIMEOUT_SEC
+def get_partition_key(event_name: str, payload: dict[str, Any]) -> str:
+    """
+    Events with the same partition key are handled in the order we receive
+    them, while events with different keys may be handled concurrently.
+
+    We key events by the pull request, commit, or ref they affect.
+    """
+    repo = (payload.get("repository") or {}).get("full_name")
+    if event_name in {
+        "pull_request",
+        "pull_request_review",
+        "pull_request_review_thread",
+    }:
+        pull_request = payload.get("pull_request") or {}
+        return f"{repo}#{pull_request.get('number')}"
+    if event_name == "check_run":
+        check_run = payload.get("check_run") or {}
+        return f"{repo}@{check_run.get('head_sha')}"
+    if event_name == "status":
+        return f"{repo}@{payload.get('sha')}"
+    if event_name == "push":
+        return f"{repo}:{payload.get('ref')}"
+    return f"{repo}"
+
+
+class IngestQueueWorker:
+    """
+    Handle events from an installation's ingest queue with up to
+    `concurrency` events in flight.
+    """
+
+    def __init__(
+        self, *, queue: WebhookQueueProtocol, queue_name: str, concurrency: int
+    ) -> None:
+        self.queue = queue
+        self.queue_name = queue_name
+        self.log = logger.bind(queue_name=queue_name, task="work_ingest_queue")
+        self.semaphore = asyncio.Semaphore(concurrency)
+        # partition key -> most recently started task for that key.
+        self.partitions: dict[str, Task[None]] = {}
+        self.tasks: set[Task[None]] = set()
+        self.in_flight = 0
+
+    async def run(self) -> NoReturn:
+        self.log.info("start working ingest_queue")
+        try:
+            await self.pop_events()
+        finally:
+            await self.cancel_tasks()
+
+    async def pop_events(self) -> NoReturn:
+        while True:
+            # wait for a free slot before popping so the backlog stays in Redis.
+            await self.semaphore.acquire()
+            try:
+                res = await redis_bot.blpop(
+                    [self.queue_name], timeout=conf.REDIS_BLOCKING_POP_TIMEOUT_SEC
+                )
+                if res is None:
+                    self.semaphore.release()
+                    continue
+                _, value = res
+                parsed_event = ingest_envelope.decode(value)
+            except BaseException:
+                self.semaphore.release()
+                raise
+            key = get_partition_key(parsed_event.event_name, parsed_event.payload)
+            task = asyncio.create_task(
+                self.handle(parsed_event, previous=self.partitions.get(key))
+            )
+            self.partitions[key] = task
+            self.tasks.add(task)
+            self.in_flight += 1
+            task.add_done_callback(functools.partial(self.on_done, key))
+
+    def on_done(self, key: str, task: Task[None]) -> None:
+        self.in_flight -= 1
+        self.semaphore.release()
+        self.tasks.discard(task)
+        if self.partitions.get(key) is task:
+            del self.partitions[key]
+
+    async def cancel_tasks(self) -> None:
+        """
+        Cancel in flight events when the worker stops, so handlers don't
+        outlive the worker.
+        """
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def handle(self, event: RawWebhookEvent, previous: Task[None] | None) -> None:
+        if previous is not None:
+            # preserve ordering of events within the partition.
+            await asyncio.wait([previous])
+        log = self.log.bind(event_name=event.event_name)
+        # time from the ingest server queuing the event to us handling it.
+        queue_lag_sec = (
+            time.time() - event.enqueued_at if event.enqueued_at is not None else None
         )
-        if res is None:
-            continue
-        _, value = res
-        parsed_event = RawWebhookEvent.parse_raw(value)
         try:
             await asyncio.wait_for(
                 handle_webhook_event(
-                    queue=queue,
-                    event_name=parsed_event.event_name,
-                    payload=parsed_event.payload,
+                    queue=self.queue,
+                    event_name=event.event_name,
+                    payload=event.payload,
                 ),
                 timeout=60,
             )
         except asyncio.TimeoutError:
             log.warning("handle_webhook_event timed out")
-        log.info("ingest_event_handled")
+        except Exception:
+            log.exception("handle_webhook_event failed")
+        log.info(
+            "ingest_event_handled",
+            in_flight=self.in_flight,
+            partitions=len(self.partitions),
+            queue_lag_sec=queue_lag_sec,
+        )
+
+
+async def work_ingest_queue(queue: WebhookQueueProtocol, queue_name: str) -> NoReturn:
+    await IngestQueueWorker(
+        queue=queue, queue_name=queue_name, concurrency=conf.INGEST_QUEUE_CONCURRENCY
+    ).run()
 
 
 class PubsubIngestQueueSchema(pydantic.BaseModel):
     installation_id: int
 
 
+def start_ingest_worker(
+    supervisor: TaskSupervisor, queue: RedisWebhookQueue, queue_name: str
+) -> None:
+    supervisor.start(
+        queue_name,
+        kind="ingest",
+        factory=lambda: work_ingest_queue(queue, queue_name=queue_name),
+    )
+
+
 async def ingest_queue_starter(
-    ingest_workers: dict[str, Task[NoReturn]], queue: RedisWebhookQueue
+    supervisor: TaskSupervisor, queue: RedisWebhookQueue
 ) -> None:
     """
     Listen on Redis Pubsub and start queue worker if we don't have one already.
@@ -78,73 +204,76 @@ async def ingest_queue_starter(
         installation_id = PubsubIngestQueueSchema.parse_raw(
             reply["data"]
         ).installation_id
-        queue_name = get_ingest_queue(installation_id)
-        if queue_name not in ingest_workers:
-            ingest_workers[queue_name] = asyncio.create_task(
-                work_ingest_queue(queue, queue_name=queue_name)
-            )
-            log.info("started new task")
+        if not in_worker_shard(str(installation_id)):
+            continue
+        start_ingest_worker(supervisor, queue, get_ingest_queue(installation_id))
 
 
-async def main() -> NoReturn:
-    queue = RedisWebhookQueue()
-    await queue.create()
+async def log_github_pool_metrics() -> NoReturn:
+    while True:
+        await asyncio.sleep(GITHUB_POOL_METRICS_INTERVAL_SEC)
+        metrics = await queries.get_github_pool_metrics()
+        if metrics is not None:
+            logger.info("github_http_pool", **dataclasses.asdict(metrics))
+        logger.info(
+            "github_http_cache",
+            # 304s don't count against the rate limit, so each hit saves a
+            # request of budget.
+            hits=response_cache.hits,
+            misses=response_cache.misses,
+            entries=len(response_cache.responses),
+            size=response_cache.size,
+        )
+        logger.info("retry_policy", **dataclasses.asdict(retry_policy.metrics))
+
 
-    ingest_workers = dict()
+async def main() -> None:
+    supervisor = TaskSupervisor()
+    queue = RedisWebhookQueue(supervisor)
+    shutdown = asyncio.Event()
+    # stop on SIGTERM so we flush buffered usage reporting events and release
+    # our queue leases on shutdown.
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, shutdown.set)
+    try:
+        await start_workers(supervisor, queue)
+        # the supervisor restarts failed tasks from their done callbacks, so
+        # there's nothing left to do but wait.
+        await shutdown.wait()
+    finally:
+        supervisor.cancel()
+        if queue.leases is not None:
+            await queue.leases.close()
+        await usage_reporter.close()
+        await queries.close_github_session()
+
+
+async def start_workers(supervisor: TaskSupervisor, queue: RedisWebhookQueue) -> None:
+    await queue.create()
+    # avoid an introspection query for the first evaluation after a restart.
+    await queries.api_features_registry.warm()
 
     ingest_queue_names = await redis_bot.smembers(INGEST_QUEUE_NAMES)
     log = logger.bind(task="main_worker")
 
     for queue_name_bytes in ingest_queue_names:
         queue_name = queue_name_bytes.decode()
-        if queue_name not in ingest_workers:
-            log.info("start ingest_queue_worker", queue_name=queue_name)
-            ingest_workers[queue_name] = asyncio.create_task(
-                work_ingest_queue(queue, queue_name=queue_name)
-            )
+        if not in_worker_shard(installation_id_from_ingest_queue(queue_name)):
+            continue
+        log.info("start ingest_queue_worker", queue_name=queue_name)
+        start_ingest_worker(supervisor, queue, queue_name)
 
-    log.info("start ingest_queue_watcher")
-    ingest_queue_watcher = asyncio.create_task(
-        ingest_queue_starter(ingest_workers, queue)
+    supervisor.start(
+        "github_pool_metrics",
+        kind="github_pool_metrics",
+        factory=log_github_pool_metrics,
     )
 
-    while True:
-        # Health check the various tasks and recreate them if necessary.
-        # There's probably a cleaner way to do this.
-        await asyncio.sleep(0.25)
-        for queue_name, worker_task in ingest_workers.items():
-            if worker_task is None or not worker_task.done():
-                continue
-            logger.info("worker task failed", kind="ingest")
-            # task failed. record result and restart
-            exception = worker_task.exception()
-            logger.info("exception", excep=exception)
-            sentry_sdk.capture_exception(exception)
-            ingest_workers[queue_name] = asyncio.create_task(
-                work_ingest_queue(queue, queue_name=queue_name)
-            )
-        for task_meta, cur_task in queue.all_tasks():
-            if not cur_task.done():
-                continue
-            logger.info("worker task failed", kind=task_meta.kind)
-            # task failed. record result and restart
-            exception = cur_task.exception()
-            logger.info("exception", excep=exception)
-            sentry_sdk.capture_exception(exception)
-            if task_meta.kind == "repo":
-                queue.start_repo_worker(queue_name=task_meta.queue_name)
-            elif task_meta.kind == "webhook":
-                queue.start_webhook_worker(queue_name=task_meta.queue_name)
-            else:
-                assert_never(task_meta.kind)
-        if ingest_queue_watcher.done():
-            logger.info("worker task failed", kind="ingest_queue_watcher")
-            exception = ingest_queue_watcher.exception()
-            logger.info("exception", excep=exception)
-            sentry_sdk.capture_exception(exception)
-            ingest_queue_watcher = asyncio.create_task(
-                ingest_queue_starter(ingest_workers, queue)
-            )
+    log.info("start ingest_queue_watcher")
+    supervisor.start(
+        "ingest_queue_watcher",
+        kind="ingest_queue_watcher",
+        factory=lambda: ingest_queue_starter(supervisor, queue),
+    )
 
 
 if __name__ == "__main__":
@@ -16,8 +16,13 @@ class Ref(pydantic.BaseModel):
     ref: str
 
 
+class Head(pydantic.BaseModel):
+    sha: str
+
+
 class PullRequest(pydantic.BaseModel):
     base: Ref
+    head: Head
 
 
 class PullRequestEvent(GithubEvent):
@@ -25,6 +30,7 @@ class PullRequestEvent(GithubEvent):
     https://developer.github.com/v3/activity/events/types/#pullrequestevent
     """
 
+    action: str
     number: int
     pull_request: PullRequest
     repository: Repository
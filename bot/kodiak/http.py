@@ -1,18 +1,36 @@
 from __future__ import annotations
 
 import ssl
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple
 
+import httpcore
 from httpx import (
+    URL,
+    AsyncBaseTransport,
+    AsyncByteStream,
     AsyncClient,
+    AsyncHTTPTransport,
     HTTPError,
     HTTPStatusError,
+    Limits,
     Request,
     Response,
 )
 from httpx._config import DEFAULT_TIMEOUT_CONFIG
 from httpx._types import TimeoutTypes
 
-__all__ = ["HTTPError", "HTTPStatusError", "HttpClient", "Request", "Response"]
+__all__ = [
+    "URL",
+    "HTTPError",
+    "HTTPStatusError",
+    "HttpClient",
+    "Limits",
+    "PoolMetrics",
+    "PooledTransport",
+    "Request",
+    "Response",
+]
 
 # NOTE: this has a cost to create so we may want to set this lazily on the first HttpClient creation
 context = ssl.create_default_context()
@@ -28,8 +46,94 @@ class HttpClient(AsyncClient):
         self,
         *,
         timeout: TimeoutTypes = DEFAULT_TIMEOUT_CONFIG,
+        transport: Optional[AsyncBaseTransport] = None,
+        event_hooks: Optional[Mapping[str, List[Callable[..., Any]]]] = None,
     ):
         super().__init__(
             verify=context,
             timeout=timeout,
+            # httpx uses its defaults for None.
+            event_hooks=event_hooks,  # type: ignore [arg-type]
+            transport=transport,  # type: ignore [arg-type]
+        )
+
+
+@dataclass
+class PoolMetrics:
+    requests: int
+    connections_open: int
+    connections_active: int
+    connections_idle: int
+    connections_opened: int
+    connections_reused: int
+    waiting: int
+
+
+class MeteredConnectionPool(httpcore.AsyncConnectionPool):
+    """
+    Connection pool that counts new connections and the requests waiting for
+    a free connection slot.
+
+    NOTE: `_add_to_pool` is private httpcore API, which is pinned in
+    pyproject.toml.
+    """
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.connections_opened = 0
+        self.waiting = 0
+
+    async def _add_to_pool(self, connection: Any, timeout: Any) -> None:
+        # we block here while the pool is at `max_connections`.
+        self.waiting += 1
+        try:
+            await super()._add_to_pool(connection, timeout)
+        finally:
+            self.waiting -= 1
+        self.connections_opened += 1
+
+
+class PooledTransport(AsyncHTTPTransport):
+    """
+    Keep-alive transport to share between clients so connections are reused.
+    """
+
+    def __init__(self, *, limits: Limits) -> None:
+        super().__init__(verify=context, limits=limits)
+        self.pool = MeteredConnectionPool(
+            ssl_context=context,
+            max_connections=limits.max_connections,
+            max_keepalive_connections=limits.max_keepalive_connections,
+            keepalive_expiry=limits.keepalive_expiry,
+        )
+        self._pool = self.pool  # type: ignore [has-type]
+        self.requests = 0
+
+    async def handle_async_request(
+        self,
+        method: bytes,
+        url: Tuple[bytes, bytes, Optional[int], bytes],
+        headers: List[Tuple[bytes, bytes]],
+        stream: AsyncByteStream,
+        extensions: Dict[str, Any],
+    ) -> Tuple[int, List[Tuple[bytes, bytes]], AsyncByteStream, Dict[str, Any]]:
+        self.requests += 1
+        return await super().handle_async_request(
+            method, url, headers, stream, extensions
+        )
+
+    async def get_metrics(self) -> PoolMetrics:
+        states = [
+            state
+            for connections in (await self.pool.get_connection_info()).values()
+            for state in connections
+        ]
+        return PoolMetrics(
+            requests=self.requests,
+            connections_open=len(states),
+            connections_active=sum("ACTIVE" in state for state in states),
+            connections_idle=sum("IDLE" in state for state in states),
+            connections_opened=self.pool.connections_opened,
+            connections_reused=max(0, self.requests - self.pool.connections_opened),
+            waiting=self.pool.waiting,
         )
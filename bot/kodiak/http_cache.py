@@ -0,0 +1,129 @@
+"""
+Conditional request cache for GitHub REST reads.
+
+GitHub doesn't count `304 Not Modified` responses against the rate limit, so
+we keep the `ETag`/`Last-Modified` validators and body of GET responses and
+revalidate with `If-None-Match`/`If-Modified-Since`. On a 304 we serve the
+body from the cache.
+
+Entries are kept in an LRU bounded by `HTTP_CACHE_MAX_BYTES` of response
+bodies.
+"""
+
+from __future__ import annotations
+
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import List, Mapping, Optional, Tuple
+
+from kodiak import (
+    app_config as conf,
+    http,
+)
+
+# headers that describe the encoding of the original response, which don't
+# apply to the decoded body we store.
+_SKIPPED_HEADERS = {"content-encoding", "content-length", "transfer-encoding"}
+
+
+def get_stored_headers(res: http.Response) -> List[Tuple[str, str]]:
+    return [
+        (name, value)
+        for name, value in res.headers.items()
+        if name.lower() not in _SKIPPED_HEADERS
+    ]
+
+
+@dataclass(frozen=True)
+class CachedResponse:
+    etag: Optional[str]
+    last_modified: Optional[str]
+    headers: List[Tuple[str, str]]
+    content: bytes
+
+
+class ResponseCache:
+    def __init__(self, *, max_bytes: int) -> None:
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.responses: OrderedDict[Tuple[str, str], CachedResponse] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(
+        self,
+        session: http.AsyncClient,
+        url: str,
+        *,
+        scope: str,
+        params: Optional[Mapping[str, str]] = None,
+        headers: Optional[Mapping[str, str]] = None,
+    ) -> http.Response:
+        """
+        GET `url`, revalidating a cached response if we have one.
+
+        `scope` identifies who is making the request, e.g. the installation
+        id, so a response is never served to a different installation.
+        """
+        key = (scope, str(http.URL(url, params=params)))
+        cached = self.responses.get(key)
+        request_headers = dict(headers or {})
+        if cached is not None:
+            if cached.etag is not None:
+                request_headers["If-None-Match"] = cached.etag
+            if cached.last_modified is not None:
+                request_headers["If-Modified-Since"] = cached.last_modified
+
+        res = await session.get(url, params=params, headers=request_headers)
+
+        if cached is not None and res.status_code == 304:
+            self.responses.move_to_end(key)
+            self.hits += 1
+            # the 304 carries the latest rate limit headers, so its headers
+            # take precedence over the cached ones.
+            fresh_headers = get_stored_headers(res)
+            fresh_names = {name.lower() for name, _ in fresh_headers}
+            return http.Response(
+                status_code=200,
+                headers=[
+                    (name, value)
+                    for name, value in cached.headers
+                    if name.lower() not in fresh_names
+                ]
+                + fresh_headers,
+                content=cached.content,
+                request=res.request,
+            )
+
+        self.misses += 1
+        self.discard(key)
+        etag = res.headers.get("etag")
+        last_modified = res.headers.get("last-modified")
+        if res.status_code == 200 and (etag is not None or last_modified is not None):
+            self.add(
+                key,
+                CachedResponse(
+                    etag=etag,
+                    last_modified=last_modified,
+                    headers=get_stored_headers(res),
+                    content=res.content,
+                ),
+            )
+        return res
+
+    def add(self, key: Tuple[str, str], response: CachedResponse) -> None:
+        if len(response.content) > self.max_bytes:
+            return
+        self.responses[key] = response
+        self.size += len(response.content)
+        while self.size > self.max_bytes:
+            _, evicted = self.responses.popitem(last=False)
+            self.size -= len(evicted.content)
+
+    def discard(self, key: Tuple[str, str]) -> None:
+        evicted = self.responses.pop(key, None)
+        if evicted is not None:
+            self.size -= len(evicted.content)
+
+
+response_cache = ResponseCache(max_bytes=conf.HTTP_CACHE_MAX_BYTES)
@@ -0,0 +1,133 @@
+"""
+Encoding of entries in the `kodiak:ingest:{installation_id}` queues.
+
+The ingest server stores the raw webhook body instead of parsing and
+re-serializing the payload, so an entry has the form:
+
+    <version byte><event name> <enqueued at>\n<body>
+
+The enqueue time is a unix timestamp the worker uses to measure queue lag. It
+may be missing from entries written before we recorded it.
+
+Version 1 stores the raw body and version 2 stores the body as a zstd frame,
+optionally compressed with a dictionary trained on GitHub payloads (see
+`kodiak train-ingest-dictionary`). Dictionary compressed frames record the
+dictionary id, so the worker must be configured with the same dictionary.
+
+Entries written before the envelope existed are JSON encoded
+`RawWebhookEvent`s, which always start with `{`, so we can tell them apart by
+the first byte.
+"""
+
+from __future__ import annotations
+
+import json
+import re
+import time
+from pathlib import Path
+
+import zstandard as zstd
+
+from kodiak import app_config as conf
+from kodiak.schemas import RawWebhookEvent
+
+ENVELOPE_V1 = b"\x01"
+ENVELOPE_V2_ZSTD = b"\x02"
+
+# GitHub places the installation id as the first key of the top level
+# `installation` object, e.g. `"installation":{"id":1234,"node_id":"..."}`.
+#
+# Quotes in JSON string values are always escaped, so this pattern can't match
+# inside the body of a pull request or commit message.
+INSTALLATION_ID_PATTERN = re.compile(rb'"installation"\s*:\s*\{\s*"id"\s*:\s*(\d+)')
+
+
+_compression_dict: zstd.ZstdCompressionDict | None = None
+_compressor: zstd.ZstdCompressor | None = None
+_decompressor: zstd.ZstdDecompressor | None = None
+
+
+def load_compression_dict(path: str | None) -> zstd.ZstdCompressionDict | None:
+    """
+    Load the zstd dictionary at `path`, if configured.
+    """
+    if not path:
+        return None
+    return zstd.ZstdCompressionDict(Path(path).read_bytes())
+
+
+def create_compressor(
+    compression_dict: zstd.ZstdCompressionDict | None,
+) -> zstd.ZstdCompressor:
+    # compression contexts are reusable, so callers should only create one.
+    if compression_dict is not None:
+        return zstd.ZstdCompressor(dict_data=compression_dict)
+    return zstd.ZstdCompressor()
+
+
+def _get_compression_dict() -> zstd.ZstdCompressionDict | None:
+    global _compression_dict
+    if _compression_dict is None:
+        _compression_dict = load_compression_dict(
+            conf.INGEST_QUEUE_ZSTD_DICTIONARY_PATH
+        )
+    return _compression_dict
+
+
+def _get_compressor() -> zstd.ZstdCompressor:
+    global _compressor
+    if _compressor is None:
+        _compressor = create_compressor(_get_compression_dict())
+    return _compressor
+
+
+def _get_decompressor() -> zstd.ZstdDecompressor:
+    global _decompressor
+    if _decompressor is None:
+        compression_dict = _get_compression_dict()
+        if compression_dict is not None:
+            _decompressor = zstd.ZstdDecompressor(dict_data=compression_dict)
+        else:
+            _decompressor = zstd.ZstdDecompressor()
+    return _decompressor
+
+
+def encode(*, event_name: str, body: bytes) -> bytes:
+    return (
+        ENVELOPE_V2_ZSTD
+        + event_name.encode()
+        + b" %.3f\n" % time.time()
+        + _get_compressor().compress(body)
+    )
+
+
+def decode(data: bytes) -> RawWebhookEvent:
+    """
+    Decode an ingest queue entry, parsing the webhook payload.
+    """
+    version = data[:1]
+    if version in {ENVELOPE_V1, ENVELOPE_V2_ZSTD}:
+        header, _, body = data[1:].partition(b"\n")
+        event_name, _, enqueued_at = header.partition(b" ")
+        if version == ENVELOPE_V2_ZSTD:
+            body = _get_decompressor().decompress(body)
+        return RawWebhookEvent.construct(
+            event_name=event_name.decode(),
+            payload=json.loads(body),
+            enqueued_at=float(enqueued_at) if enqueued_at else None,
+        )
+    # entries queued before we started using the envelope.
+    return RawWebhookEvent.parse_raw(data)
+
+
+def find_installation_id(body: bytes) -> int | None:
+    """
+    Find the installation id of a webhook body without parsing the payload.
+
+    Returns None when the id is missing or ambiguous, in which case callers
+    should fall back to parsing the payload.
+    """
+    installation_ids = {int(m) for m in INSTALLATION_ID_PATTERN.findall(body)}
+    if len(installation_ids) != 1:
+        return None
+    return installation_ids.pop()
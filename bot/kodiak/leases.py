@@ -0,0 +1,403 @@
+"""
+Share webhook and merge queues between worker processes.
+
+Each worker heartbeats into a Redis sorted set. Queues are assigned to live
+workers with a consistent hash ring keyed by installation id, so an
+installation's webhook and merge queues stay on the same worker and only a
+fraction of queues move when a worker joins or leaves.
+
+A worker only handles a queue while it holds the queue's lease. Leases expire
+after `WORKER_LEASE_TTL_SEC` unless renewed by the heartbeat, so at most one
+worker merges a given merge queue and a dead worker's queues fail over once
+its heartbeat and leases expire.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import bisect
+import hashlib
+import os
+import socket
+import time
+import uuid
+from typing import (
+    Any,
+    Callable,
+    Coroutine,
+    Dict,
+    Iterable,
+    List,
+    NoReturn,
+    Sequence,
+    Set,
+    Tuple,
+)
+
+import structlog
+
+from kodiak import app_config as conf
+from kodiak.dispatcher import QueueDispatcher, QueueHandler
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+WORKERS_KEY = "kodiak:workers"
+QUEUE_PUBSUB_DISCOVERY = "kodiak:pubsub:queues"
+VIRTUAL_NODES = 64
+DISCOVERY_INTERVAL_SEC = 30
+
+RENEW_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("pexpire", KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_SCRIPT = """
+if redis.call("get", KEYS[1]) == ARGV[1] then
+    return redis.call("del", KEYS[1])
+end
+return 0
+"""
+
+
+def get_lease_key(queue_name: str) -> str:
+    return f"kodiak:lease:{queue_name}"
+
+
+def stable_hash(value: str) -> int:
+    """
+    Unlike `hash()`, this is the same in every process.
+    """
+    return int.from_bytes(hashlib.sha1(value.encode()).digest()[:8], "big")
+
+
+def get_shard_key(queue_name: str) -> str:
+    """
+    webhook:848733 -> 848733
+    merge_queue:848733.chdsbd/kodiak/master -> 848733
+    """
+    return queue_name.partition(":")[2].partition(".")[0]
+
+
+def get_shard_index(installation_id: str, shard_count: int) -> int:
+    return stable_hash(installation_id) % shard_count
+
+
+def in_worker_shard(installation_id: str) -> bool:
+    """
+    Whether this process handles `installation_id` when running under
+    `kodiak.entrypoints.launcher`.
+    """
+    return (
+        get_shard_index(installation_id, conf.WORKER_SHARD_COUNT)
+        == conf.WORKER_SHARD_INDEX
+    )
+
+
+class HashRing:
+    def __init__(self, members: Iterable[str]) -> None:
+        self.members = tuple(sorted(set(members)))
+        points: List[Tuple[int, str]] = sorted(
+            (stable_hash(f"{member}#{index}"), member)
+            for member in self.members
+            for index in range(VIRTUAL_NODES)
+        )
+        self._hashes = [point for point, _ in points]
+        self._members = [member for _, member in points]
+
+    def owner(self, key: str) -> str | None:
+        if not self._hashes:
+            return None
+        index = bisect.bisect(self._hashes, stable_hash(key)) % len(self._hashes)
+        return self._members[index]
+
+
+class LeaseManager:
+    def __init__(
+        self,
+        *,
+        dispatcher: QueueDispatcher,
+        handler_for: Callable[[str], QueueHandler],
+        queue_name_sets: Sequence[str],
+        lease_ttl_sec: float,
+        heartbeat_interval_sec: float,
+    ) -> None:
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self.dispatcher = dispatcher
+        self.handler_for = handler_for
+        # Redis sets of queue names we read to discover queues.
+        self.queue_name_sets = queue_name_sets
+        self.lease_ttl_sec = lease_ttl_sec
+        self.heartbeat_interval_sec = heartbeat_interval_sec
+        # we don't know about any workers until our first heartbeat.
+        self.ring = HashRing([])
+        self.tracked: Set[str] = set()
+        # queues assigned to us by the hash ring.
+        self.assigned: Set[str] = set()
+        # queue name -> monotonic time our lease expires.
+        self.leases: Dict[str, float] = {}
+        # stop handling a queue as soon as its lease expires locally, even if
+        # the heartbeat is failing.
+        self._expiry_timers: Dict[str, asyncio.TimerHandle] = {}
+        self.discovered_at = 0.0
+        self.acquired = 0
+        self.lost = 0
+        self.released = 0
+        self.log = logger.bind(worker_id=self.worker_id)
+        self._tasks: Set[asyncio.Task[None]] = set()
+        dispatcher.can_handle = self.owns
+
+    def owns(self, queue_name: str) -> bool:
+        """
+        Whether we hold an unexpired lease for `queue_name`.
+
+        This is checked locally, so it stays correct if our event loop stalls
+        and the heartbeat can't renew our leases.
+        """
+        valid_until = self.leases.get(queue_name)
+        return valid_until is not None and valid_until > time.monotonic()
+
+    def track(
+        self, queue_name: str, *, announce: bool = True, acquire: bool = True
+    ) -> None:
+        """
+        Start considering `queue_name` for our leases. If the queue is
+        assigned to us we claim it immediately, otherwise other workers are
+        notified so the queue's owner can claim it.
+        """
+        if queue_name in self.tracked:
+            return
+        self.tracked.add(queue_name)
+        if self.ring.owner(get_shard_key(queue_name)) == self.worker_id:
+            self.assigned.add(queue_name)
+            if acquire:
+                self._start_task(self._acquire_now(queue_name))
+        elif announce:
+            self._start_task(self._announce(queue_name))
+
+    def _start_task(self, coro: Coroutine[Any, Any, None]) -> None:
+        task = asyncio.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _acquire_now(self, queue_name: str) -> None:
+        try:
+            await self.acquire([queue_name])
+        except Exception:
+            # we'll retry on the next heartbeat.
+            self.log.exception("lease_acquire_failed", queue=queue_name)
+
+    async def _announce(self, queue_name: str) -> None:
+        try:
+            await redis_bot.publish(QUEUE_PUBSUB_DISCOVERY, queue_name)
+        except Exception:
+            # we'll find the queue on the next discovery interval.
+            self.log.exception("queue_announce_failed", queue=queue_name)
+
+    async def listen(self) -> NoReturn:
+        """
+        Track queues announced by other workers.
+        """
+        pubsub = redis_bot.pubsub()
+        await pubsub.subscribe(QUEUE_PUBSUB_DISCOVERY)
+        while True:
+            reply = await pubsub.get_message(ignore_subscribe_messages=True, timeout=10)
+            if reply is None:
+                continue
+            self.track(reply["data"].decode(), announce=False)
+
+    async def run(self) -> NoReturn:
+        self.log.info("start lease heartbeat")
+        while True:
+            start = time.monotonic()
+            try:
+                await self.heartbeat()
+            except Exception:
+                # we couldn't renew our leases, so another worker may claim
+                # the ones that expired.
+                self.log.exception("lease_heartbeat_failed")
+                self.lose_expired()
+            await asyncio.sleep(
+                max(0.0, self.heartbeat_interval_sec - (time.monotonic() - start))
+            )
+
+    async def heartbeat(self) -> None:
+        if time.monotonic() - self.discovered_at >= DISCOVERY_INTERVAL_SEC:
+            await self.discover()
+        now = time.time()
+        async with redis_bot.pipeline(transaction=False) as pipe:
+            pipe.zadd(WORKERS_KEY, {self.worker_id: now})
+            pipe.zremrangebyscore(WORKERS_KEY, "-inf", now - self.lease_ttl_sec)
+            pipe.zrange(WORKERS_KEY, 0, -1)
+            _, _, members = await pipe.execute()
+        ring = HashRing(member.decode() for member in members)
+        if ring.members != self.ring.members:
+            self.log.info("worker_membership_changed", workers=len(ring.members))
+            self.ring = ring
+            self.assigned = {
+                queue_name
+                for queue_name in self.tracked
+                if ring.owner(get_shard_key(queue_name)) == self.worker_id
+            }
+        await self.renew()
+        await self.rebalance()
+        self.log.info(
+            "lease_heartbeat",
+            workers=len(self.ring.members),
+            tracked=len(self.tracked),
+            assigned=len(self.assigned),
+            leases=len(self.leases),
+            acquired=self.acquired,
+            released=self.released,
+            lost=self.lost,
+        )
+
+    async def discover(self) -> None:
+        self.discovered_at = time.monotonic()
+        async with redis_bot.pipeline(transaction=False) as pipe:
+            for key in self.queue_name_sets:
+                pipe.smembers(key)
+            results = await pipe.execute()
+        for queue_names in results:
+            for queue_name in queue_names:
+                # the heartbeat claims discovered queues after discovery.
+                self.track(queue_name.decode(), announce=False, acquire=False)
+
+    async def renew(self) -> None:
+        if not self.leases:
+            return
+        queue_names = list(self.leases)
+        start = time.monotonic()
+        async with redis_bot.pipeline(transaction=False) as pipe:
+            for queue_name in queue_names:
+                pipe.eval(
+                    RENEW_SCRIPT,
+                    1,
+                    get_lease_key(queue_name),
+                    self.worker_id,
+                    int(self.lease_ttl_sec * 1000),
+                )
+            results = await pipe.execute()
+        for queue_name, renewed in zip(queue_names, results):
+            if queue_name not in self.leases:
+                # the lease expired while we were renewing it.
+                continue
+            if renewed:
+                self._set_lease(queue_name, start + self.lease_ttl_sec)
+            else:
+                self._lose(queue_name)
+
+    def _set_lease(self, queue_name: str, valid_until: float) -> None:
+        self.leases[queue_name] = valid_until
+        timer = self._expiry_timers.pop(queue_name, None)
+        if timer is not None:
+            timer.cancel()
+        self._expiry_timers[queue_name] = asyncio.get_running_loop().call_later(
+            max(0.0, valid_until - time.monotonic()), self._expire, queue_name
+        )
+
+    def _clear_lease(self, queue_name: str) -> None:
+        self.leases.pop(queue_name, None)
+        timer = self._expiry_timers.pop(queue_name, None)
+        if timer is not None:
+            timer.cancel()
+
+    def _expire(self, queue_name: str) -> None:
+        self._expiry_timers.pop(queue_name, None)
+        if queue_name not in self.leases:
+            return
+        if self.owns(queue_name):
+            # the event loop may run timers slightly early.
+            self._set_lease(queue_name, self.leases[queue_name])
+            return
+        self._lose(queue_name)
+
+    def lose_expired(self) -> None:
+        """
+        Stop handling the queues whose leases have expired locally.
+        """
+        for queue_name in [q for q in self.leases if not self.owns(q)]:
+            self._lose(queue_name)
+
+    def _lose(self, queue_name: str) -> None:
+        """
+        Stop handling a queue immediately because another worker may have
+        claimed it. The cancelled handler clears its merge target and the
+        dispatcher puts the event it was handling back on the queue.
+        """
+        self.lost += 1
+        self.log.warning("lease_lost", queue=queue_name)
+        self._clear_lease(queue_name)
+        self.dispatcher.unregister(queue_name)
+        task = self.dispatcher.active.get(queue_name)
+        if task is not None:
+            task.cancel()
+
+    async def rebalance(self) -> None:
+        to_acquire = []
+        for queue_name in self.assigned:
+            if queue_name not in self.leases:
+                to_acquire.append(queue_name)
+            elif queue_name not in self.dispatcher.handlers:
+                # the queue was reassigned to us before we released it.
+                self.dispatcher.register(queue_name, self.handler_for(queue_name))
+        to_release = [q for q in self.leases if q not in self.assigned]
+        await self.acquire(to_acquire)
+        for queue_name in to_release:
+            self.dispatcher.unregister(queue_name)
+        # wait for in progress events to finish before releasing leases so we
+        # never merge concurrently with the new owner.
+        await self.release([q for q in to_release if q not in self.dispatcher.active])
+
+    async def acquire(self, queue_names: Sequence[str]) -> None:
+        if not queue_names:
+            return
+        start = time.monotonic()
+        async with redis_bot.pipeline(transaction=False) as pipe:
+            for queue_name in queue_names:
+                pipe.set(
+                    get_lease_key(queue_name),
+                    self.worker_id,
+                    nx=True,
+                    px=int(self.lease_ttl_sec * 1000),
+                )
+            results = await pipe.execute()
+        for queue_name, acquired in zip(queue_names, results):
+            if not acquired or queue_name in self.leases:
+                # the previous owner's lease hasn't expired, or we already
+                # hold it. We'll retry on the next heartbeat.
+                continue
+            self.acquired += 1
+            self._set_lease(queue_name, start + self.lease_ttl_sec)
+            self.dispatcher.register(queue_name, self.handler_for(queue_name))
+
+    async def release(self, queue_names: Sequence[str]) -> None:
+        if not queue_names:
+            return
+        async with redis_bot.pipeline(transaction=False) as pipe:
+            for queue_name in queue_names:
+                pipe.eval(RELEASE_SCRIPT, 1, get_lease_key(queue_name), self.worker_id)
+            await pipe.execute()
+        for queue_name in queue_names:
+            self.released += 1
+            self._clear_lease(queue_name)
+
+    async def close(self) -> None:
+        """
+        Leave the ring and release our leases so other workers can claim our
+        queues without waiting for them to expire. Call on shutdown.
+        """
+        for queue_name in self.leases:
+            self.dispatcher.unregister(queue_name)
+        active = [
+            task
+            for queue_name, task in self.dispatcher.active.items()
+            if queue_name in self.leases
+        ]
+        for task in active:
+            task.cancel()
+        await asyncio.gather(*active, return_exceptions=True)
+        await redis_bot.zrem(WORKERS_KEY, self.worker_id)
+        await self.release(list(self.leases))
@@ -125,6 +125,18 @@ def add_request_info_processor(
     return event_dict
 
 
+def add_worker_shard_processor(
+    _: Any, __: Any, event_dict: Dict[str, Any]
+) -> Dict[str, Any]:
+    """
+    Structlog processor for tagging log events with the worker shard when
+    running under `kodiak.entrypoints.launcher`.
+    """
+    if conf.WORKER_SHARD_COUNT > 1:
+        event_dict["worker_shard"] = conf.WORKER_SHARD_INDEX
+    return event_dict
+
+
 def configure_logging() -> None:
     # for info on logging formats see: https://docs.python.org/3/library/logging.html#logrecord-attributes
     logging.basicConfig(
@@ -148,6 +160,7 @@ def configure_logging() -> None:
             structlog.processors.format_exc_info,
             structlog.processors.UnicodeDecoder(),
             add_request_info_processor,
+            add_worker_shard_processor,
             SentryProcessor(level=logging.WARNING),
             structlog.processors.KeyValueRenderer(key_order=["event"], sort_keys=True),
         ],
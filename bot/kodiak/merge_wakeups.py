@@ -0,0 +1,87 @@
+"""
+Wake the merge loop when a webhook event arrives for the pull request being
+merged.
+
+While waiting on CI, the merge loop used to re-evaluate the pull request every
+few seconds. Instead we park it until a webhook event for the pull request is
+queued. Events may be queued by a different worker process than the one
+merging, so every queued event is announced on Redis Pubsub. We still poll
+every `MERGE_POLL_FALLBACK_SEC` in case we miss a webhook.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import contextlib
+from typing import AsyncIterator, Dict, NoReturn
+
+import structlog
+
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+QUEUE_PUBSUB_MERGE_WAKEUP = "kodiak:pubsub:merge_wakeup"
+
+
+class MergeWakeup:
+    def __init__(self) -> None:
+        self.event = asyncio.Event()
+        self.wakeups = 0
+
+    async def wait(self, timeout: float) -> bool:
+        """
+        Wait for an event for the pull request. Events that arrived since the
+        last call return immediately.
+
+        Returns False if we reached the timeout.
+        """
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return False
+        self.event.clear()
+        self.wakeups += 1
+        return True
+
+
+class MergeWakeups:
+    def __init__(self) -> None:
+        self.waiters: Dict[str, MergeWakeup] = {}
+
+    @contextlib.asynccontextmanager
+    async def watch(self, member: str) -> AsyncIterator[MergeWakeup]:
+        """
+        Record events for `member` while it's being merged.
+        """
+        wakeup = MergeWakeup()
+        self.waiters[member] = wakeup
+        try:
+            yield wakeup
+        finally:
+            if self.waiters.get(member) is wakeup:
+                del self.waiters[member]
+
+    def notify(self, member: str) -> None:
+        wakeup = self.waiters.get(member)
+        if wakeup is not None:
+            wakeup.event.set()
+
+    async def publish(self, member: str) -> None:
+        try:
+            await redis_bot.publish(QUEUE_PUBSUB_MERGE_WAKEUP, member)
+        except Exception:
+            # the fallback poll will find the update.
+            logger.exception("merge_wakeup_publish_failed", member=member)
+
+    async def listen(self) -> NoReturn:
+        pubsub = redis_bot.pubsub()
+        await pubsub.subscribe(QUEUE_PUBSUB_MERGE_WAKEUP)
+        while True:
+            reply = await pubsub.get_message(ignore_subscribe_messages=True, timeout=10)
+            if reply is None:
+                continue
+            self.notify(reply["data"].decode())
+
+
+merge_wakeups = MergeWakeups()
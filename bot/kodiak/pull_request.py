@@ -8,6 +8,7 @@ import structlog
 from typing_extensions import Protocol
 
 import kodiak.app_config as conf
+from kodiak import sha_index
 from kodiak.errors import (
     ApiCallException,
     GitHubApiInternalServerError,
@@ -16,13 +17,18 @@ from kodiak.errors import (
 )
 from kodiak.evaluation import mergeable
 from kodiak.http import HTTPStatusError as HTTPError
-from kodiak.queries import Client, EventInfoResponse
+from kodiak.queries import Client, EventInfoResponse, PullRequestState
+from kodiak.retry import Backoff, retry_policy
 
 logger = structlog.get_logger()
 
 
 RETRY_RATE_SECONDS = 2
 POLL_RATE_SECONDS = 3
+SKIPPABLE_CHECK_TIMEOUT = 4
+API_CALL_RETRIES = 5
+# waits up to 2, 4, 8 and then 16 seconds for skippable checks.
+SKIPPABLE_CHECK_BACKOFF = Backoff(base_sec=RETRY_RATE_SECONDS, max_sec=16)
 
 
 async def get_pr(
@@ -33,13 +39,31 @@ async def get_pr(
     dequeue_callback: Callable[[], Awaitable[None]],
     requeue_callback: Callable[[], Awaitable[None]],
     queue_for_merge_callback: QueueForMergeCallback,
+    target_name: Optional[str] = None,
+    event: Optional[EventInfoResponse] = None,
 ) -> Optional[PRV2]:
+    """
+    `event` may be prefetched with `Client.get_event_info_many`.
+    """
     log = logger.bind(install=install, owner=owner, repo=repo, number=number)
     async with Client(installation_id=install, owner=owner, repo=repo) as api_client:
-        event = await api_client.get_event_info(pr_number=number)
+        if event is None:
+            event = await api_client.get_event_info(
+                pr_number=number, base_ref=target_name
+            )
         if event is None:
             log.info("failed to find event")
             return None
+        if event.pull_request.state == PullRequestState.OPEN:
+            # keep the SHA index current for status events.
+            await sha_index.record_head_sha(
+                installation_id=install,
+                owner=owner,
+                repo=repo,
+                sha=event.pull_request.latest_sha,
+                pull_request_number=number,
+                target_name=event.pull_request.baseRefName,
+            )
         return PRV2(
             event,
             install=install,
@@ -66,17 +90,33 @@ async def evaluate_pr(
     number: int,
     merging: bool,
     dequeue_callback: Callable[[], Awaitable[None]],
-    requeue_callback: Callable[[], Awaitable[None]],
+    requeue_callback: RequeueCallback,
     queue_for_merge_callback: QueueForMergeCallback,
     is_active_merging: bool,
     log: structlog.BoundLogger,
-) -> None:
-    skippable_check_timeout = 4
-    api_call_retries_remaining = 5
+    target_name: Optional[str] = None,
+    poll_callback: Optional[Callable[[], Awaitable[None]]] = None,
+    event: Optional[EventInfoResponse] = None,
+) -> bool:
+    """
+    Evaluate a pull request until it's settled.
+
+    While merging, we wait on `poll_callback` between evaluations for pending
+    checks if it's provided, instead of polling every `POLL_RATE_SECONDS`.
+
+    A prefetched `event` is only used for the first evaluation.
+
+    Returns whether we merged or updated a branch.
+    """
+    skippable_check_timeout = SKIPPABLE_CHECK_TIMEOUT
+    api_call_retries_remaining = API_CALL_RETRIES
     api_call_errors = []  # type: list[APICallError]
+    timeouts = 0
+    changed_branch = False
     log = log.bind(owner=owner, repo=repo, number=number, merging=merging)
     while True:
         log.info("get_pr")
+        prefetched_event, event = event, None
         try:
             pr = await asyncio.wait_for(
                 get_pr(
@@ -87,6 +127,8 @@ async def evaluate_pr(
                     dequeue_callback=dequeue_callback,
                     requeue_callback=requeue_callback,
                     queue_for_merge_callback=queue_for_merge_callback,
+                    target_name=target_name,
+                    event=prefetched_event,
                 ),
                 timeout=60,
             )
@@ -99,7 +141,7 @@ async def evaluate_pr(
                             http_status_code=0,
                             response=b"",
                         )
-                    return
+                    return changed_branch
                 await asyncio.wait_for(
                     mergeable(
                         api=pr,
@@ -127,19 +169,27 @@ async def evaluate_pr(
                     timeout=60,
                 )
                 log.info("evaluate_pr successful")
+                retry_policy.record_success(install)
             except RetryForSkippableChecks:
                 if skippable_check_timeout > 0:
+                    delay = SKIPPABLE_CHECK_BACKOFF.delay(
+                        SKIPPABLE_CHECK_TIMEOUT - skippable_check_timeout
+                    )
                     skippable_check_timeout -= 1
-                    log.info("waiting for skippable checks to pass")
-                    await asyncio.sleep(RETRY_RATE_SECONDS)
+                    log.info("waiting for skippable checks to pass", delay=delay)
+                    await asyncio.sleep(delay)
                     continue
             except PollForever:
                 log.info("polling")
-                await asyncio.sleep(POLL_RATE_SECONDS)
+                if poll_callback is not None:
+                    await poll_callback()
+                else:
+                    await asyncio.sleep(POLL_RATE_SECONDS)
                 continue
             except ApiCallException as e:
                 # if we have some api exception, it's likely a temporary error that
                 # can be resolved by calling GitHub again.
+                retry_policy.record_failure(install)
                 if api_call_retries_remaining:
                     api_call_errors.append(
                         APICallError(
@@ -148,15 +198,46 @@ async def evaluate_pr(
                             response_body=str(e.response),
                         )
                     )
-                    api_call_retries_remaining -= 1
-                    log.info("problem contacting remote api. retrying")
+                    if retry_policy.try_acquire_retry(install):
+                        delay = retry_policy.backoff.delay(
+                            API_CALL_RETRIES - api_call_retries_remaining
+                        )
+                        api_call_retries_remaining -= 1
+                        log.info("problem contacting remote api. retrying", delay=delay)
+                        await asyncio.sleep(delay)
+                        continue
+                    log.info("problem contacting remote api. out of retries")
+                    if pr is None:
+                        return changed_branch
+                    # we're out of retries for this installation, so report the
+                    # errors with the pull request we already fetched instead
+                    # of calling GitHub again.
+                    api_call_retries_remaining = 0
+                    event = pr.event
                     continue
                 log.warning("api_call_retries_remaining", exc_info=True)
-            return
+            finally:
+                if pr is not None:
+                    changed_branch = changed_branch or pr.changed_branch
+            return changed_branch
         except asyncio.TimeoutError:
-            # On timeout we add the PR to the back of the queue to try again.
-            log.warning("mergeable_timeout", exc_info=True)
-            await requeue_callback()
+            # On timeout we add the PR to the back of the queue to try again
+            # after a backoff.
+            retry_policy.record_failure(install)
+            delay = retry_policy.backoff.delay(timeouts)
+            timeouts += 1
+            log.warning("mergeable_timeout", delay=delay, exc_info=True)
+            await requeue_callback(delay=delay)
+            if not merging:
+                # the requeued event evaluates the pull request again, so we
+                # don't block the rest of the webhook queue.
+                return changed_branch
+            # the merge queue can't move on until this pull request settles.
+            await asyncio.sleep(delay)
+
+
+class RequeueCallback(Protocol):
+    async def __call__(self, *, delay: float = 0) -> None: ...
 
 
 class QueueForMergeCallback(Protocol):
@@ -194,6 +275,9 @@ class PRV2:
         self.queue_for_merge_callback = queue_for_merge_callback
         self.log = logger.bind(install=install, owner=owner, repo=repo, number=number)
         self.client = client or Client
+        # set once we merge or update a branch, which makes the info we
+        # prefetched for other pull requests stale.
+        self.changed_branch = False
 
     async def dequeue(self) -> None:
         self.log.info("dequeue")
@@ -272,6 +356,7 @@ class PRV2:
                     http_status_code=res.status_code,
                     response=res.content,
                 ) from e
+            self.changed_branch = True
 
     async def approve_pull_request(self) -> None:
         self.log.info("approve_pull_request")
@@ -336,6 +421,7 @@ class PRV2:
                     http_status_code=res.status_code,
                     response=res.content,
                 ) from e
+            self.changed_branch = True
 
     async def update_ref(self, ref: str, sha: str) -> None:
         self.log.info("update_ref", ref=ref, sha=sha)
@@ -356,6 +442,7 @@ class PRV2:
                     http_status_code=res.status_code,
                     response=res.content,
                 ) from e
+            self.changed_branch = True
 
     async def queue_for_merge(self, *, first: bool) -> Optional[int]:
         self.log.info("queue_for_merge")
@@ -1,16 +1,24 @@
 from __future__ import annotations
 
+import asyncio
+import functools
+import json
+import time
 import urllib
-from dataclasses import dataclass, field
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
 from datetime import datetime, timedelta, timezone
 from enum import Enum
 from typing import (
     Any,
+    Awaitable,
+    Callable,
     Dict,
     List,
     Mapping,
     MutableMapping,
     Optional,
+    Tuple,
     TypedDict,
     Union,
     cast,
@@ -26,7 +34,9 @@ from typing_extensions import Literal, Protocol
 import kodiak.app_config as conf
 from kodiak import http
 from kodiak.config import V1, MergeMethod
-from kodiak.http import HttpClient
+from kodiak.config_cache import config_cache
+from kodiak.http import HttpClient, PooledTransport, PoolMetrics
+from kodiak.http_cache import response_cache
 from kodiak.queries.commits import (
     Commit,
     CommitConnection,
@@ -34,8 +44,8 @@ from kodiak.queries.commits import (
     User as PullRequestCommitUser,
     get_commits,
 )
-from kodiak.redis_client import redis_web_api
-from kodiak.throttle import get_thottler_for_installation
+from kodiak.redis_client import redis_bot, redis_web_api
+from kodiak.throttle import get_thottler_for_installation, record_rate_limit
 
 logger = structlog.get_logger()
 
@@ -73,11 +83,13 @@ query (
   repository(owner: $owner, name: $repo) {
     rootConfigFile: object(expression: $rootConfigFileExpression) {
       ... on Blob {
+        oid
         text
       }
     }
     githubConfigFile: object(expression: $githubConfigFileExpression) {
       ... on Blob {
+        oid
         text
       }
     }
@@ -85,11 +97,13 @@ query (
   orgConfigRepo: repository(owner: $owner, name: ".github") {
     rootConfigFile: object(expression: $orgRootConfigFileExpression) {
       ... on Blob {
+        oid
         text
       }
     }
     githubConfigFile: object(expression: $orgGithubConfigFileExpression) {
       ... on Blob {
+        oid
         text
       }
     }
@@ -99,6 +113,7 @@ query (
 
 
 class ConfigQueryText(pydantic.BaseModel):
+    oid: Optional[str]
     text: Optional[str]
 
 
@@ -119,6 +134,7 @@ class ConfigQueryResponse(pydantic.BaseModel):
 class ParsedConfig:
     text: str
     kind: Literal["repo_root", "repo_github", "org_root", "org_github"]
+    oid: Optional[str] = None
 
 
 def parse_config(data: dict[Any, Any]) -> ParsedConfig | None:
@@ -134,14 +150,18 @@ def parse_config(data: dict[Any, Any]) -> ParsedConfig | None:
             and res.repository.rootConfigFile.text is not None
         ):
             return ParsedConfig(
-                text=res.repository.rootConfigFile.text, kind="repo_root"
+                text=res.repository.rootConfigFile.text,
+                kind="repo_root",
+                oid=res.repository.rootConfigFile.oid,
             )
         if (
             res.repository.githubConfigFile
             and res.repository.githubConfigFile.text is not None
         ):
             return ParsedConfig(
-                text=res.repository.githubConfigFile.text, kind="repo_github"
+                text=res.repository.githubConfigFile.text,
+                kind="repo_github",
+                oid=res.repository.githubConfigFile.oid,
             )
         raise Exception("unexpected missing config file")
     if res.orgConfigRepo:
@@ -150,31 +170,223 @@ def parse_config(data: dict[Any, Any]) -> ParsedConfig | None:
             and res.orgConfigRepo.rootConfigFile.text is not None
         ):
             return ParsedConfig(
-                text=res.orgConfigRepo.rootConfigFile.text, kind="org_root"
+                text=res.orgConfigRepo.rootConfigFile.text,
+                kind="org_root",
+                oid=res.orgConfigRepo.rootConfigFile.oid,
             )
         if (
             res.orgConfigRepo.githubConfigFile
             and res.orgConfigRepo.githubConfigFile.text is not None
         ):
             return ParsedConfig(
-                text=res.orgConfigRepo.githubConfigFile.text, kind="org_github"
+                text=res.orgConfigRepo.githubConfigFile.text,
+                kind="org_github",
+                oid=res.orgConfigRepo.githubConfigFile.oid,
             )
         raise Exception("unexpected missing config file")
     return None
 
 
+EVENT_INFO_CONFIG_VARIABLES = """,
+  $rootConfigFileExpression: String!,
+  $githubConfigFileExpression: String!
+"""
+
+# we only fetch the blob oids because the config is usually in our cache.
+EVENT_INFO_CONFIG_QUERY = """
+    rootConfigFile: object(expression: $rootConfigFileExpression) {
+      ... on Blob {
+        oid
+      }
+    }
+    githubConfigFile: object(expression: $githubConfigFileExpression) {
+      ... on Blob {
+        oid
+      }
+    }
+"""
+
+
+# the optional edges of the event info query. See `QueryProfile`.
+EVENT_INFO_REVIEWS_QUERY = """
+      reviews(first: 100) {
+        nodes {
+          createdAt
+          state
+          author {
+            login
+            type: __typename
+          }
+          authorAssociation
+        }
+        totalCount
+      }
+""".strip()
+
+EVENT_INFO_RULES_QUERY = """
+        rules(first: 100) {
+          totalCount
+          nodes {
+            type
+            parameters {
+              ... on RequiredStatusChecksParameters {
+                requiredStatusChecks {
+                  context
+                }
+                strictRequiredStatusChecksPolicy
+              }
+              ... on PullRequestParameters {
+                requiredReviewThreadResolution
+              }
+            }
+            repositoryRuleset {
+              bypassActors(first: 100) {
+                nodes {
+                  actor {
+                    __typename
+                    ... on App {
+                      databaseId
+                    }
+                  }
+                }
+              }
+            }
+          }
+        }
+""".strip()
+
+# we still need to know if the base branch has ruleset rules.
+EVENT_INFO_RULES_COUNT_QUERY = """
+        rules(first: 1) {
+          totalCount
+        }
+""".strip()
+
+EVENT_INFO_COMMIT_HISTORY_QUERY = """
+      commitHistory: commits(last: 100) {
+        nodes {
+          commit {
+            author {
+              user {
+                databaseId
+                name
+                login
+                type: __typename
+              }
+            }
+            parents {
+              totalCount
+            }
+          }
+        }
+      }
+""".strip()
+
+
+@dataclass(frozen=True)
+class QueryProfile:
+    """
+    The optional edges of the event info query.
+
+    Most evaluations don't read every edge, so we only request the edges the
+    repository's config and branch rules need.
+    """
+
+    # commit authors for `merge.message.include_coauthors`.
+    commit_authors: bool = True
+    # our reviews for `approve.auto_approve_usernames` and
+    # `approve.auto_approve_labels`.
+    reviews: bool = True
+    # ruleset rules of the base branch. We always fetch their count.
+    ruleset_rules: bool = True
+
+    def covers(self, other: QueryProfile) -> bool:
+        return (
+            (self.commit_authors or not other.commit_authors)
+            and (self.reviews or not other.reviews)
+            and (self.ruleset_rules or not other.ruleset_rules)
+        )
+
+
+FULL_QUERY_PROFILE = QueryProfile()
+
+
+def get_required_query_profile(
+    config: Union[V1, pydantic.ValidationError, toml.TomlDecodeError],
+    *,
+    has_ruleset_rules: bool,
+) -> QueryProfile:
+    if not isinstance(config, V1):
+        # we stop evaluating on an invalid config.
+        return QueryProfile(commit_authors=False, reviews=False, ruleset_rules=False)
+    return QueryProfile(
+        commit_authors=config.merge.message.include_coauthors,
+        reviews=bool(
+            config.approve.auto_approve_usernames or config.approve.auto_approve_labels
+        ),
+        ruleset_rules=has_ruleset_rules,
+    )
+
+
+# GitHub limits a GraphQL query to 500,000 nodes. The event info query can
+# return ~21,000 nodes per pull request, most of them from the 100x100 check
+# runs and ruleset bypass actors.
+GRAPHQL_NODE_LIMIT = 500_000
+EVENT_INFO_NODES_PER_PULL_REQUEST = 21_000
+EVENT_INFO_BATCH_SIZE = GRAPHQL_NODE_LIMIT // EVENT_INFO_NODES_PER_PULL_REQUEST
+
+
 def get_event_info_query(
-    requires_conversation_resolution: bool, fetch_body_html: bool
+    requires_conversation_resolution: bool,
+    fetch_body_html: bool,
+    fetch_config: bool = False,
+    pull_request_aliases: Optional[List[str]] = None,
+    profile: QueryProfile = FULL_QUERY_PROFILE,
 ) -> str:
+    """
+    With `fetch_config`, we also fetch the repository's config files so we
+    don't need a second request for the config in the common case.
+
+    `profile` selects the optional edges of the pull request to fetch.
+
+    With `pull_request_aliases`, we fetch a pull request for each alias, with
+    its number in the variable of the same name, instead of `$PRNumber`.
+    """
+    if pull_request_aliases is None:
+        pull_request_variables = ", $PRNumber: Int!"
+        pull_request_query = """
+    pullRequest(number: $PRNumber) {
+      ...EventInfoPullRequest
+    }"""
+    else:
+        pull_request_variables = "".join(
+            f", ${alias}: Int!" for alias in pull_request_aliases
+        )
+        pull_request_query = "".join(
+            f"""
+    {alias}: pullRequest(number: ${alias}) {{
+      ...EventInfoPullRequest
+    }}"""
+            for alias in pull_request_aliases
+        )
     return """
-query GetEventInfo($owner: String!, $repo: String!, $PRNumber: Int!) {
+query GetEventInfo($owner: String!, $repo: String!%(pullRequestVariables)s%(configVariables)s) {
   repository(owner: $owner, name: $repo) {
+    %(configQuery)s
     mergeCommitAllowed
     rebaseMergeAllowed
     squashMergeAllowed
     deleteBranchOnMerge
-    isPrivate
-    pullRequest(number: $PRNumber) {
+    isPrivate%(pullRequestQuery)s
+  }
+  orgConfigRepo: repository(owner: $owner, name: ".github") {
+    defaultBranchRef {
+      name
+    }
+  }
+}
+
+fragment EventInfoPullRequest on PullRequest {
       id
       author {
         login
@@ -217,18 +429,7 @@ query GetEventInfo($owner: String!, $repo: String!, $PRNumber: Int!) {
       bodyText
       %(bodyHTMLQuery)s
       url
-      reviews(first: 100) {
-        nodes {
-          createdAt
-          state
-          author {
-            login
-            type: __typename
-          }
-          authorAssociation
-        }
-        totalCount
-      }
+      %(reviewsQuery)s
       baseRefName
       headRefName
       headRef {
@@ -253,52 +454,9 @@ query GetEventInfo($owner: String!, $repo: String!, $PRNumber: Int!) {
             }
           }
         }
-        rules(first: 100) {
-          nodes {
-            type
-            parameters {
-              ... on RequiredStatusChecksParameters {
-                requiredStatusChecks {
-                  context
-                }
-                strictRequiredStatusChecksPolicy
-              }
-              ... on PullRequestParameters {
-                requiredReviewThreadResolution
-              }
-            }
-            repositoryRuleset {
-              bypassActors(first: 100) {
-                nodes {
-                  actor {
-                    __typename
-                    ... on App {
-                      databaseId
-                    }
-                  }
-                }
-              }
-            }
-          }
-        }
-      }
-      commitHistory: commits(last: 100) {
-        nodes {
-          commit {
-            author {
-              user {
-                databaseId
-                name
-                login
-                type: __typename
-              }
-            }
-            parents {
-              totalCount
-            }
-          }
-        }
+        %(rulesQuery)s
       }
+      %(commitHistoryQuery)s
       commits(last: 1) {
         nodes {
           commit {
@@ -332,20 +490,24 @@ query GetEventInfo($owner: String!, $repo: String!, $PRNumber: Int!) {
         }
         totalCount
       }
-    }
-  }
-  orgConfigRepo: repository(owner: $owner, name: ".github") {
-    defaultBranchRef {
-      name
-    }
-  }
 }
 
 """ % dict(  # noqa: UP031
+        pullRequestVariables=pull_request_variables,
+        pullRequestQuery=pull_request_query,
         requiresConversationResolution="requiresConversationResolution"
         if requires_conversation_resolution
         else "",
         bodyHTMLQuery="bodyHTML" if fetch_body_html else "bodyHTML: body",
+        configVariables=EVENT_INFO_CONFIG_VARIABLES if fetch_config else "",
+        configQuery=EVENT_INFO_CONFIG_QUERY if fetch_config else "",
+        reviewsQuery=EVENT_INFO_REVIEWS_QUERY if profile.reviews else "",
+        rulesQuery=EVENT_INFO_RULES_QUERY
+        if profile.ruleset_rules
+        else EVENT_INFO_RULES_COUNT_QUERY,
+        commitHistoryQuery=EVENT_INFO_COMMIT_HISTORY_QUERY
+        if profile.commit_authors
+        else "",
     )
 
 
@@ -471,6 +633,10 @@ class EventInfoResponse:
     check_runs: List[CheckRun] = field(default_factory=list)
     valid_merge_methods: List[MergeMethod] = field(default_factory=list)
     commits: List[Commit] = field(default_factory=list)
+    # the query profile this pull request needs, from its config and rules.
+    required_query_profile: QueryProfile = field(
+        default=FULL_QUERY_PROFILE, compare=False
+    )
 
 
 MERGE_PR_MUTATION = """
@@ -677,9 +843,140 @@ class TokenResponse(BaseModel):
     def expired(self) -> bool:
         return self.expires_at - timedelta(minutes=5) < datetime.now(timezone.utc)
 
+    @property
+    def needs_refresh(self) -> bool:
+        """
+        Installation tokens last an hour, so we refresh them in the background
+        well before they expire.
+        """
+        return self.expires_at - timedelta(minutes=15) < datetime.now(timezone.utc)
+
 
 installation_cache: MutableMapping[str, Optional[TokenResponse]] = dict()
 
+github_transport: Optional[PooledTransport] = None
+github_session: Optional[HttpClient] = None
+
+
+def get_github_session() -> HttpClient:
+    """
+    Get the process-wide GitHub API session.
+
+    Sharing one connection pool between Clients lets us reuse TLS connections
+    across the many API calls made while evaluating a pull request.
+    """
+    global github_session, github_transport
+    if github_session is not None:
+        return github_session
+    github_transport = PooledTransport(
+        limits=http.Limits(
+            max_connections=conf.GITHUB_HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=conf.GITHUB_HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=conf.GITHUB_HTTP_KEEPALIVE_EXPIRY_SEC,
+        )
+    )
+    github_session = HttpClient(
+        # infinite timeout to match behavior of old, requests_async http
+        # client. As a backup we have an asyncio timeout of 30 seconds.
+        timeout=None,
+        transport=github_transport,
+        # adapt our request rate to the rate limit headers of each response.
+        event_hooks={"response": [record_rate_limit]},
+    )
+    github_session.headers["Accept"] = (
+        "application/vnd.github.antiope-preview+json,application/vnd.github.merge-info-preview+json"
+    )
+    if (
+        conf.GITHUB_API_HEADER_NAME is not None
+        and conf.GITHUB_API_HEADER_VALUE is not None
+    ):
+        github_session.headers[conf.GITHUB_API_HEADER_NAME] = (
+            conf.GITHUB_API_HEADER_VALUE
+        )
+    return github_session
+
+
+async def get_github_pool_metrics() -> Optional[PoolMetrics]:
+    if github_transport is None:
+        return None
+    return await github_transport.get_metrics()
+
+
+async def close_github_session() -> None:
+    global github_session, github_transport
+    if github_session is not None:
+        await github_session.aclose()
+    github_session = None
+    github_transport = None
+
+
+# GitHub caps the pages for list endpoints, but we also want to bound our
+# requests for repositories with many open pull requests.
+OPEN_PULL_REQUESTS_PAGE_LIMIT = 20
+
+
+@dataclass
+class OpenPullRequestsCacheEntry:
+    expires_at: float
+    pull_requests: List[GetOpenPullRequestsResponseSchema]
+
+
+# (installation id, owner, repo) -> (base, head) -> listing, for the
+# `OPEN_PULL_REQUESTS_CACHE_SIZE` most recently used repositories.
+open_pull_requests_cache: OrderedDict[
+    Tuple[str, str, str],
+    Dict[Tuple[Optional[str], Optional[str]], OpenPullRequestsCacheEntry],
+] = OrderedDict()
+
+
+# (installation id, owner, repo, base ref) -> the query profile needed by the
+# last pull request we fetched for the base ref, for the
+# `QUERY_PROFILE_CACHE_SIZE` most recently used base refs.
+query_profiles: OrderedDict[Tuple[str, str, str, str], QueryProfile] = OrderedDict()
+
+
+def invalidate_open_pull_requests(
+    *, installation_id: str, owner: str, repo: str
+) -> None:
+    """
+    Drop the cached open pull request listings for a repository.
+    """
+    open_pull_requests_cache.pop((installation_id, owner, repo), None)
+
+
+def cache_open_pull_requests(
+    repo_key: Tuple[str, str, str],
+    listing_key: Tuple[Optional[str], Optional[str]],
+    entry: OpenPullRequestsCacheEntry,
+) -> None:
+    now = time.monotonic()
+    # drop expired listings, e.g. for the head branches of merged pull
+    # requests, so a repository's listings don't grow without bound.
+    repo_cache = {
+        key: cached
+        for key, cached in open_pull_requests_cache.pop(repo_key, {}).items()
+        if cached.expires_at > now
+    }
+    repo_cache[listing_key] = entry
+    open_pull_requests_cache[repo_key] = repo_cache
+    while len(open_pull_requests_cache) > conf.OPEN_PULL_REQUESTS_CACHE_SIZE:
+        open_pull_requests_cache.popitem(last=False)
+
+
+def get_page_number(url: Optional[str]) -> Optional[int]:
+    """
+    Extract the page number from a pagination link.
+
+    https://api.github.com/repositories/1234/pulls?state=open&page=3 -> 3
+    """
+    if url is None:
+        return None
+    pages = urllib.parse.parse_qs(urllib.parse.urlparse(url).query).get("page")
+    if not pages or not pages[0].isdigit():
+        return None
+    return int(pages[0])
+
+
 # TODO(sbdchd): pass logging via TLS or async equivalent
 
 
@@ -727,6 +1024,14 @@ def get_branch_protection(
         return None
 
 
+def get_has_ruleset_rules(*, pull_request: Dict[str, Any]) -> bool:
+    try:
+        return bool(pull_request["baseRef"]["rules"]["totalCount"])
+    except (KeyError, TypeError):
+        # assume there are rules so we fetch them.
+        return True
+
+
 def get_rules_dicts(*, pull_request: Dict[str, Any]) -> List[Dict[str, Any]]:
     try:
         return cast(List[Dict[str, Any]], pull_request["baseRef"]["rules"]["nodes"])
@@ -869,13 +1174,27 @@ def create_github_config_file_expression(branch: str) -> str:
     return f"{branch}:.github/{CONFIG_FILE_NAME}"
 
 
+def get_config_expression_variables(base_ref: str) -> Dict[str, str]:
+    return dict(
+        rootConfigFileExpression=create_root_config_file_expression(branch=base_ref),
+        githubConfigFileExpression=create_github_config_file_expression(
+            branch=base_ref
+        ),
+    )
+
+
 class Ref(pydantic.BaseModel):
     ref: str
 
 
+class HeadRef(pydantic.BaseModel):
+    sha: str
+
+
 class GetOpenPullRequestsResponseSchema(pydantic.BaseModel):
     number: int
     base: Ref
+    head: Optional[HeadRef] = None
 
 
 class SubscriptionExpired(pydantic.BaseModel):
@@ -909,6 +1228,14 @@ class CfgInfo:
     file_expression: str
 
 
+def get_cfg_info(event_info: EventInfoResponse) -> CfgInfo:
+    return CfgInfo(
+        parsed=event_info.config,
+        text=event_info.config_str,
+        file_expression=event_info.config_file_expression,
+    )
+
+
 @dataclass
 class ApiFeatures:
     requires_conversation_resolution: bool
@@ -916,16 +1243,107 @@ class ApiFeatures:
 
 def has_body_html_error(errors: list[GraphQLError]) -> bool:
     for error in errors:
+        # the path is ["repository", <pull request alias>, "headRef"] for
+        # batched queries.
+        path = error.get("path") or []
         if (
             error.get("type") == "FORBIDDEN"
             and error.get("message") == "Resource not accessible by integration"
-            and error.get("path") == ["repository", "pullRequest", "headRef"]
+            and len(path) == 3
+            and path[0] == "repository"
+            and path[2] == "headRef"
         ):
             return True
     return False
 
 
-_api_features_cache: ApiFeatures | None = None
+def get_api_host() -> str:
+    return urllib.parse.urlparse(conf.GITHUB_V4_API_URL).netloc
+
+
+def get_api_features_key(host: str) -> str:
+    return f"kodiak:api_features:{host}"
+
+
+@dataclass
+class ApiFeaturesCacheEntry:
+    expires_at: float
+    features: Optional[ApiFeatures]
+
+
+class ApiFeaturesRegistry:
+    """
+    Cache the GraphQL schema features of each GitHub API host.
+
+    Features are shared between processes through Redis with a TTL, so
+    restarted workers don't repeat the introspection query. Concurrent misses
+    for a host share one query, and failures are cached briefly so we don't
+    retry them on every event.
+    """
+
+    def __init__(self) -> None:
+        self.entries: Dict[str, ApiFeaturesCacheEntry] = {}
+        self.pending: Dict[str, asyncio.Task[Optional[ApiFeatures]]] = {}
+
+    async def warm(self) -> None:
+        """
+        Load the features for our API host from Redis.
+        """
+        await self.load(get_api_host())
+
+    async def load(self, host: str) -> Optional[ApiFeatures]:
+        cached = await redis_bot.get(get_api_features_key(host))
+        if cached is None:
+            return None
+        features = ApiFeatures(**json.loads(cached))
+        ttl_sec: float = await redis_bot.ttl(get_api_features_key(host))
+        if ttl_sec <= 0:
+            ttl_sec = conf.API_FEATURES_CACHE_TTL_SEC
+        self.entries[host] = ApiFeaturesCacheEntry(
+            expires_at=time.monotonic() + ttl_sec, features=features
+        )
+        return features
+
+    async def get(
+        self, fetch: Callable[[], Awaitable[Optional[ApiFeatures]]]
+    ) -> Optional[ApiFeatures]:
+        host = get_api_host()
+        entry = self.entries.get(host)
+        if entry is not None and entry.expires_at > time.monotonic():
+            return entry.features
+        task = self.pending.get(host)
+        if task is None:
+            task = asyncio.create_task(self.refresh(host, fetch))
+            self.pending[host] = task
+            task.add_done_callback(lambda _task: self.pending.pop(host, None))
+        return await asyncio.shield(task)
+
+    async def refresh(
+        self, host: str, fetch: Callable[[], Awaitable[Optional[ApiFeatures]]]
+    ) -> Optional[ApiFeatures]:
+        features = await self.load(host)
+        if features is not None:
+            return features
+        features = await fetch()
+        if features is None:
+            self.entries[host] = ApiFeaturesCacheEntry(
+                expires_at=time.monotonic() + conf.API_FEATURES_ERROR_TTL_SEC,
+                features=None,
+            )
+            return None
+        self.entries[host] = ApiFeaturesCacheEntry(
+            expires_at=time.monotonic() + conf.API_FEATURES_CACHE_TTL_SEC,
+            features=features,
+        )
+        await redis_bot.set(
+            get_api_features_key(host),
+            json.dumps(asdict(features)),
+            ex=int(conf.API_FEATURES_CACHE_TTL_SEC),
+        )
+        return features
+
+
+api_features_registry = ApiFeaturesRegistry()
 
 
 class ThrottlerProtocol(Protocol):
@@ -938,28 +1356,15 @@ class ThrottlerProtocol(Protocol):
 
 class Client:
     throttler: ThrottlerProtocol
+    graphql_throttler: ThrottlerProtocol
 
     def __init__(self, *, owner: str, repo: str, installation_id: str):
         self.owner = owner
         self.repo = repo
         self.installation_id = installation_id
-        # NOTE: We must call `await session.close()` when we are finished with our session.
-        # We implement an async context manager this handle this.
-        self.session = HttpClient(
-            # infinite timeout to match behavior of old, requests_async http
-            # client. As a backup we have an asyncio timeout of 30 seconds.
-            timeout=None
-        )
-        self.session.headers["Accept"] = (
-            "application/vnd.github.antiope-preview+json,application/vnd.github.merge-info-preview+json"
-        )
-        if (
-            conf.GITHUB_API_HEADER_NAME is not None
-            and conf.GITHUB_API_HEADER_VALUE is not None
-        ):
-            self.session.headers[conf.GITHUB_API_HEADER_NAME] = (
-                conf.GITHUB_API_HEADER_VALUE
-            )
+        # NOTE: the session is shared by every Client, so we must not modify
+        # it. Pass per-installation headers with each request instead.
+        self.session = get_github_session()
         self.log = logger.bind(
             owner=self.owner, repo=self.repo, install=self.installation_id
         )
@@ -968,12 +1373,16 @@ class Client:
         self.throttler = get_thottler_for_installation(
             installation_id=self.installation_id
         )
+        # GitHub tracks the GraphQL budget separately from the REST budget.
+        self.graphql_throttler = get_thottler_for_installation(
+            installation_id=self.installation_id, resource="graphql"
+        )
         return self
 
     async def __aexit__(
         self, exc_type: object, exc_value: object, traceback: object
     ) -> None:
-        await self.session.aclose()
+        pass
 
     async def send_query(
         self,
@@ -986,10 +1395,11 @@ class Client:
         token = await get_token_for_install(
             session=self.session, installation_id=installation_id
         )
-        self.session.headers["Authorization"] = f"Bearer {token}"
-        async with self.throttler:
+        async with self.graphql_throttler:
             res = await self.session.post(
-                conf.GITHUB_V4_API_URL, json=(dict(query=query, variables=variables))
+                conf.GITHUB_V4_API_URL,
+                json=(dict(query=query, variables=variables)),
+                headers=dict(Authorization=f"Bearer {token}"),
             )
         rate_limit_remaining = res.headers.get("x-ratelimit-remaining")
         rate_limit_max = res.headers.get("x-ratelimit-limit")
@@ -1013,9 +1423,9 @@ class Client:
         first client to make an API request, we use their credentials to view
         schema metadata and cache the results.
         """
-        global _api_features_cache
-        if _api_features_cache is not None:
-            return _api_features_cache
+        return await api_features_registry.get(self.fetch_api_features)
+
+    async def fetch_api_features(self) -> ApiFeatures | None:
         res = await self.send_query(
             query="""
 query {
@@ -1043,12 +1453,11 @@ query {
         except (TypeError, KeyError):
             self.log.warning("problem parsing api features", exc_info=True)
             return None
-        _api_features_cache = ApiFeatures(
+        return ApiFeatures(
             requires_conversation_resolution=any(
                 field["name"] == "requiresConversationResolution" for field in fields
             )
         )
-        return _api_features_cache
 
     def get_bot_reviews(self, *, reviews: List[PRReviewSchema]) -> List[PRReview]:
         bot_reviews: List[PRReview] = []
@@ -1124,20 +1533,51 @@ query {
                 return org_github_config_file_expression
             raise Exception(f"unknown config kind {parsed_config.kind!r}")
 
+        cached = await config_cache.put(parsed_config.oid, parsed_config.text)
         return CfgInfo(
-            parsed=V1.parse_toml(parsed_config.text),
-            text=parsed_config.text,
+            parsed=cached.parsed,
+            text=cached.text,
             file_expression=get_file_expression(),
         )
 
-    async def get_event_info(self, pr_number: int) -> Optional[EventInfoResponse]:
+    async def get_config_from_event_info(
+        self, *, ref: str, repository: Dict[str, Any]
+    ) -> CfgInfo | None:
         """
-        Retrieve all the information we need to evaluate a pull request
+        Find the repository config from the blob oids fetched with the event
+        info query.
 
-        This is basically the "do-all-the-things" query
+        Returns None if we haven't cached the config, or the repository
+        doesn't have a config file, in which case we need to download it with
+        `get_config_for_ref`.
         """
+        for field_name, file_expression in (
+            ("rootConfigFile", create_root_config_file_expression(branch=ref)),
+            ("githubConfigFile", create_github_config_file_expression(branch=ref)),
+        ):
+            blob = repository.get(field_name)
+            if not blob:
+                continue
+            oid = blob.get("oid")
+            if oid is None:
+                return None
+            cached = await config_cache.get(oid)
+            if cached is None:
+                return None
+            return CfgInfo(
+                parsed=cached.parsed, text=cached.text, file_expression=file_expression
+            )
+        return None
 
-        log = self.log.bind(pr=pr_number)
+    async def send_event_info_query(
+        self,
+        *,
+        variables: Mapping[str, Union[str, int, None]],
+        fetch_config: bool,
+        pull_request_aliases: Optional[List[str]] = None,
+        profile: QueryProfile = FULL_QUERY_PROFILE,
+    ) -> Optional[Dict[Any, Any]]:
+        log = self.log.bind(query_profile=profile)
 
         api_features = await self.get_api_features()
 
@@ -1147,8 +1587,11 @@ query {
                 if api_features
                 else True,
                 fetch_body_html=True,
+                fetch_config=fetch_config,
+                pull_request_aliases=pull_request_aliases,
+                profile=profile,
             ),
-            variables=dict(owner=self.owner, repo=self.repo, PRNumber=pr_number),
+            variables=variables,
             installation_id=self.installation_id,
         )
         if res is None:
@@ -1174,8 +1617,11 @@ query {
                     if api_features
                     else True,
                     fetch_body_html=False,
+                    fetch_config=fetch_config,
+                    pull_request_aliases=pull_request_aliases,
+                    profile=profile,
                 ),
-                variables=dict(owner=self.owner, repo=self.repo, PRNumber=pr_number),
+                variables=variables,
                 installation_id=self.installation_id,
             )
             if res is None:
@@ -1185,23 +1631,208 @@ query {
             if data is None:
                 log.error("could not fetch event info", res=res)
                 return None
+        return data
+
+    async def get_event_info(
+        self, pr_number: int, base_ref: str | None = None
+    ) -> Optional[EventInfoResponse]:
+        """
+        Retrieve all the information we need to evaluate a pull request
+
+        This is basically the "do-all-the-things" query
+
+        If we know the pull request's base ref (from the webhook event), we
+        fetch the config with the same query, and only the optional edges
+        that the last pull request for the base ref needed.
+        """
+        profile = self.get_query_profile(base_ref)
+        event_info = await self.fetch_event_info(
+            pr_number=pr_number, base_ref=base_ref, profile=profile
+        )
+        if event_info is not None and not profile.covers(
+            event_info.required_query_profile
+        ):
+            # the config or branch rules changed since we chose the profile.
+            self.log.info(
+                "query_profile_refetch",
+                pr=pr_number,
+                profile=profile,
+                required_profile=event_info.required_query_profile,
+            )
+            event_info = await self.fetch_event_info(
+                pr_number=pr_number,
+                base_ref=base_ref,
+                profile=event_info.required_query_profile,
+                config=get_cfg_info(event_info),
+            )
+        if event_info is not None:
+            self.set_query_profile(event_info)
+        return event_info
+
+    def get_query_profile(self, base_ref: str | None) -> QueryProfile:
+        if base_ref is None:
+            return FULL_QUERY_PROFILE
+        key = (self.installation_id, self.owner, self.repo, base_ref)
+        profile = query_profiles.get(key)
+        if profile is None:
+            return FULL_QUERY_PROFILE
+        query_profiles.move_to_end(key)
+        return profile
+
+    def set_query_profile(self, event_info: EventInfoResponse) -> None:
+        key = (
+            self.installation_id,
+            self.owner,
+            self.repo,
+            event_info.pull_request.baseRefName,
+        )
+        query_profiles[key] = event_info.required_query_profile
+        query_profiles.move_to_end(key)
+        while len(query_profiles) > conf.QUERY_PROFILE_CACHE_SIZE:
+            query_profiles.popitem(last=False)
+
+    async def fetch_event_info(
+        self,
+        *,
+        pr_number: int,
+        base_ref: str | None,
+        profile: QueryProfile,
+        config: CfgInfo | None = None,
+    ) -> Optional[EventInfoResponse]:
+        """
+        `config` is the config we already fetched for the pull request, if
+        we're fetching it again for more edges.
+        """
+        log = self.log.bind(pr=pr_number)
+
+        variables: Dict[str, Union[str, int, None]] = dict(
+            owner=self.owner, repo=self.repo, PRNumber=pr_number
+        )
+        if base_ref is not None:
+            variables.update(get_config_expression_variables(base_ref))
+
+        data = await self.send_event_info_query(
+            variables=variables, fetch_config=base_ref is not None, profile=profile
+        )
+        if data is None:
+            return None
 
         repository = get_repo(data=data)
         if not repository:
             log.warning("could not find repository")
             return None
 
-        org_repo_default_branch = get_org_config_default_branch(data=data)
+        subscription = (
+            await self.get_subscription() if conf.SUBSCRIPTIONS_ENABLED else None
+        )
+
+        return await self.parse_event_info(
+            data=data,
+            repository=repository,
+            pull_request=get_pull_request(repo=repository),
+            pr_number=pr_number,
+            base_ref=base_ref,
+            subscription=subscription,
+            profile=profile,
+            config=config,
+        )
+
+    async def get_event_info_many(
+        self, pr_numbers: List[int], base_ref: str | None = None
+    ) -> Dict[int, EventInfoResponse]:
+        """
+        Retrieve the event info for many pull requests of the repository,
+        fetching up to `EVENT_INFO_BATCH_SIZE` pull requests per query with
+        field aliases.
+
+        Pull requests we failed to fetch are missing from the result.
+        """
+        results: Dict[int, EventInfoResponse] = {}
+        for start in range(0, len(pr_numbers), EVENT_INFO_BATCH_SIZE):
+            batch = pr_numbers[start : start + EVENT_INFO_BATCH_SIZE]
+            results.update(
+                await self.get_event_info_batch(pr_numbers=batch, base_ref=base_ref)
+            )
+        return results
+
+    async def get_event_info_batch(
+        self, *, pr_numbers: List[int], base_ref: str | None
+    ) -> Dict[int, EventInfoResponse]:
+        log = self.log.bind(prs=pr_numbers)
+        aliases = {f"pr{index}": number for index, number in enumerate(pr_numbers)}
+        profile = self.get_query_profile(base_ref)
+
+        variables: Dict[str, Union[str, int, None]] = dict(
+            owner=self.owner, repo=self.repo, **aliases
+        )
+        if base_ref is not None:
+            variables.update(get_config_expression_variables(base_ref))
+
+        data = await self.send_event_info_query(
+            variables=variables,
+            fetch_config=base_ref is not None,
+            pull_request_aliases=list(aliases),
+            profile=profile,
+        )
+        if data is None:
+            return {}
+
+        repository = get_repo(data=data)
+        if not repository:
+            log.warning("could not find repository")
+            return {}
 
         subscription = (
             await self.get_subscription() if conf.SUBSCRIPTIONS_ENABLED else None
         )
 
-        pull_request = get_pull_request(repo=repository)
+        results: Dict[int, EventInfoResponse] = {}
+        for alias, pr_number in aliases.items():
+            event_info = await self.parse_event_info(
+                data=data,
+                repository=repository,
+                pull_request=cast(Optional[Dict[str, Any]], repository.get(alias)),
+                pr_number=pr_number,
+                base_ref=base_ref,
+                subscription=subscription,
+                profile=profile,
+            )
+            if event_info is None:
+                continue
+            if not profile.covers(event_info.required_query_profile):
+                # fetch the edges we skipped for this pull request.
+                event_info = await self.fetch_event_info(
+                    pr_number=pr_number,
+                    base_ref=base_ref,
+                    profile=event_info.required_query_profile,
+                    config=get_cfg_info(event_info),
+                )
+                if event_info is None:
+                    continue
+            self.set_query_profile(event_info)
+            results[pr_number] = event_info
+        log.info("get_event_info_batch", fetched=len(results))
+        return results
+
+    async def parse_event_info(
+        self,
+        *,
+        data: Dict[Any, Any],
+        repository: Dict[str, Any],
+        pull_request: Optional[Dict[str, Any]],
+        pr_number: int,
+        base_ref: str | None,
+        subscription: Optional[Subscription],
+        profile: QueryProfile,
+        config: CfgInfo | None = None,
+    ) -> Optional[EventInfoResponse]:
+        log = self.log.bind(pr=pr_number)
+
+        org_repo_default_branch = get_org_config_default_branch(data=data)
+
         if not pull_request:
             log.warning("Could not find PR")
             return None
-
         latest_sha = get_sha(pr=pull_request)
         if latest_sha is None:
             # PR didn't have a diff associated with it!
@@ -1218,9 +1849,23 @@ query {
             log.warning("Could not parse pull request")
             return None
 
-        cfg = await self.get_config_for_ref(
-            ref=pr.baseRefName, org_repo_default_branch=org_repo_default_branch
-        )
+        cfg = config
+        if cfg is None and base_ref is not None and base_ref == pr.baseRefName:
+            cfg = await self.get_config_from_event_info(
+                ref=base_ref, repository=repository
+            )
+        if cfg is None:
+            # the pull request was retargeted since the webhook event, the
+            # config changed, or the config is in the organization's `.github`
+            # repository.
+            log.info(
+                "get_config_for_ref",
+                base_ref=base_ref,
+                base_ref_name=pr.baseRefName,
+            )
+            cfg = await self.get_config_for_ref(
+                ref=pr.baseRefName, org_repo_default_branch=org_repo_default_branch
+            )
         if cfg is None:
             log.info("no config found")
             return None
@@ -1248,10 +1893,14 @@ query {
             review_requests=get_requested_reviews(pr=pull_request),
             bot_reviews=bot_reviews,
             status_contexts=get_status_contexts(pr=pull_request),
-            commits=get_commits(pr=pull_request),
+            commits=get_commits(pr=pull_request) if profile.commit_authors else [],
             check_runs=get_check_runs(pr=pull_request),
             head_exists=get_head_exists(pr=pull_request),
             valid_merge_methods=get_valid_merge_methods(repo=repository),
+            required_query_profile=get_required_query_profile(
+                cfg.parsed,
+                has_ruleset_rules=get_has_ruleset_rules(pull_request=pull_request),
+            ),
         )
 
     async def get_open_pull_requests(
@@ -1261,6 +1910,14 @@ query {
         https://developer.github.com/v3/pulls/#list-pull-requests
         """
         log = self.log.bind(base=base, head=head)
+        repo_key = (self.installation_id, self.owner, self.repo)
+        repo_cache = open_pull_requests_cache.get(repo_key, {})
+        cached = repo_cache.get((base, head))
+        if cached is not None and cached.expires_at > time.monotonic():
+            open_pull_requests_cache.move_to_end(repo_key)
+            log.info("open_pull_requests_cache_hit")
+            return list(cached.pull_requests)
+
         headers = await get_headers(
             session=self.session, installation_id=self.installation_id
         )
@@ -1270,33 +1927,50 @@ query {
         if head is not None:
             params["head"] = head
 
-        open_prs = []
-
-        page = None
-        current_page = 0
-        while page != []:
-            current_page += 1
-            if current_page > 20:
-                log.info("hit pagination limit")
-                break
-
-            params["page"] = str(current_page)
+        async def get_page(page: int) -> http.Response:
             async with self.throttler:
-                res = await self.session.get(
+                return await response_cache.get(
+                    self.session,
                     conf.v3_url(f"/repos/{self.owner}/{self.repo}/pulls"),
-                    params=params,
+                    scope=self.installation_id,
+                    params={**params, "page": str(page)},
                     headers=headers,
                 )
+
+        res = await get_page(1)
+        responses = [res]
+        last_page = get_page_number(res.links.get("last", {}).get("url"))
+        if last_page is not None:
+            if last_page > OPEN_PULL_REQUESTS_PAGE_LIMIT:
+                log.info("hit pagination limit", last_page=last_page)
+                last_page = OPEN_PULL_REQUESTS_PAGE_LIMIT
+            # the Link header tells us the number of pages, so we can fetch the
+            # rest concurrently.
+            responses += await asyncio.gather(
+                *(get_page(page) for page in range(2, last_page + 1))
+            )
+
+        open_prs = []
+        for res in responses:
             try:
                 res.raise_for_status()
             except http.HTTPError:
                 log.warning("problem finding prs", res=res, exc_info=True)
                 return None
-
-            page = res.json()
-            open_prs += [GetOpenPullRequestsResponseSchema.parse_obj(pr) for pr in page]
-
-        return open_prs
+            open_prs += [
+                GetOpenPullRequestsResponseSchema.parse_obj(pr) for pr in res.json()
+            ]
+
+        if conf.OPEN_PULL_REQUESTS_CACHE_TTL_SEC > 0:
+            cache_open_pull_requests(
+                repo_key,
+                (base, head),
+                OpenPullRequestsCacheEntry(
+                    expires_at=time.monotonic() + conf.OPEN_PULL_REQUESTS_CACHE_TTL_SEC,
+                    pull_requests=open_prs,
+                ),
+            )
+        return list(open_prs)
 
     async def delete_branch(self, branch: str) -> http.Response:
         """
@@ -1347,7 +2021,9 @@ query {
         )
         url = conf.v3_url(f"/repos/{self.owner}/{self.repo}/pulls/{number}")
         async with self.throttler:
-            return await self.session.get(url, headers=headers)
+            return await response_cache.get(
+                self.session, url, scope=self.installation_id, headers=headers
+            )
 
     async def merge_pull_request(
         self,
@@ -1370,7 +2046,12 @@ query {
         )
         url = conf.v3_url(f"/repos/{self.owner}/{self.repo}/pulls/{number}/merge")
         async with self.throttler:
-            return await self.session.put(url, headers=headers, json=body)
+            res = await self.session.put(url, headers=headers, json=body)
+        if not res.is_error:
+            invalidate_open_pull_requests(
+                installation_id=self.installation_id, owner=self.owner, repo=self.repo
+            )
+        return res
 
     async def update_ref(self, *, ref: str, sha: str) -> http.Response:
         """
@@ -1487,36 +2168,127 @@ def generate_jwt(*, private_key: str, app_identifier: str) -> str:
     return jwt.encode(payload=payload, key=private_key, algorithm="RS256").decode()
 
 
+def get_installation_token_key(installation_id: str) -> str:
+    return f"kodiak:installation_token:{installation_id}"
+
+
+class InstallationTokenManager:
+    """
+    Fetch installation access tokens.
+
+    Concurrent requests for an installation's token share one API call, and
+    tokens are refreshed in the background before they expire so callers
+    don't wait on the refresh. With `INSTALLATION_TOKEN_REDIS_CACHE`, tokens
+    are also shared between processes through Redis.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Dict[str, asyncio.Task[TokenResponse]] = {}
+        self.app_token: Optional[str] = None
+        self.app_token_expires_at = 0.0
+        self.fetches = 0
+
+    def get_app_token(self) -> str:
+        """
+        Signing a JWT is CPU heavy, so we reuse the token for most of its life.
+        """
+        if self.app_token is None or self.app_token_expires_at < time.monotonic():
+            self.app_token = generate_jwt(
+                private_key=conf.PRIVATE_KEY, app_identifier=conf.GITHUB_APP_ID
+            )
+            # `generate_jwt` tokens last 9.5 minutes.
+            self.app_token_expires_at = time.monotonic() + 8 * 60
+        return self.app_token
+
+    async def get_token(
+        self, *, session: http.AsyncClient, installation_id: str
+    ) -> str:
+        token = installation_cache.get(installation_id)
+        if token is not None and not token.expired:
+            if token.needs_refresh:
+                self.refresh(session=session, installation_id=installation_id)
+            return token.token
+        token_response = await asyncio.shield(
+            self.refresh(session=session, installation_id=installation_id)
+        )
+        return token_response.token
+
+    def refresh(
+        self, *, session: http.AsyncClient, installation_id: str
+    ) -> asyncio.Task[TokenResponse]:
+        task = self.pending.get(installation_id)
+        if task is None:
+            task = asyncio.create_task(
+                self.fetch(session=session, installation_id=installation_id)
+            )
+            self.pending[installation_id] = task
+            task.add_done_callback(
+                functools.partial(self.on_refreshed, installation_id)
+            )
+        return task
+
+    def on_refreshed(
+        self, installation_id: str, task: asyncio.Task[TokenResponse]
+    ) -> None:
+        self.pending.pop(installation_id, None)
+        if not task.cancelled() and task.exception() is not None:
+            # callers waiting on the token receive the exception. A failed
+            # background refresh is retried on the next request.
+            logger.warning(
+                "installation_token_refresh_failed",
+                install=installation_id,
+                exc_info=task.exception(),
+            )
+
+    async def fetch(
+        self, *, session: http.AsyncClient, installation_id: str
+    ) -> TokenResponse:
+        if conf.INSTALLATION_TOKEN_REDIS_CACHE:
+            cached = await redis_bot.get(get_installation_token_key(installation_id))
+            if cached is not None:
+                token_response = TokenResponse.parse_raw(cached)
+                if not token_response.needs_refresh:
+                    installation_cache[installation_id] = token_response
+                    return token_response
+        self.fetches += 1
+        throttler = get_thottler_for_installation(
+            # this isn't a real installation ID, but it provides rate limiting
+            # for our GithubApp instead of the installations we typically act as
+            installation_id=APPLICATION_ID
+        )
+        async with throttler:
+            res = await session.post(
+                conf.v3_url(f"/app/installations/{installation_id}/access_tokens"),
+                headers=dict(
+                    Accept="application/vnd.github.machine-man-preview+json",
+                    Authorization=f"Bearer {self.get_app_token()}",
+                ),
+            )
+        if res.status_code > 300:
+            raise Exception(f"Failed to get token, github response: {res.text}")
+        token_response = TokenResponse(**res.json())
+        installation_cache[installation_id] = token_response
+        if conf.INSTALLATION_TOKEN_REDIS_CACHE:
+            await redis_bot.set(
+                get_installation_token_key(installation_id),
+                token_response.json(),
+                exat=token_response.expires_at - timedelta(minutes=5),
+            )
+        return token_response
+
+
+token_manager = InstallationTokenManager()
+
+
 async def get_token_for_install(
     *, session: http.AsyncClient, installation_id: str
 ) -> str:
     """
     https://developer.github.com/apps/building-github-apps/authenticating-with-github-apps/#authenticating-as-an-installation
     """
-    token = installation_cache.get(installation_id)
-    if token is not None and not token.expired:
-        return token.token
-    app_token = generate_jwt(
-        private_key=conf.PRIVATE_KEY, app_identifier=conf.GITHUB_APP_ID
-    )
-    throttler = get_thottler_for_installation(
-        # this isn't a real installation ID, but it provides rate limiting
-        # for our GithubApp instead of the installations we typically act as
-        installation_id=APPLICATION_ID
+    return await token_manager.get_token(
+        session=session, installation_id=installation_id
     )
-    async with throttler:
-        res = await session.post(
-            conf.v3_url(f"/app/installations/{installation_id}/access_tokens"),
-            headers=dict(
-                Accept="application/vnd.github.machine-man-preview+json",
-                Authorization=f"Bearer {app_token}",
-            ),
-        )
-    if res.status_code > 300:
-        raise Exception(f"Failed to get token, github response: {res.text}")
-    token_response = TokenResponse(**res.json())
-    installation_cache[installation_id] = token_response
-    return token_response.token
 
 
 async def get_headers(
@@ -1,25 +1,26 @@
 from __future__ import annotations
 
 import asyncio
+import functools
 import json
 import time
-import typing
 import urllib
-from asyncio.tasks import Task
-from dataclasses import dataclass
 from datetime import timedelta
-from typing import Iterator, MutableMapping, NoReturn, Optional, Tuple
+from typing import Iterator, Optional
 
 import sentry_sdk
 import structlog
-import zstandard as zstd
-from pydantic import BaseModel
-from typing_extensions import Literal, Protocol
+from pydantic import BaseModel, PrivateAttr
+from typing_extensions import Protocol
 
 from kodiak import (
     app_config as conf,
     queries,
+    sha_index,
 )
+from kodiak.coalescing import WebhookCoalescer
+from kodiak.delayed_queue import DelayedQueue
+from kodiak.dispatcher import QueueDispatcher, QueueHandler
 from kodiak.events import (
     CheckRunEvent,
     PullRequestEvent,
@@ -29,9 +30,14 @@ from kodiak.events import (
     StatusEvent,
 )
 from kodiak.events.status import Branch
-from kodiak.pull_request import evaluate_pr
+from kodiak.leases import LeaseManager, in_worker_shard
+from kodiak.merge_wakeups import merge_wakeups
+from kodiak.pull_request import POLL_RATE_SECONDS, evaluate_pr
 from kodiak.queries import Client
-from kodiak.redis_client import redis_bot, redis_web_api
+from kodiak.redis_client import redis_bot
+from kodiak.retry import retry_policy
+from kodiak.supervisor import TaskSupervisor
+from kodiak.usage_reporting import usage_reporter
 
 logger = structlog.get_logger()
 
@@ -41,11 +47,20 @@ MERGE_QUEUE_NAMES = "kodiak_merge_queue_names:v2"
 WEBHOOK_QUEUE_NAMES = "kodiak_webhook_queue_names"
 QUEUE_PUBSUB_INGEST = "kodiak:pubsub:ingest"
 
+webhook_delayed_queue = DelayedQueue(queue_names_key=WEBHOOK_QUEUE_NAMES)
+
 
 def get_ingest_queue(installation_id: int) -> str:
     return f"kodiak:ingest:{installation_id}"
 
 
+def installation_id_from_ingest_queue(queue_name: str) -> str:
+    """
+    kodiak:ingest:848733 -> 848733
+    """
+    return queue_name.rpartition(":")[2]
+
+
 RETRY_RATE_SECONDS = 2
 
 
@@ -69,17 +84,45 @@ class WebhookQueueProtocol(Protocol):
     ) -> int | None: ...
 
 
+# pull_request actions that change the open pull requests for a base or head.
+OPEN_PULL_REQUESTS_CHANGED_ACTIONS = {"opened", "reopened", "closed", "edited"}
+
+
 async def pr_event(queue: WebhookQueueProtocol, pr: PullRequestEvent) -> None:
     """
     Trigger evaluation of modified PR.
     """
+    owner = pr.repository.owner.login
+    repo = pr.repository.name
+    installation_id = str(pr.installation.id)
+    if pr.action in OPEN_PULL_REQUESTS_CHANGED_ACTIONS:
+        queries.invalidate_open_pull_requests(
+            installation_id=installation_id, owner=owner, repo=repo
+        )
+    if pr.action == "closed":
+        await sha_index.remove_head_sha(
+            installation_id=installation_id,
+            owner=owner,
+            repo=repo,
+            sha=pr.pull_request.head.sha,
+            pull_request_number=pr.number,
+        )
+    else:
+        await sha_index.record_head_sha(
+            installation_id=installation_id,
+            owner=owner,
+            repo=repo,
+            sha=pr.pull_request.head.sha,
+            pull_request_number=pr.number,
+            target_name=pr.pull_request.base.ref,
+        )
     await queue.enqueue(
         event=WebhookEvent(
-            repo_owner=pr.repository.owner.login,
-            repo_name=pr.repository.name,
+            repo_owner=owner,
+            repo_name=repo,
             pull_request_number=pr.number,
             target_name=pr.pull_request.base.ref,
-            installation_id=str(pr.installation.id),
+            installation_id=installation_id,
         )
     )
 
@@ -104,6 +147,52 @@ def check_run(check_run_event: CheckRunEvent) -> Iterator[WebhookEvent]:
         )
 
 
+async def find_indexed_pull_requests(
+    *, installation_id: str, owner: str, repo: str, sha: str
+) -> tuple[list[WebhookEvent], bool]:
+    """
+    Find the pull requests with `sha` at their head using the SHA index, and
+    whether the index has every pull request for the SHA.
+    """
+    entry = await sha_index.find_pull_requests(
+        installation_id=installation_id, owner=owner, repo=repo, sha=sha
+    )
+    events = [
+        WebhookEvent(
+            repo_owner=owner,
+            repo_name=repo,
+            pull_request_number=number,
+            target_name=target_name,
+            installation_id=installation_id,
+        )
+        for number, target_name in entry.pull_requests
+    ]
+    return events, entry.complete
+
+
+async def check_run_fork_prs(
+    queue: WebhookQueueProtocol, check_run_event: CheckRunEvent
+) -> None:
+    """
+    Check runs for pull requests from forks don't include `pull_requests`, so
+    we find them with the SHA index.
+    """
+    if (
+        check_run_event.check_run.name == queries.CHECK_RUN_NAME
+        or check_run_event.check_run.head_sha is None
+    ):
+        return
+    events, _complete = await find_indexed_pull_requests(
+        installation_id=str(check_run_event.installation.id),
+        owner=check_run_event.repository.owner.login,
+        repo=check_run_event.repository.name,
+        sha=check_run_event.check_run.head_sha,
+    )
+    logger.info("check_run_sha_index_lookup", sha_index_hit=bool(events))
+    for event in events:
+        await queue.enqueue(event=event)
+
+
 def find_branch_names_latest(sha: str, branches: list[Branch]) -> list[str]:
     """
     from the docs:
@@ -127,6 +216,17 @@ async def status_event(queue: WebhookQueueProtocol, status_event: StatusEvent) -
     installation_id = str(status_event.installation.id)
     log = logger.bind(owner=owner, repo=repo, install=installation_id)
 
+    indexed_events, complete = await find_indexed_pull_requests(
+        installation_id=installation_id, owner=owner, repo=repo, sha=status_event.sha
+    )
+    if complete:
+        log.info("status_event_sha_index_hit", events=len(indexed_events))
+        for event in indexed_events:
+            await queue.enqueue(event=event)
+        return
+    # pull requests we haven't indexed may have the same SHA, so we list them.
+    log.info("status_event_sha_index_miss", indexed_events=len(indexed_events))
+
     refs = find_branch_names_latest(
         sha=status_event.sha, branches=status_event.branches
     )
@@ -150,7 +250,7 @@ async def status_event(queue: WebhookQueueProtocol, status_event: StatusEvent) -
             ]
             pr_results = await asyncio.gather(*pr_requests)
 
-        all_events: set[WebhookEvent] = set()
+        all_events: set[WebhookEvent] = set(indexed_events)
         for prs in pr_results:
             if prs is None:
                 continue
@@ -164,6 +264,22 @@ async def status_event(queue: WebhookQueueProtocol, status_event: StatusEvent) -
                         installation_id=str(installation_id),
                     )
                 )
+                if pr.head is not None and pr.head.sha == status_event.sha:
+                    await sha_index.record_head_sha(
+                        installation_id=installation_id,
+                        owner=owner,
+                        repo=repo,
+                        sha=pr.head.sha,
+                        pull_request_number=pr.number,
+                        target_name=pr.base.ref,
+                    )
+        if all(prs is not None for prs in pr_results):
+            await sha_index.mark_complete(
+                installation_id=installation_id,
+                owner=owner,
+                repo=repo,
+                sha=status_event.sha,
+            )
         for event in all_events:
             await queue.enqueue(event=event)
 
@@ -229,11 +345,6 @@ async def push(queue: WebhookQueueProtocol, push_event: PushEvent) -> None:
             )
 
 
-def compress_payload(data: dict[str, object]) -> bytes:
-    cctx = zstd.ZstdCompressor()
-    return cctx.compress(json.dumps(data).encode())
-
-
 async def handle_webhook_event(
     queue: WebhookQueueProtocol, event_name: str, payload: dict[str, object]
 ) -> None:
@@ -241,21 +352,16 @@ async def handle_webhook_event(
 
     if conf.USAGE_REPORTING and event_name in conf.USAGE_REPORTING_EVENTS:
         # store events in Redis for dequeue by web api job.
-        #
-        # We limit the queue length to ensure that if the dequeue job fails, we
-        # won't overload Redis.
-        await redis_web_api.rpush(
-            b"kodiak:webhook_event",
-            compress_payload(dict(event_name=event_name, payload=payload)),
-        )
-        await redis_web_api.ltrim(
-            b"kodiak:webhook_event", 0, conf.USAGE_REPORTING_QUEUE_LENGTH
-        )
+        usage_reporter.report(event_name=event_name, payload=payload)
         log = log.bind(usage_reported=True)
 
     if event_name == "check_run":
-        for event in check_run(CheckRunEvent.parse_obj(payload)):
-            await queue.enqueue(event=event)
+        check_run_event = CheckRunEvent.parse_obj(payload)
+        if check_run_event.check_run.pull_requests:
+            for event in check_run(check_run_event):
+                await queue.enqueue(event=event)
+        else:
+            await check_run_fork_prs(queue, check_run_event)
     elif event_name == "pull_request":
         await pr_event(queue, PullRequestEvent.parse_obj(payload))
     elif event_name == "pull_request_review":
@@ -279,6 +385,58 @@ class WebhookEvent(BaseModel):
     installation_id: str
     target_name: str
 
+    _member: Optional[str] = PrivateAttr(default=None)
+
+    class Config:
+        # `member()` is cached, so events must not change.
+        allow_mutation = False
+
+    def member(self) -> str:
+        """
+        Compact encoding of the event we store in webhook and merge queues and
+        in the merge target key. Must match `parse_kodiak_queue_entry` in the
+        web api.
+
+        ["848733","chdsbd","kodiak",123,"master"]
+        """
+        if self._member is None:
+            self._member = json.dumps(
+                [
+                    self.installation_id,
+                    self.repo_owner,
+                    self.repo_name,
+                    self.pull_request_number,
+                    self.target_name,
+                ],
+                separators=(",", ":"),
+            )
+        return self._member
+
+    @classmethod
+    def parse_member(cls, data: bytes) -> WebhookEvent:
+        """
+        Parse an event from a queue. We also accept the JSON object encoding
+        used before `member()`.
+        """
+        if not data.startswith(b"["):
+            return cls.parse_raw(data)
+        (
+            installation_id,
+            repo_owner,
+            repo_name,
+            pull_request_number,
+            target_name,
+        ) = json.loads(data)
+        event = cls.construct(
+            repo_owner=repo_owner,
+            repo_name=repo_name,
+            pull_request_number=pull_request_number,
+            installation_id=installation_id,
+            target_name=target_name,
+        )
+        event._member = data.decode()
+        return event
+
     def get_merge_queue_name(self) -> str:
         return get_merge_queue_name(self)
 
@@ -297,64 +455,92 @@ class WebhookEvent(BaseModel):
         )
 
 
-async def bzpopmin_with_timeout(queue_name: str) -> Tuple[bytes, bytes, float] | None:
-    return await redis_bot.bzpopmin(
-        [queue_name], timeout=conf.REDIS_BLOCKING_POP_TIMEOUT_SEC
+async def dequeue_from_merge_queue(webhook_event: WebhookEvent) -> None:
+    # we also remove the JSON object encoding in case the event was queued
+    # before we switched to `WebhookEvent.member()`.
+    await redis_bot.zrem(
+        webhook_event.get_merge_queue_name(),
+        webhook_event.member(),
+        webhook_event.json(),
+    )
+
+
+async def requeue_webhook_event(webhook_event: WebhookEvent, *, delay: float) -> None:
+    if delay > 0:
+        await webhook_delayed_queue.add(
+            queue_name=webhook_event.get_webhook_queue_name(),
+            member=webhook_event.member(),
+            delay=delay,
+        )
+        return
+    await redis_bot.zadd(
+        webhook_event.get_webhook_queue_name(),
+        {webhook_event.member(): time.time()},
+        nx=True,
     )
 
 
 async def process_webhook_event(
     webhook_queue: RedisWebhookQueue,
-    queue_name: str,
+    webhook_event: WebhookEvent,
     log: structlog.BoundLogger,
-) -> None:
-    log.info("block for new webhook event")
-    webhook_event_json = await bzpopmin_with_timeout(queue_name)
-    if webhook_event_json is None:
-        return
-    log.info("parsing webhook event")
-    webhook_event = WebhookEvent.parse_raw(webhook_event_json[1])
+    event_info: Optional[queries.EventInfoResponse] = None,
+) -> bool:
+    """
+    Returns whether we merged or updated a branch.
+    """
     is_active_merging = (
         await redis_bot.get(webhook_event.get_merge_target_queue_name())
-        == webhook_event.json().encode()
+        == webhook_event.member().encode()
     )
 
     async def dequeue() -> None:
-        await redis_bot.zrem(webhook_event.get_merge_queue_name(), webhook_event.json())
+        await dequeue_from_merge_queue(webhook_event)
 
-    async def requeue() -> None:
-        await redis_bot.zadd(
-            webhook_event.get_webhook_queue_name(),
-            {webhook_event.json(): time.time()},
-            nx=True,
-        )
+    async def requeue(*, delay: float = 0) -> None:
+        await requeue_webhook_event(webhook_event, delay=delay)
 
     async def queue_for_merge(*, first: bool) -> Optional[int]:
         return await webhook_queue.enqueue_for_repo(event=webhook_event, first=first)
 
+    coalescer = webhook_queue.coalescer
+    if coalescer is not None:
+        await coalescer.start(member=webhook_event.member())
     log.info("evaluate pr for webhook event")
-    await evaluate_pr(
-        install=webhook_event.installation_id,
-        owner=webhook_event.repo_owner,
-        repo=webhook_event.repo_name,
-        number=webhook_event.pull_request_number,
-        merging=False,
-        dequeue_callback=dequeue,
-        requeue_callback=requeue,
-        queue_for_merge_callback=queue_for_merge,
-        is_active_merging=is_active_merging,
-        log=log,
-    )
+    try:
+        return await evaluate_pr(
+            install=webhook_event.installation_id,
+            owner=webhook_event.repo_owner,
+            repo=webhook_event.repo_name,
+            number=webhook_event.pull_request_number,
+            merging=False,
+            dequeue_callback=dequeue,
+            requeue_callback=requeue,
+            queue_for_merge_callback=queue_for_merge,
+            is_active_merging=is_active_merging,
+            log=log,
+            target_name=webhook_event.target_name,
+            event=event_info,
+        )
+    finally:
+        if coalescer is not None:
+            await coalescer.finish(
+                queue_name=webhook_event.get_webhook_queue_name(),
+                member=webhook_event.member(),
+            )
 
 
 async def webhook_event_consumer(
-    *, webhook_queue: RedisWebhookQueue, queue_name: str
-) -> typing.NoReturn:
+    webhook_queue: RedisWebhookQueue, queue_name: str, value: bytes, score: float
+) -> None:
     """
-    Worker to process incoming webhook events from redis
+    Process a webhook event popped from redis by the dispatcher
 
     1. process mergeability information and update github check status for pr
     2. enqueue pr into repo queue for merging, if mergeability passed
+
+    Queued events for the same repository and base branch are processed with
+    the popped event.
     """
 
     # We need to define a custom Hub so that we can set the scope correctly.
@@ -371,62 +557,162 @@ async def webhook_event_consumer(
         log = logger.bind(
             queue=queue_name, install=installation_id_from_queue(queue_name)
         )
-        log.info("start webhook event consumer")
-        while True:
-            await process_webhook_event(webhook_queue, queue_name, log)
+        # pause the installation's queue during a GitHub outage.
+        await retry_policy.wait_until_closed(installation_id_from_queue(queue_name))
+        log.info("parsing webhook event")
+        webhook_event = WebhookEvent.parse_member(value)
+        events = [webhook_event]
+        if conf.WEBHOOK_BATCH_SIZE > 1:
+            events += await pop_related_webhook_events(queue_name, webhook_event)
+        if len(events) > 1:
+            log.info("webhook_event_batch", events=len(events))
+        finished = 0
+        try:
+            event_infos = await get_event_infos(events, log)
+            for event in events:
+                try:
+                    changed_branch = await process_webhook_event(
+                        webhook_queue,
+                        event,
+                        log,
+                        event_info=event_infos.get(event.pull_request_number),
+                    )
+                except Exception:
+                    # don't drop the rest of the batch. We may have changed a
+                    # branch before failing.
+                    log.exception("webhook_event_failed", webhook_event=event.member())
+                    changed_branch = True
+                finished += 1
+                if changed_branch and event_infos:
+                    # merging or updating a branch changes the other pull
+                    # requests, e.g. they may now be behind their base branch.
+                    event_infos = await get_event_infos(events[finished:], log)
+        except asyncio.CancelledError:
+            # the dispatcher puts the popped event back on the queue, so we
+            # only need to put back the related events we haven't finished.
+            unfinished = events[max(finished, 1) :]
+            if unfinished:
+                await redis_bot.zadd(
+                    queue_name,
+                    {
+                        unfinished_event.member(): score
+                        for unfinished_event in unfinished
+                    },
+                    nx=True,
+                )
+            raise
 
 
-async def process_repo_queue(log: structlog.BoundLogger, queue_name: str) -> None:
-    log.info("block for new repo event")
-    result = await bzpopmin_with_timeout(queue_name)
-    if result is None:
-        return
-    _key, value, score = result
-    webhook_event = WebhookEvent.parse_raw(value)
+async def get_event_infos(
+    events: list[WebhookEvent], log: structlog.BoundLogger
+) -> dict[int, queries.EventInfoResponse]:
+    """
+    Fetch the pull requests for `events` with one query instead of one query
+    each. If the query fails, each pull request is fetched when it's evaluated.
+    """
+    if len(events) < 2:
+        return {}
+    first_event = events[0]
+    try:
+        async with Client(
+            owner=first_event.repo_owner,
+            repo=first_event.repo_name,
+            installation_id=first_event.installation_id,
+        ) as api_client:
+            return await api_client.get_event_info_many(
+                [event.pull_request_number for event in events],
+                base_ref=first_event.target_name,
+            )
+    except Exception:
+        log.exception("webhook_event_batch_failed", events=len(events))
+        return {}
+
+
+async def pop_related_webhook_events(
+    queue_name: str, webhook_event: WebhookEvent
+) -> list[WebhookEvent]:
+    """
+    Remove the next events from the webhook queue that are for the same
+    repository and base branch as `webhook_event`, so we can evaluate them
+    together.
+    """
+    related: dict[bytes, WebhookEvent] = {}
+    for value in await redis_bot.zrange(queue_name, 0, conf.WEBHOOK_BATCH_SIZE - 2):
+        event = WebhookEvent.parse_member(value)
+        if (event.repo_owner, event.repo_name, event.target_name) == (
+            webhook_event.repo_owner,
+            webhook_event.repo_name,
+            webhook_event.target_name,
+        ):
+            related[value] = event
+    if not related:
+        return []
+    await redis_bot.zrem(queue_name, *related)
+    return list(related.values())
+
+
+async def process_repo_queue(
+    log: structlog.BoundLogger, value: bytes, score: float
+) -> None:
+    webhook_event = WebhookEvent.parse_member(value)
     target_name = webhook_event.get_merge_target_queue_name()
     # mark this PR as being merged currently. we check this elsewhere to set proper status codes
-    await redis_bot.set(target_name, webhook_event.json())
+    await redis_bot.set(target_name, webhook_event.member())
     await redis_bot.set(target_name + ":time", str(score))
 
     async def dequeue() -> None:
-        await redis_bot.zrem(webhook_event.get_merge_queue_name(), webhook_event.json())
+        await dequeue_from_merge_queue(webhook_event)
 
-    async def requeue() -> None:
-        await redis_bot.zadd(
-            webhook_event.get_webhook_queue_name(),
-            {webhook_event.json(): time.time()},
-            nx=True,
-        )
+    async def requeue(*, delay: float = 0) -> None:
+        await requeue_webhook_event(webhook_event, delay=delay)
 
     async def queue_for_merge(*, first: bool) -> Optional[int]:
         raise NotImplementedError
 
     log.info("evaluate PR for merging")
-    await evaluate_pr(
-        install=webhook_event.installation_id,
-        owner=webhook_event.repo_owner,
-        repo=webhook_event.repo_name,
-        number=webhook_event.pull_request_number,
-        dequeue_callback=dequeue,
-        requeue_callback=requeue,
-        merging=True,
-        is_active_merging=False,
-        queue_for_merge_callback=queue_for_merge,
-        log=log,
-    )
+    try:
+        async with merge_wakeups.watch(webhook_event.member()) as wakeup:
+
+            async def wait_for_update() -> None:
+                # events for the pull request that arrive while we sleep are
+                # handled by a single evaluation.
+                await asyncio.sleep(POLL_RATE_SECONDS)
+                woken = await wakeup.wait(timeout=conf.MERGE_POLL_FALLBACK_SEC)
+                log.info("merge_wakeup", woken=woken, wakeups=wakeup.wakeups)
+
+            await evaluate_pr(
+                install=webhook_event.installation_id,
+                owner=webhook_event.repo_owner,
+                repo=webhook_event.repo_name,
+                number=webhook_event.pull_request_number,
+                dequeue_callback=dequeue,
+                requeue_callback=requeue,
+                merging=True,
+                is_active_merging=False,
+                queue_for_merge_callback=queue_for_merge,
+                log=log,
+                target_name=webhook_event.target_name,
+                poll_callback=wait_for_update,
+            )
+    except asyncio.CancelledError:
+        # we lost the queue's lease or are shutting down. The dispatcher puts
+        # the event back on the queue, so clear the target marker for the
+        # next worker.
+        log.info("merge cancelled, remove target marker", target_name=target_name)
+        await redis_bot.delete(target_name, target_name + ":time")
+        raise
     log.info("merge completed, remove target marker", target_name=target_name)
     await redis_bot.delete(target_name)
     await redis_bot.delete(target_name + ":time")
 
 
-async def repo_queue_consumer(*, queue_name: str) -> typing.NoReturn:
+async def repo_queue_consumer(queue_name: str, value: bytes, score: float) -> None:
     """
-    Worker for a repo given by :queue_name:
-
-    Pull webhook events off redis queue and process for mergeability.
+    Process a merge queue event for a repo given by :queue_name:
 
-    We only run one of these per repo as we can only merge one PR at a time
-    to be efficient. This also alleviates the need of locks.
+    The dispatcher only runs one handler per queue at a time as we can only
+    merge one PR at a time to be efficient. This also alleviates the need of
+    locks.
     """
     installation = installation_id_from_queue(queue_name)
     with sentry_sdk.Hub(sentry_sdk.Hub.current) as hub:
@@ -434,102 +720,118 @@ async def repo_queue_consumer(*, queue_name: str) -> typing.NoReturn:
             scope.set_tag("queue", queue_name)
             scope.set_tag("installation", installation)
         log = logger.bind(queue=queue_name, install=installation)
-        log.info("start repo_consumer")
-        while True:
-            await process_repo_queue(log, queue_name)
-
-
-T = typing.TypeVar("T")
-
-
-def find_position(x: typing.Iterable[T], v: T) -> typing.Optional[int]:
-    for index, item in enumerate(x):
-        if item == v:
-            return index
-    return None
+        await retry_policy.wait_until_closed(installation)
+        await process_repo_queue(log, value, score)
 
 
 ONE_DAY = int(timedelta(days=1).total_seconds())
 
 
-@dataclass(frozen=True)
-class TaskMeta:
-    kind: Literal["repo", "webhook"]
-    queue_name: str
-
-
 class RedisWebhookQueue:
-    def __init__(self) -> None:
-        self.worker_tasks: MutableMapping[
-            str, tuple[Task[NoReturn], Literal["repo", "webhook"]]
-        ] = {}  # type: ignore [assignment]
+    def __init__(self, supervisor: TaskSupervisor) -> None:
+        self.supervisor = supervisor
+        self.dispatcher = QueueDispatcher()
+        self.coalescer: WebhookCoalescer | None = None
+        if conf.WEBHOOK_COALESCE_WINDOW_SEC > 0:
+            self.coalescer = WebhookCoalescer(
+                queue_names_key=WEBHOOK_QUEUE_NAMES,
+                delayed_queue=webhook_delayed_queue,
+                window_sec=conf.WEBHOOK_COALESCE_WINDOW_SEC,
+                max_delay_sec=conf.WEBHOOK_COALESCE_MAX_DELAY_SEC,
+            )
+        self.leases: LeaseManager | None = None
+        if conf.WORKER_LEASES:
+            self.leases = LeaseManager(
+                dispatcher=self.dispatcher,
+                handler_for=self.get_handler,
+                queue_name_sets=[MERGE_QUEUE_NAMES, WEBHOOK_QUEUE_NAMES],
+                lease_ttl_sec=conf.WORKER_LEASE_TTL_SEC,
+                heartbeat_interval_sec=conf.WORKER_HEARTBEAT_INTERVAL_SEC,
+            )
 
     async def create(self) -> None:
-        # restart repo workers
-        merge_queues, webhook_queues = await asyncio.gather(
-            redis_bot.smembers(MERGE_QUEUE_NAMES),
-            redis_bot.smembers(WEBHOOK_QUEUE_NAMES),
+        if self.leases is not None:
+            # the lease heartbeat discovers existing queues and claims the
+            # queues assigned to us.
+            self.supervisor.start(
+                "lease_heartbeat", kind="lease_heartbeat", factory=self.leases.run
+            )
+            self.supervisor.start(
+                "lease_listener", kind="lease_listener", factory=self.leases.listen
+            )
+        else:
+            # restart repo workers
+            merge_queues, webhook_queues = await asyncio.gather(
+                redis_bot.smembers(MERGE_QUEUE_NAMES),
+                redis_bot.smembers(WEBHOOK_QUEUE_NAMES),
+            )
+            for merge_result in merge_queues:
+                queue_name = merge_result.decode()
+                if in_worker_shard(installation_id_from_queue(queue_name)):
+                    self.start_repo_worker(queue_name=queue_name)
+
+            for webhook_result in webhook_queues:
+                queue_name = webhook_result.decode()
+                if in_worker_shard(installation_id_from_queue(queue_name)):
+                    self.start_webhook_worker(queue_name=queue_name)
+
+        self.supervisor.start(
+            "queue_dispatcher", kind="queue_dispatcher", factory=self.dispatcher.run
+        )
+        self.supervisor.start(
+            "merge_wakeup_listener",
+            kind="merge_wakeup_listener",
+            factory=merge_wakeups.listen,
         )
-        for merge_result in merge_queues:
-            queue_name = merge_result.decode()
-            self.start_repo_worker(queue_name=queue_name)
+        self.supervisor.start(
+            "webhook_delayed_queue",
+            kind="webhook_delayed_queue",
+            factory=webhook_delayed_queue.run,
+        )
+
+    def get_handler(self, queue_name: str) -> QueueHandler:
+        if queue_name.startswith("merge_queue:"):
+            return repo_queue_consumer
+        return functools.partial(webhook_event_consumer, self)
 
-        for webhook_result in webhook_queues:
-            queue_name = webhook_result.decode()
-            self.start_webhook_worker(queue_name=queue_name)
+    def start_worker(self, queue_name: str) -> None:
+        if self.leases is not None:
+            # we only handle the queue if we claim its lease.
+            self.leases.track(queue_name)
+        else:
+            self.dispatcher.register(queue_name, self.get_handler(queue_name))
 
     def start_webhook_worker(self, *, queue_name: str) -> None:
-        self._start_worker(
-            queue_name,
-            "webhook",
-            webhook_event_consumer(webhook_queue=self, queue_name=queue_name),
-        )
+        self.start_worker(queue_name)
 
     def start_repo_worker(self, *, queue_name: str) -> None:
-        self._start_worker(
-            queue_name,
-            "repo",
-            repo_queue_consumer(
-                queue_name=queue_name,
-            ),
-        )
-
-    def _start_worker(
-        self,
-        key: str,
-        kind: Literal["repo", "webhook"],
-        fut: typing.Coroutine[None, None, NoReturn],
-    ) -> None:
-        log = logger.bind(queue_name=key, kind=kind)
-        worker_task_result = self.worker_tasks.get(key)
-        if worker_task_result is not None:
-            worker_task, _task_kind = worker_task_result
-            if not worker_task.done():
-                return
-            log.info("task failed")
-            # task failed. record result and restart
-            exception = worker_task.exception()
-            log.info("exception", excep=exception)
-            sentry_sdk.capture_exception(exception)
-        log.info("creating task for queue")
-        # create new task for queue
-        self.worker_tasks[key] = (asyncio.create_task(fut), kind)
+        self.start_worker(queue_name)
 
     async def enqueue(self, *, event: WebhookEvent) -> None:
         """
         add :event: to webhook queue
         """
         queue_name = get_webhook_queue_name(event)
-        async with redis_bot.pipeline(transaction=True) as pipe:
-            pipe.sadd(WEBHOOK_QUEUE_NAMES, queue_name)
-            pipe.zadd(queue_name, {event.json(): time.time()}, nx=True)
-            await pipe.execute()
         log = logger.bind(
             owner=event.repo_owner,
             repo=event.repo_name,
             number=event.pull_request_number,
             install=event.installation_id,
         )
+        # wake the merge loop if the pull request is being merged.
+        await merge_wakeups.publish(event.member())
+        if self.coalescer is not None:
+            queued = await self.coalescer.enqueue(
+                queue_name=queue_name, member=event.member()
+            )
+            if not queued:
+                log.info("coalesce webhook event")
+                return
+        else:
+            async with redis_bot.pipeline(transaction=True) as pipe:
+                pipe.sadd(WEBHOOK_QUEUE_NAMES, queue_name)
+                pipe.zadd(queue_name, {event.member(): time.time()}, nx=True)
+                await pipe.execute()
         log.info("enqueue webhook event")
         self.start_webhook_worker(queue_name=queue_name)
 
@@ -538,27 +840,29 @@ class RedisWebhookQueue:
     ) -> Optional[int]:
         """
         1. get the corresponding repo queue for event
-        2. add key to MERGE_QUEUE_NAMES so on restart we can recreate the
-        worker for the queue.
+        2. add key to MERGE_QUEUE_NAMES so on restart (or on another worker
+        process) we can recreate the worker for the queue.
         3. add event
         4. start worker (will create new worker if one does not exist)
 
         returns position of event in queue
         """
         queue_name = get_merge_queue_name(event)
+        member = event.member()
         async with redis_bot.pipeline(transaction=True) as pipe:
+            pipe.sadd(MERGE_QUEUE_NAMES, queue_name)
             merge_queues_by_install = f"merge_queue_by_install:{event.installation_id}"
             pipe.sadd(merge_queues_by_install, queue_name)
             pipe.expire(merge_queues_by_install, time=ONE_DAY)
             if first:
                 # place at front of queue. To allow us to always place this PR at
                 # the front, we should not pass only_if_not_exists.
-                pipe.zadd(queue_name, {event.json(): 1.0})
+                pipe.zadd(queue_name, {member: 1.0})
             else:
                 # use only_if_not_exists to prevent changing queue positions on new
                 # webhook events.
-                pipe.zadd(queue_name, {event.json(): time.time()}, nx=True)
-            pipe.zrange(queue_name, 0, 1000, withscores=True)
+                pipe.zadd(queue_name, {member: time.time()}, nx=True)
+            pipe.zrank(queue_name, member)
             results = await pipe.execute()
         log = logger.bind(
             owner=event.repo_owner,
@@ -570,15 +874,8 @@ class RedisWebhookQueue:
         log.info("enqueue repo event")
         self.start_repo_worker(queue_name=queue_name)
 
-        zrange_results = results[-1]  # type: list[tuple[bytes, float]]
-        kvs = sorted(
-            ((key, value) for key, value in zrange_results), key=lambda x: x[1]
-        )
-        return find_position((key for key, value in kvs), event.json().encode())
-
-    def all_tasks(self) -> Iterator[tuple[TaskMeta, Task[NoReturn]]]:
-        for queue_name, (task, task_kind) in self.worker_tasks.items():
-            yield (TaskMeta(kind=task_kind, queue_name=queue_name), task)
+        position: Optional[int] = results[-1]
+        return position
 
 
 def get_merge_queue_name(event: WebhookEvent) -> str:
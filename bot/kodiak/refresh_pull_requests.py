@@ -24,6 +24,7 @@ from sentry_sdk.integrations.logging import LoggingIntegration
 
 from kodiak import app_config as conf
 from kodiak.http import HttpClient
+from kodiak.http_cache import response_cache
 from kodiak.logging import SentryProcessor, add_request_info_processor
 from kodiak.queries import generate_jwt, get_token_for_install
 from kodiak.queue import WebhookEvent
@@ -108,8 +109,10 @@ async def get_login_for_install(*, http: HttpClient, installation_id: str) -> st
     app_token = generate_jwt(
         private_key=conf.PRIVATE_KEY, app_identifier=conf.GITHUB_APP_ID
     )
-    res = await http.get(
+    res = await response_cache.get(
+        http,
         conf.v3_url(f"/app/installations/{installation_id}"),
+        scope="app",
         headers=dict(
             Accept="application/vnd.github.machine-man-preview+json",
             Authorization=f"Bearer {app_token}",
@@ -160,7 +163,7 @@ async def refresh_pull_requests_for_installation(*, installation_id: str) -> Non
     for event in events:
         await redis_bot.zadd(
             event.get_webhook_queue_name(),
-            {event.json(): time.time()},
+            {event.member(): time.time()},
             nx=True,
         )
     logger.info(
@@ -0,0 +1,146 @@
+"""
+Back off from GitHub when API calls fail.
+
+`evaluate_pr` retries failed API calls after a jittered exponential backoff.
+Each installation has a budget of retries per minute so a degraded GitHub
+doesn't spend its rate limit on retries. After `RETRY_CIRCUIT_FAILURE_THRESHOLD`
+consecutive failures for an installation, we open a circuit breaker that
+pauses the installation's queues for `RETRY_CIRCUIT_OPEN_SEC`.
+
+State is kept per process. With sharded workers an installation's queues are
+handled by a single process.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import random
+import time
+from dataclasses import dataclass
+from typing import Dict
+
+import structlog
+
+from kodiak import app_config as conf
+
+logger = structlog.get_logger()
+
+
+@dataclass(frozen=True)
+class Backoff:
+    base_sec: float
+    max_sec: float
+
+    def delay(self, attempt: int) -> float:
+        """
+        Exponential backoff with "equal jitter", so we wait at least half of
+        the backoff and retries from many pull requests are spread out.
+
+        https://aws.amazon.com/blogs/architecture/exponential-backoff-and-jitter/
+        """
+        backoff: float = min(self.max_sec, self.base_sec * 2**attempt)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+
+@dataclass
+class InstallationRetryState:
+    tokens: float
+    updated_at: float
+    failures: int = 0
+    open_until: float = 0
+
+
+@dataclass
+class RetryMetrics:
+    retries: int = 0
+    retries_denied: int = 0
+    failures: int = 0
+    circuit_opened: int = 0
+
+
+class RetryPolicy:
+    def __init__(
+        self,
+        *,
+        backoff: Backoff,
+        budget_per_minute: float,
+        failure_threshold: int,
+        open_sec: float,
+    ) -> None:
+        self.backoff = backoff
+        self.budget_per_minute = budget_per_minute
+        self.failure_threshold = failure_threshold
+        self.open_sec = open_sec
+        self.installations: Dict[str, InstallationRetryState] = {}
+        self.metrics = RetryMetrics()
+
+    def _get_state(self, installation_id: str) -> InstallationRetryState:
+        state = self.installations.get(installation_id)
+        if state is None:
+            state = InstallationRetryState(
+                tokens=self.budget_per_minute, updated_at=time.monotonic()
+            )
+            self.installations[installation_id] = state
+        return state
+
+    def try_acquire_retry(self, installation_id: str) -> bool:
+        """
+        Take a retry from the installation's budget.
+        """
+        state = self._get_state(installation_id)
+        now = time.monotonic()
+        state.tokens = min(
+            self.budget_per_minute,
+            state.tokens + (now - state.updated_at) * self.budget_per_minute / 60,
+        )
+        state.updated_at = now
+        if state.tokens < 1:
+            self.metrics.retries_denied += 1
+            logger.info("retry_budget_exhausted", install=installation_id)
+            return False
+        state.tokens -= 1
+        self.metrics.retries += 1
+        return True
+
+    def record_failure(self, installation_id: str) -> None:
+        self.metrics.failures += 1
+        state = self._get_state(installation_id)
+        state.failures += 1
+        if state.failures >= self.failure_threshold:
+            state.failures = 0
+            state.open_until = time.monotonic() + self.open_sec
+            self.metrics.circuit_opened += 1
+            logger.warning(
+                "retry_circuit_opened",
+                install=installation_id,
+                open_sec=self.open_sec,
+            )
+
+    def record_success(self, installation_id: str) -> None:
+        state = self.installations.get(installation_id)
+        if state is not None:
+            state.failures = 0
+
+    async def wait_until_closed(self, installation_id: str) -> None:
+        """
+        Pause while the installation's circuit breaker is open.
+        """
+        state = self.installations.get(installation_id)
+        if state is None:
+            return
+        remaining = state.open_until - time.monotonic()
+        if remaining > 0:
+            logger.info(
+                "retry_circuit_wait", install=installation_id, wait_sec=remaining
+            )
+            await asyncio.sleep(remaining)
+
+
+retry_policy = RetryPolicy(
+    backoff=Backoff(
+        base_sec=conf.RETRY_BACKOFF_BASE_SEC, max_sec=conf.RETRY_BACKOFF_MAX_SEC
+    ),
+    budget_per_minute=conf.RETRY_BUDGET_PER_MINUTE,
+    failure_threshold=conf.RETRY_CIRCUIT_FAILURE_THRESHOLD,
+    open_sec=conf.RETRY_CIRCUIT_OPEN_SEC,
+)
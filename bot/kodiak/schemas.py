@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from typing import Any, Dict
+from typing import Any, Dict, Optional
 
 import pydantic
 
@@ -8,3 +8,5 @@ import pydantic
 class RawWebhookEvent(pydantic.BaseModel):
     event_name: str
     payload: Dict[str, Any]
+    # unix timestamp of when the ingest server queued the event.
+    enqueued_at: Optional[float] = None
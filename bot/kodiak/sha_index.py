@@ -0,0 +1,116 @@
+"""
+Index of head commit SHA -> open pull requests.
+
+Status events only include a commit SHA (and for fork pull requests, no
+branches), and check_run events for fork pull requests have no
+`pull_requests`, so to find the pull requests to evaluate we'd need to list
+the repository's open pull requests.
+
+We record the head SHA of pull requests from the `pull_request` events and
+event info we already receive, so most status and check_run events can be
+resolved without an API call.
+
+Pull requests opened before we started indexing, or whose entry expired,
+aren't in the index, so an entry only lists every pull request for the SHA
+once we've listed the repository's pull requests for it and marked the entry
+complete. Pull requests opened afterwards are recorded by their
+`pull_request` events.
+"""
+
+from __future__ import annotations
+
+from dataclasses import dataclass
+from typing import List, Tuple
+
+from kodiak.redis_client import redis_bot
+
+# status events for a commit usually arrive within a few hours of the push.
+SHA_INDEX_TTL_SEC = 3 * 24 * 60 * 60
+# hash field marking that the entry includes every open pull request.
+COMPLETE_FIELD = "complete"
+
+
+@dataclass(frozen=True)
+class ShaIndexEntry:
+    # (pull request number, base ref) pairs.
+    pull_requests: List[Tuple[int, str]]
+    complete: bool
+
+
+def get_sha_index_key(*, installation_id: str, owner: str, repo: str, sha: str) -> str:
+    return f"kodiak:sha_index:{installation_id}.{owner}/{repo}:{sha}"
+
+
+async def record_head_sha(
+    *,
+    installation_id: str,
+    owner: str,
+    repo: str,
+    sha: str,
+    pull_request_number: int,
+    target_name: str,
+) -> None:
+    """
+    Record `sha` as the head of the pull request.
+    """
+    key = get_sha_index_key(
+        installation_id=installation_id, owner=owner, repo=repo, sha=sha
+    )
+    async with redis_bot.pipeline(transaction=False) as pipe:
+        pipe.hset(key, str(pull_request_number), target_name)
+        pipe.expire(key, SHA_INDEX_TTL_SEC)
+        await pipe.execute()
+
+
+async def mark_complete(
+    *, installation_id: str, owner: str, repo: str, sha: str
+) -> None:
+    """
+    Record that the index has every open pull request with `sha` at its
+    head, because we listed the repository's pull requests.
+    """
+    key = get_sha_index_key(
+        installation_id=installation_id, owner=owner, repo=repo, sha=sha
+    )
+    async with redis_bot.pipeline(transaction=False) as pipe:
+        pipe.hset(key, COMPLETE_FIELD, "1")
+        pipe.expire(key, SHA_INDEX_TTL_SEC)
+        await pipe.execute()
+
+
+async def remove_head_sha(
+    *, installation_id: str, owner: str, repo: str, sha: str, pull_request_number: int
+) -> None:
+    """
+    Remove a closed pull request from the index.
+    """
+    await redis_bot.hdel(
+        get_sha_index_key(
+            installation_id=installation_id, owner=owner, repo=repo, sha=sha
+        ),
+        str(pull_request_number),
+    )
+
+
+async def find_pull_requests(
+    *, installation_id: str, owner: str, repo: str, sha: str
+) -> ShaIndexEntry:
+    """
+    Find the pull requests with `sha` at their head.
+
+    Unless the entry is complete, there may be other pull requests for the
+    SHA that we haven't seen.
+    """
+    res = await redis_bot.hgetall(
+        get_sha_index_key(
+            installation_id=installation_id, owner=owner, repo=repo, sha=sha
+        )
+    )
+    return ShaIndexEntry(
+        pull_requests=sorted(
+            (int(number), target.decode())
+            for number, target in res.items()
+            if number != COMPLETE_FIELD.encode()
+        ),
+        complete=COMPLETE_FIELD.encode() in res,
+    )
@@ -0,0 +1,112 @@
+"""
+Keep the worker's long running tasks alive.
+
+Instead of polling every task for failures, we restart tasks from their done
+callbacks with an exponential backoff so a crashing task can't spin.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import functools
+import time
+from collections import Counter
+from dataclasses import dataclass, field
+from typing import Callable, Coroutine, Dict
+
+import sentry_sdk
+import structlog
+
+logger = structlog.get_logger()
+
+TaskFactory = Callable[[], Coroutine[None, None, object]]
+
+
+@dataclass
+class SupervisedTask:
+    kind: str
+    factory: TaskFactory
+    task: asyncio.Task[object] | None = None
+    started_at: float = 0.0
+    consecutive_failures: int = 0
+    restart_handle: asyncio.TimerHandle | None = field(default=None, repr=False)
+
+
+class TaskSupervisor:
+    def __init__(
+        self,
+        *,
+        min_backoff_sec: float = 0.25,
+        max_backoff_sec: float = 60.0,
+        healthy_after_sec: float = 60.0,
+    ) -> None:
+        self.min_backoff_sec = min_backoff_sec
+        self.max_backoff_sec = max_backoff_sec
+        # a task that runs this long before failing is restarted without backoff.
+        self.healthy_after_sec = healthy_after_sec
+        self.tasks: Dict[str, SupervisedTask] = {}
+        self.restarts: Counter[str] = Counter()
+        # updated as tasks start and finish so logging it doesn't walk every task.
+        self.live_tasks = 0
+
+    def start(self, key: str, *, kind: str, factory: TaskFactory) -> None:
+        """
+        Start a task for `key` unless one is already running or scheduled to
+        restart.
+        """
+        if key in self.tasks:
+            return
+        self.tasks[key] = SupervisedTask(kind=kind, factory=factory)
+        self._run(key)
+        logger.info(
+            "supervisor_task_started", key=key, kind=kind, live_tasks=self.live_tasks
+        )
+
+    def _run(self, key: str) -> None:
+        supervised = self.tasks[key]
+        supervised.restart_handle = None
+        supervised.started_at = time.monotonic()
+        supervised.task = asyncio.create_task(supervised.factory())
+        self.live_tasks += 1
+        supervised.task.add_done_callback(functools.partial(self._on_done, key))
+
+    def _on_done(self, key: str, task: asyncio.Task[object]) -> None:
+        self.live_tasks -= 1
+        supervised = self.tasks.get(key)
+        if supervised is None or supervised.task is not task:
+            return
+        if task.cancelled():
+            # tasks are only cancelled on shutdown.
+            del self.tasks[key]
+            return
+        log = logger.bind(key=key, kind=supervised.kind)
+        exception = task.exception()
+        log.info("worker task failed", excep=exception)
+        if exception is not None:
+            sentry_sdk.capture_exception(exception)
+
+        if time.monotonic() - supervised.started_at >= self.healthy_after_sec:
+            supervised.consecutive_failures = 0
+        supervised.consecutive_failures += 1
+        backoff = min(
+            self.max_backoff_sec,
+            self.min_backoff_sec * 2 ** (supervised.consecutive_failures - 1),
+        )
+        self.restarts[supervised.kind] += 1
+        log.info(
+            "supervisor_task_restart_scheduled",
+            backoff_sec=backoff,
+            consecutive_failures=supervised.consecutive_failures,
+            restarts=self.restarts[supervised.kind],
+            live_tasks=self.live_tasks,
+        )
+        supervised.restart_handle = asyncio.get_running_loop().call_later(
+            backoff, self._run, key
+        )
+
+    def cancel(self) -> None:
+        for supervised in self.tasks.values():
+            if supervised.restart_handle is not None:
+                supervised.restart_handle.cancel()
+            if supervised.task is not None:
+                supervised.task.cancel()
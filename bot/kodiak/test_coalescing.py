@@ -0,0 +1,140 @@
+from __future__ import annotations
+
+import asyncio
+from typing import List, Tuple
+
+import pytest
+from pytest_mock import MockFixture
+
+from kodiak.coalescing import WebhookCoalescer, get_in_flight_key, get_pending_key
+from kodiak.delayed_queue import DELAYED_KEY, DelayedQueue
+from kodiak.redis_client import redis_bot
+from kodiak.tests.fixtures import get_queue, requires_redis
+
+QUEUE = "webhook:1234"
+QUEUE_NAMES = "kodiak_webhook_queue_names"
+MEMBER = '["1234","chdsbd","kodiak",123,"main"]'
+
+pytestmark = [requires_redis, pytest.mark.usefixtures("clean_redis")]
+
+
+@pytest.fixture
+def redis_keys() -> List[str]:
+    return [QUEUE, DELAYED_KEY, get_in_flight_key(MEMBER), get_pending_key(MEMBER)]
+
+
+def create_coalescer(
+    *, window_sec: float, max_delay_sec: float = 1
+) -> Tuple[WebhookCoalescer, DelayedQueue]:
+    delayed_queue = DelayedQueue(queue_names_key=QUEUE_NAMES)
+    coalescer = WebhookCoalescer(
+        queue_names_key=QUEUE_NAMES,
+        delayed_queue=delayed_queue,
+        window_sec=window_sec,
+        max_delay_sec=max_delay_sec,
+    )
+    return coalescer, delayed_queue
+
+
+async def test_coalescer_no_events() -> None:
+    """
+    If no events arrive during an evaluation, we shouldn't re-evaluate.
+    """
+    coalescer, delayed_queue = create_coalescer(window_sec=0.01, max_delay_sec=1)
+    assert await coalescer.enqueue(queue_name=QUEUE, member=MEMBER)
+    await redis_bot.delete(QUEUE)
+
+    await coalescer.start(member=MEMBER)
+    await coalescer.finish(queue_name=QUEUE, member=MEMBER)
+    await asyncio.sleep(0.05)
+    await delayed_queue.sweep()
+
+    assert await get_queue(QUEUE) == []
+    assert await redis_bot.exists(get_in_flight_key(MEMBER), DELAYED_KEY) == 0
+    assert coalescer.reevaluations == 0
+
+
+async def test_coalescer_events_during_evaluation() -> None:
+    """
+    Events that arrive during an evaluation should result in exactly one more
+    evaluation once the events stop.
+    """
+    coalescer, delayed_queue = create_coalescer(window_sec=0.05, max_delay_sec=1)
+
+    await coalescer.start(member=MEMBER)
+    for _ in range(5):
+        assert not await coalescer.enqueue(queue_name=QUEUE, member=MEMBER)
+    await coalescer.finish(queue_name=QUEUE, member=MEMBER)
+
+    # events that arrive during the quiet period are coalesced too.
+    assert not await coalescer.enqueue(queue_name=QUEUE, member=MEMBER)
+    await delayed_queue.sweep()
+    assert await get_queue(QUEUE) == []
+
+    await asyncio.sleep(0.1)
+    await delayed_queue.sweep()
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert (
+        await redis_bot.exists(
+            get_in_flight_key(MEMBER), get_pending_key(MEMBER), DELAYED_KEY
+        )
+        == 0
+    )
+    assert coalescer.coalesced_events == 6
+    assert coalescer.reevaluations == 1
+    assert coalescer.saved_evaluations == 5
+
+
+async def test_coalescer_max_delay() -> None:
+    """
+    We should re-evaluate after the max delay even if events keep arriving.
+    """
+    coalescer, delayed_queue = create_coalescer(window_sec=0.05, max_delay_sec=0.1)
+
+    await coalescer.start(member=MEMBER)
+    await coalescer.enqueue(queue_name=QUEUE, member=MEMBER)
+    await coalescer.finish(queue_name=QUEUE, member=MEMBER)
+    enqueued: List[bool] = []
+    for _ in range(30):
+        enqueued.append(await coalescer.enqueue(queue_name=QUEUE, member=MEMBER))
+        await asyncio.sleep(0.01)
+        await delayed_queue.sweep()
+        if await get_queue(QUEUE):
+            break
+
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert coalescer.reevaluations == 1
+    assert not any(enqueued)
+
+
+async def test_coalescer_survives_restart() -> None:
+    """
+    A pending evaluation should be queued by any worker, e.g. after the
+    worker that scheduled it restarts.
+    """
+    coalescer, _ = create_coalescer(window_sec=0.01, max_delay_sec=1)
+    await coalescer.start(member=MEMBER)
+    await coalescer.enqueue(queue_name=QUEUE, member=MEMBER)
+    await coalescer.finish(queue_name=QUEUE, member=MEMBER)
+    await asyncio.sleep(0.05)
+
+    restarted, restarted_queue = create_coalescer(window_sec=0.01, max_delay_sec=1)
+    await restarted_queue.sweep()
+
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert restarted.reevaluations == 1
+
+
+async def test_coalescer_finish_error(mocker: MockFixture) -> None:
+    """
+    If we can't record the evaluation finishing, we should queue the pull
+    request so events aren't lost.
+    """
+    coalescer, _ = create_coalescer(window_sec=0.01, max_delay_sec=1)
+    await coalescer.start(member=MEMBER)
+    mocker.patch.object(coalescer, "_settle", side_effect=ConnectionError)
+
+    await coalescer.finish(queue_name=QUEUE, member=MEMBER)
+
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert await redis_bot.exists(get_in_flight_key(MEMBER)) == 0
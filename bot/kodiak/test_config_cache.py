@@ -0,0 +1,40 @@
+from __future__ import annotations
+
+import toml
+
+from kodiak.config import V1
+from kodiak.config_cache import ConfigCache
+
+CONFIG = "version = 1\n"
+
+
+async def test_config_cache_lru() -> None:
+    """
+    We should parse a config once per oid and evict the least recently used
+    config when full.
+    """
+    cache = ConfigCache(max_size=2)
+    assert await cache.get("a") is None
+
+    first = await cache.put("a", CONFIG)
+    assert isinstance(first.parsed, V1)
+    await cache.put("b", CONFIG)
+    assert await cache.get("a") is first
+    await cache.put("c", CONFIG)
+
+    assert list(cache.configs) == ["a", "c"]
+    assert await cache.get("b") is None
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+async def test_config_cache_parse_error() -> None:
+    """
+    Invalid configs should be cached with their parse error.
+    """
+    cache = ConfigCache(max_size=2)
+    await cache.put("a", "version = ")
+
+    cached = await cache.get("a")
+    assert cached is not None
+    assert isinstance(cached.parsed, toml.TomlDecodeError)
+    assert cached.text == "version = "
@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+from typing import List
+
+import pytest
+
+from kodiak.delayed_queue import DELAYED_KEY, DelayedQueue, get_delayed_member
+from kodiak.redis_client import redis_bot
+from kodiak.tests.fixtures import get_queue, requires_redis
+
+QUEUE = "webhook:1234"
+QUEUE_NAMES = "kodiak_test_webhook_queue_names"
+MEMBER = '["1234","chdsbd","kodiak",123,"main"]'
+
+pytestmark = [requires_redis, pytest.mark.usefixtures("clean_redis")]
+
+
+@pytest.fixture
+def redis_keys() -> List[str]:
+    return [QUEUE, QUEUE_NAMES, DELAYED_KEY]
+
+
+async def test_delayed_queue() -> None:
+    """
+    Events should be queued once their delay has passed.
+    """
+    delayed_queue = DelayedQueue(queue_names_key=QUEUE_NAMES)
+    await delayed_queue.add(queue_name=QUEUE, member=MEMBER, delay=0.05)
+
+    await delayed_queue.sweep()
+    assert await get_queue(QUEUE) == []
+
+    await asyncio.sleep(0.1)
+    await delayed_queue.sweep()
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert await redis_bot.smembers(QUEUE_NAMES) == {QUEUE.encode()}
+    assert await redis_bot.exists(DELAYED_KEY) == 0
+    assert delayed_queue.requeued == 1
+
+
+async def test_delayed_queue_keeps_earlier_retry() -> None:
+    """
+    Adding an event that's already waiting shouldn't push back its retry.
+    """
+    delayed_queue = DelayedQueue(queue_names_key=QUEUE_NAMES)
+    await delayed_queue.add(queue_name=QUEUE, member=MEMBER, delay=0.01)
+    await delayed_queue.add(queue_name=QUEUE, member=MEMBER, delay=60)
+
+    await asyncio.sleep(0.05)
+    await delayed_queue.sweep()
+    assert await get_queue(QUEUE) == [MEMBER]
+
+
+async def test_delayed_queue_requeues_once() -> None:
+    """
+    When workers sweep concurrently only one of them should queue the event.
+    """
+    first = DelayedQueue(queue_names_key=QUEUE_NAMES)
+    second = DelayedQueue(queue_names_key=QUEUE_NAMES)
+    await first.add(queue_name=QUEUE, member=MEMBER, delay=0)
+
+    await asyncio.gather(first.sweep(), second.sweep())
+
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert first.requeued + second.requeued == 1
+
+
+async def test_delayed_queue_unknown_kind() -> None:
+    """
+    Entries without a registered handler should be requeued rather than left
+    in the sorted set.
+    """
+    delayed_queue = DelayedQueue(queue_names_key=QUEUE_NAMES)
+    await redis_bot.zadd(
+        DELAYED_KEY, {get_delayed_member("coalesce", QUEUE, MEMBER): 0}
+    )
+
+    await delayed_queue.sweep()
+
+    assert await get_queue(QUEUE) == [MEMBER]
+    assert await redis_bot.exists(DELAYED_KEY) == 0
@@ -0,0 +1,163 @@
+from __future__ import annotations
+
+import asyncio
+from typing import List, Tuple
+
+from pytest_mock import MockFixture
+
+from kodiak.dispatcher import QueueDispatcher
+from kodiak.tests.fixtures import FakeRedis
+
+
+async def test_dispatcher_drains_queue(mocker: MockFixture) -> None:
+    """
+    A single blocking pop should hand items to the queue's handler, which
+    drains the rest of the queue without blocking.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.dispatcher.redis_bot", fake_redis)
+    handled: List[Tuple[str, bytes]] = []
+    done = asyncio.Event()
+
+    async def handler(queue_name: str, value: bytes, score: float) -> None:
+        handled.append((queue_name, value))
+        if len(handled) == 3:
+            done.set()
+
+    dispatcher = QueueDispatcher()
+    for installation in range(100):
+        dispatcher.register(f"webhook:{installation}", handler)
+    await fake_redis.zadd("webhook:5", {b"a": 1})
+    await fake_redis.zadd("webhook:5", {b"b": 2})
+    await fake_redis.zadd("webhook:7", {b"c": 3})
+
+    task = asyncio.create_task(dispatcher.run())
+    await asyncio.wait_for(done.wait(), timeout=1)
+    await asyncio.sleep(0)
+
+    assert sorted(handled) == [
+        ("webhook:5", b"a"),
+        ("webhook:5", b"b"),
+        ("webhook:7", b"c"),
+    ]
+    assert dispatcher.pops == 2, "the second item should be drained by the handler"
+    assert len(fake_redis.called("bzpopmin")[0][0]) == 101
+    assert dispatcher.active == {}
+    assert len(dispatcher.idle) == 100
+    task.cancel()
+
+
+async def test_dispatcher_wakeup_on_register(mocker: MockFixture) -> None:
+    """
+    Registering a queue should interrupt the blocking pop so the new queue is
+    included.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.dispatcher.redis_bot", fake_redis)
+    done = asyncio.Event()
+
+    async def handler(queue_name: str, value: bytes, score: float) -> None:
+        done.set()
+
+    dispatcher = QueueDispatcher()
+    task = asyncio.create_task(dispatcher.run())
+    await asyncio.sleep(0)
+    assert [keys for keys, _ in fake_redis.called("bzpopmin")] == [
+        [dispatcher.wakeup_key]
+    ]
+
+    await fake_redis.zadd("merge_queue:1234.chdsbd/kodiak/main", {b"a": 1})
+    dispatcher.register("merge_queue:1234.chdsbd/kodiak/main", handler)
+    await asyncio.wait_for(done.wait(), timeout=1)
+
+    assert fake_redis.called("bzpopmin")[1][0] == [
+        dispatcher.wakeup_key,
+        "merge_queue:1234.chdsbd/kodiak/main",
+    ]
+    task.cancel()
+
+
+async def test_dispatcher_handler_failure(mocker: MockFixture) -> None:
+    """
+    A failing handler shouldn't stop us from handling the queue.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.dispatcher.redis_bot", fake_redis)
+    handled: List[bytes] = []
+    done = asyncio.Event()
+
+    async def handler(queue_name: str, value: bytes, score: float) -> None:
+        handled.append(value)
+        if value == b"a":
+            raise ValueError("boom")
+        done.set()
+
+    dispatcher = QueueDispatcher()
+    dispatcher.register("webhook:1234", handler)
+    await fake_redis.zadd("webhook:1234", {b"a": 1})
+    await fake_redis.zadd("webhook:1234", {b"b": 2})
+
+    task = asyncio.create_task(dispatcher.run())
+    await asyncio.wait_for(done.wait(), timeout=1)
+
+    assert handled == [b"a", b"b"]
+    task.cancel()
+
+
+async def test_dispatcher_returns_event_for_unowned_queue(mocker: MockFixture) -> None:
+    """
+    If we stop owning a queue while handling it, we should put the remaining
+    events back for the new owner.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.dispatcher.redis_bot", fake_redis)
+    handled: List[bytes] = []
+    done = asyncio.Event()
+    dispatcher = QueueDispatcher()
+
+    async def handler(queue_name: str, value: bytes, score: float) -> None:
+        handled.append(value)
+        dispatcher.can_handle = lambda _: False
+        done.set()
+
+    dispatcher.register("webhook:1234", handler)
+    await fake_redis.zadd("webhook:1234", {b"a": 1})
+    await fake_redis.zadd("webhook:1234", {b"b": 2})
+
+    task = asyncio.create_task(dispatcher.run())
+    await asyncio.wait_for(done.wait(), timeout=1)
+    for _ in range(3):
+        await asyncio.sleep(0)
+
+    assert handled == [b"a"]
+    assert fake_redis.sorted_sets["webhook:1234"] == {b"b": 2}
+    task.cancel()
+
+
+async def test_dispatcher_returns_event_on_cancel(mocker: MockFixture) -> None:
+    """
+    If the drain is cancelled while handling an event, we should put the
+    event back on the queue.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.dispatcher.redis_bot", fake_redis)
+    started = asyncio.Event()
+
+    async def handler(queue_name: str, value: bytes, score: float) -> None:
+        started.set()
+        await asyncio.sleep(60)
+
+    dispatcher = QueueDispatcher()
+    dispatcher.register("webhook:1234", handler)
+    await fake_redis.zadd("webhook:1234", {b"a": 1})
+
+    task = asyncio.create_task(dispatcher.run())
+    await asyncio.wait_for(started.wait(), timeout=1)
+    drain = dispatcher.active["webhook:1234"]
+    dispatcher.unregister("webhook:1234")
+    drain.cancel()
+    await asyncio.gather(drain, return_exceptions=True)
+
+    assert fake_redis.sorted_sets["webhook:1234"] == {b"a": 1}
+    assert dispatcher.active == {}
+    task.cancel()
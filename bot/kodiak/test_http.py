@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import asyncio
+
+from kodiak.http import HttpClient, Limits, PooledTransport
+
+
+class KeepAliveServer:
+    """
+    Minimal HTTP/1.1 server that keeps connections open between requests.
+    """
+
+    def __init__(self) -> None:
+        self.connections = 0
+        self.closed = asyncio.Event()
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        self.connections += 1
+        try:
+            while True:
+                await reader.readuntil(b"\r\n\r\n")
+                writer.write(b"HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok")
+                await writer.drain()
+        except asyncio.IncompleteReadError:
+            # the client closed the connection.
+            pass
+        finally:
+            writer.close()
+            self.closed.set()
+
+
+async def test_pooled_transport_reuses_connections() -> None:
+    """
+    Clients sharing a transport should reuse its keep-alive connections.
+    """
+    handler = KeepAliveServer()
+    server = await asyncio.start_server(handler.handle, "127.0.0.1", 0)
+    port = server.sockets[0].getsockname()[1]
+    transport = PooledTransport(
+        limits=Limits(max_connections=10, max_keepalive_connections=10)
+    )
+    clients = [HttpClient(transport=transport) for _ in range(3)]
+
+    for client in clients:
+        res = await client.get(f"http://127.0.0.1:{port}/")
+        assert res.text == "ok"
+
+    metrics = await transport.get_metrics()
+    assert metrics.requests == 3
+    assert metrics.connections_opened == 1
+    assert metrics.connections_reused == 2
+    assert metrics.connections_open == 1
+    assert metrics.connections_idle == 1
+    assert metrics.waiting == 0
+    assert handler.connections == 1
+
+    for client in clients:
+        await client.aclose()
+    await asyncio.wait_for(handler.closed.wait(), timeout=1)
+    server.close()
+    await server.wait_closed()
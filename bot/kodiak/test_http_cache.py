@@ -0,0 +1,100 @@
+from __future__ import annotations
+
+from typing import Dict, List, Optional, cast
+
+from kodiak import http
+from kodiak.http import Request, Response
+from kodiak.http_cache import ResponseCache
+
+
+class FakeSession:
+    """
+    Serve a fixed ETag and record the headers of each request.
+    """
+
+    def __init__(self, *, etag: str, content: bytes) -> None:
+        self.etag = etag
+        self.content = content
+        self.requests: List[Dict[str, str]] = []
+
+    async def get(
+        self, url: str, *, params: Optional[Dict[str, str]], headers: Dict[str, str]
+    ) -> Response:
+        self.requests.append(headers)
+        request = Request(method="GET", url=url)
+        rate_limit = {"X-RateLimit-Remaining": str(5000 - len(self.requests))}
+        if headers.get("If-None-Match") == self.etag:
+            return Response(status_code=304, headers=rate_limit, request=request)
+        return Response(
+            status_code=200,
+            headers={
+                "ETag": self.etag,
+                "Link": '<https://example.com>; rel="next"',
+                **rate_limit,
+            },
+            content=self.content,
+            request=request,
+        )
+
+
+def get_session(session: FakeSession) -> http.AsyncClient:
+    return cast(http.AsyncClient, session)
+
+
+async def test_response_cache_revalidates() -> None:
+    """
+    We should revalidate with the ETag and serve the cached body on a 304.
+    """
+    cache = ResponseCache(max_bytes=1000)
+    session = FakeSession(etag='"a"', content=b"[1]")
+    url = "https://api.github.com/repos/a/b/pulls"
+
+    first = await cache.get(get_session(session), url, scope="1", params={"page": "1"})
+    second = await cache.get(get_session(session), url, scope="1", params={"page": "1"})
+
+    assert first.json() == second.json() == [1]
+    assert second.status_code == 200
+    assert second.links["next"]["url"] == "https://example.com"
+    # rate limit headers should come from the 304, not the cache.
+    assert second.headers["X-RateLimit-Remaining"] == "4998"
+    assert "If-None-Match" not in session.requests[0]
+    assert session.requests[1]["If-None-Match"] == '"a"'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    session.etag = '"b"'
+    session.content = b"[2]"
+    third = await cache.get(get_session(session), url, scope="1", params={"page": "1"})
+    assert third.json() == [2]
+    assert (cache.hits, cache.misses) == (1, 2)
+
+
+async def test_response_cache_scope() -> None:
+    """
+    Responses shouldn't be shared between scopes.
+    """
+    cache = ResponseCache(max_bytes=1000)
+    session = FakeSession(etag='"a"', content=b"[1]")
+    url = "https://api.github.com/repos/a/b/pulls/1"
+
+    await cache.get(get_session(session), url, scope="1")
+    await cache.get(get_session(session), url, scope="2")
+
+    assert "If-None-Match" not in session.requests[1]
+    assert cache.misses == 2
+
+
+async def test_response_cache_evicts_by_size() -> None:
+    """
+    We should evict the least recently used responses to stay under max_bytes.
+    """
+    cache = ResponseCache(max_bytes=10)
+    session = FakeSession(etag='"a"', content=b"12345")
+
+    for path in ("a", "b", "c"):
+        await cache.get(get_session(session), f"https://example.com/{path}", scope="1")
+
+    assert [url for _scope, url in cache.responses] == [
+        "https://example.com/b",
+        "https://example.com/c",
+    ]
+    assert cache.size == 10
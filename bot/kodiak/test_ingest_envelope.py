@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import json
+import time
+from pathlib import Path
+
+import pytest
+import zstandard as zstd
+from pytest_mock import MockFixture
+
+from kodiak import ingest_envelope
+from kodiak.schemas import RawWebhookEvent
+
+FIXTURES = Path(__file__).parent / "test" / "fixtures" / "events"
+
+
+def test_encode_decode() -> None:
+    body = (FIXTURES / "pull_request" / "pull_request_event.json").read_bytes()
+    data = ingest_envelope.encode(event_name="pull_request", body=body)
+    assert len(data) < len(body) / 2, "we should compress the body"
+
+    event = ingest_envelope.decode(data)
+    assert event.event_name == "pull_request"
+    assert event.payload == json.loads(body)
+    assert event.enqueued_at is not None
+    assert time.time() - event.enqueued_at < 5
+
+
+def test_decode_uncompressed() -> None:
+    body = b'{"action": "opened", "installation": {"id": 1234}}'
+    event = ingest_envelope.decode(ingest_envelope.ENVELOPE_V1 + b"push\n" + body)
+    assert event.event_name == "push"
+    assert event.payload == {"action": "opened", "installation": {"id": 1234}}
+    assert event.enqueued_at is None
+
+
+def test_encode_decode_dictionary(mocker: MockFixture) -> None:
+    samples = [path.read_bytes() for path in FIXTURES.rglob("*.json")]
+    dictionary = zstd.train_dictionary(16 * 1024, samples * 10)
+    mocker.patch.object(ingest_envelope, "_compression_dict", dictionary)
+    mocker.patch.object(ingest_envelope, "_compressor", None)
+    mocker.patch.object(ingest_envelope, "_decompressor", None)
+
+    body = samples[0]
+    data = ingest_envelope.encode(event_name="status", body=body)
+    _header, _, frame = data.partition(b"\n")
+    assert zstd.get_frame_parameters(frame).dict_id == dictionary.dict_id()
+    assert ingest_envelope.decode(data).payload == json.loads(body)
+
+
+def test_decode_legacy_json() -> None:
+    """
+    We should continue to accept entries queued before the envelope existed.
+    """
+    data = RawWebhookEvent(
+        event_name="push", payload={"installation": {"id": 1234}}
+    ).json()
+    event = ingest_envelope.decode(data.encode())
+    assert event.event_name == "push"
+    assert event.payload == {"installation": {"id": 1234}}
+
+
+@pytest.mark.parametrize(
+    "body, expected",
+    (
+        ({"installation": {"id": 1234, "node_id": "abc"}}, 1234),
+        ({"action": "created", "installation": {"id": 5}, "sender": {}}, 5),
+        # quotes within string values are escaped so we shouldn't match them.
+        (
+            {
+                "pull_request": {"body": '"installation": {"id": 999}'},
+                "installation": {"id": 1234},
+            },
+            1234,
+        ),
+        ({"hello": 123}, None),
+        # the id isn't the first key, so the caller should parse the payload.
+        ({"installation": {"node_id": "abc", "id": 1234}}, None),
+    ),
+)
+def test_find_installation_id(body: dict[str, object], expected: int | None) -> None:
+    assert ingest_envelope.find_installation_id(json.dumps(body).encode()) == expected
@@ -0,0 +1,197 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Sequence, Set
+
+import pytest
+from pytest_mock import MockFixture
+
+from kodiak.dispatcher import QueueDispatcher
+from kodiak.leases import (
+    RELEASE_SCRIPT,
+    RENEW_SCRIPT,
+    HashRing,
+    LeaseManager,
+    get_lease_key,
+    get_shard_index,
+    in_worker_shard,
+)
+from kodiak.tests.fixtures import FakeRedis, encode
+
+QUEUE_NAMES = "kodiak_webhook_queue_names"
+
+
+def renew(redis: FakeRedis, keys: Sequence[str], args: Sequence[Any]) -> int:
+    return int(redis.strings.get(keys[0]) == encode(args[0]))
+
+
+def release(redis: FakeRedis, keys: Sequence[str], args: Sequence[Any]) -> int:
+    if redis.strings.get(keys[0]) != encode(args[0]):
+        return 0
+    del redis.strings[keys[0]]
+    return 1
+
+
+def create_fake_redis(queue_names: Set[str]) -> FakeRedis:
+    fake_redis = FakeRedis(scripts={RENEW_SCRIPT: renew, RELEASE_SCRIPT: release})
+    fake_redis.sets[QUEUE_NAMES] = {encode(name) for name in queue_names}
+    return fake_redis
+
+
+async def handler(queue_name: str, value: bytes, score: float) -> None:
+    pass
+
+
+def create_lease_manager(
+    *, lease_ttl_sec: float = 10, heartbeat_interval_sec: float = 2
+) -> LeaseManager:
+    return LeaseManager(
+        dispatcher=QueueDispatcher(),
+        handler_for=lambda _: handler,
+        queue_name_sets=[QUEUE_NAMES],
+        lease_ttl_sec=lease_ttl_sec,
+        heartbeat_interval_sec=heartbeat_interval_sec,
+    )
+
+
+@pytest.fixture
+def queue_names() -> Set[str]:
+    names = set()
+    for installation in range(50):
+        names.add(f"webhook:{installation}")
+        names.add(f"merge_queue:{installation}.chdsbd/kodiak/main")
+    return names
+
+
+def test_hash_ring_stable() -> None:
+    """
+    Removing a worker should only move that worker's keys.
+    """
+    ring = HashRing(["worker-a", "worker-b", "worker-c"])
+    smaller_ring = HashRing(["worker-a", "worker-b"])
+    keys = [str(installation) for installation in range(1_000)]
+    owners = {key: ring.owner(key) for key in keys}
+
+    assert set(owners.values()) == {"worker-a", "worker-b", "worker-c"}
+    for key, owner in owners.items():
+        if owner != "worker-c":
+            assert smaller_ring.owner(key) == owner
+    assert HashRing([]).owner("1234") is None
+
+
+async def test_lease_manager_partitions_queues(
+    mocker: MockFixture, queue_names: Set[str]
+) -> None:
+    """
+    Every queue should be leased by exactly one worker, and a worker's queues
+    should be claimed by the other workers when it shuts down.
+    """
+    fake_redis = create_fake_redis(queue_names)
+    mocker.patch("kodiak.leases.redis_bot", fake_redis)
+    worker_a = create_lease_manager()
+    worker_b = create_lease_manager()
+
+    await worker_a.heartbeat()
+    assert set(worker_a.leases) == queue_names, "we're the only worker"
+
+    await worker_b.heartbeat()
+    await worker_a.heartbeat()
+    await worker_b.heartbeat()
+    assert worker_a.leases.keys() | worker_b.leases.keys() == queue_names
+    assert worker_a.leases.keys() & worker_b.leases.keys() == set()
+    assert worker_a.leases and worker_b.leases
+    assert set(worker_a.dispatcher.handlers) == set(worker_a.leases)
+    assert worker_a.released == len(worker_b.leases)
+    for queue_name in worker_b.leases:
+        assert (
+            fake_redis.strings[get_lease_key(queue_name)] == worker_b.worker_id.encode()
+        )
+        assert not worker_a.owns(queue_name)
+    # an installation's queues should be on the same worker.
+    assert worker_a.owns("webhook:7") == worker_a.owns(
+        "merge_queue:7.chdsbd/kodiak/main"
+    )
+
+    await worker_b.close()
+    await worker_a.heartbeat()
+    assert set(worker_a.leases) == queue_names
+
+
+async def test_lease_manager_lost_lease(
+    mocker: MockFixture, queue_names: Set[str]
+) -> None:
+    """
+    We should stop handling a queue if another worker takes our lease.
+    """
+    fake_redis = create_fake_redis(queue_names)
+    mocker.patch("kodiak.leases.redis_bot", fake_redis)
+    worker = create_lease_manager()
+    await worker.heartbeat()
+    assert worker.owns("webhook:1")
+
+    fake_redis.strings[get_lease_key("webhook:1")] = b"another-worker"
+    await worker.renew()
+
+    assert not worker.owns("webhook:1")
+    assert "webhook:1" not in worker.dispatcher.handlers
+    assert worker.lost == 1
+
+
+async def test_lease_manager_lease_expires(
+    mocker: MockFixture, queue_names: Set[str]
+) -> None:
+    """
+    If we can't renew our leases, we should stop handling their queues once
+    they expire, because another worker may claim them.
+    """
+    fake_redis = create_fake_redis(queue_names)
+    mocker.patch("kodiak.leases.redis_bot", fake_redis)
+    worker = create_lease_manager(lease_ttl_sec=0.1, heartbeat_interval_sec=0.02)
+    await worker.heartbeat()
+    merging: asyncio.Task[None] = asyncio.create_task(asyncio.sleep(60))
+    worker.dispatcher.active["merge_queue:1.chdsbd/kodiak/main"] = merging
+
+    mocker.patch.object(fake_redis, "pipeline", side_effect=ConnectionError)
+    heartbeat = asyncio.create_task(worker.run())
+    await asyncio.sleep(0.2)
+
+    assert merging.cancelled()
+    assert worker.leases == {}
+    assert worker.dispatcher.handlers == {}
+    assert worker.lost == len(queue_names)
+    assert not heartbeat.done(), "the heartbeat should keep retrying"
+    heartbeat.cancel()
+
+
+async def test_lease_manager_track_new_queue(mocker: MockFixture) -> None:
+    """
+    Queues created after startup should be claimed without waiting for the
+    next heartbeat.
+    """
+    fake_redis = create_fake_redis(set())
+    mocker.patch("kodiak.leases.redis_bot", fake_redis)
+    worker = create_lease_manager()
+    await worker.heartbeat()
+
+    worker.track("webhook:1234")
+    await asyncio.gather(*worker._tasks)
+    assert worker.owns("webhook:1234")
+    assert "webhook:1234" in worker.dispatcher.handlers
+    assert worker.acquired == 1
+
+
+def test_in_worker_shard(mocker: MockFixture) -> None:
+    """
+    Every installation should belong to exactly one worker shard.
+    """
+    mocker.patch("kodiak.leases.conf.WORKER_SHARD_COUNT", 4)
+    shards = {get_shard_index(str(installation), 4) for installation in range(100)}
+    assert shards == {0, 1, 2, 3}
+
+    for installation in range(100):
+        owners = []
+        for shard in range(4):
+            mocker.patch("kodiak.leases.conf.WORKER_SHARD_INDEX", shard)
+            if in_worker_shard(str(installation)):
+                owners.append(shard)
+        assert len(owners) == 1
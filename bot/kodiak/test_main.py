@@ -11,9 +11,13 @@ from pytest_mock import MockFixture
 from starlette import status
 from starlette.testclient import TestClient
 
-from kodiak import app_config as conf
+from kodiak import (
+    app_config as conf,
+    ingest_envelope,
+)
 from kodiak.entrypoints.ingest import app
 from kodiak.test_events import MAPPING
+from kodiak.tests.fixtures import FakeRedis
 
 
 def test_root(client: TestClient) -> None:
@@ -35,26 +39,6 @@ def get_body_and_hash(data: Dict[str, Any]) -> Tuple[bytes, str]:
     return body, sha
 
 
-class FakeRedis:
-    def __init__(self) -> None:
-        self.called_rpush_cnt = 0
-        self.called_ltrim_cnt = 0
-        self.called_sadd_cnt = 0
-        self.called_publish_cnt = 0
-
-    async def rpush(self, key: str, events: list[object]) -> None:
-        self.called_rpush_cnt += 1
-
-    async def ltrim(self, key: str, start: int, end: int) -> None:
-        self.called_ltrim_cnt += 1
-
-    async def sadd(self, key: str, values: list[str]) -> None:
-        self.called_sadd_cnt += 1
-
-    async def publish(self, channel: str, message: str) -> None:
-        self.called_publish_cnt += 1
-
-
 @pytest.mark.parametrize("event_name", (event_name for event_name, _schema in MAPPING))
 def test_webhook_event(
     client: TestClient, event_name: str, mocker: MockFixture
@@ -71,16 +55,21 @@ def test_webhook_event(
 
         body, sha = get_body_and_hash(data)
 
-        assert fake_redis.called_rpush_cnt == index
+        assert len(fake_redis.called("rpush")) == index
         res = client.post(
             "/api/github/hook",
             data=body,
             headers={"X-Github-Event": event_name, "X-Hub-Signature": sha},
         )
         assert res.status_code == status.HTTP_200_OK
-        assert fake_redis.called_rpush_cnt == index + 1
+        assert len(fake_redis.called("rpush")) == index + 1
+        queued_event = ingest_envelope.decode(fake_redis.called("rpush")[-1][1])
+        assert queued_event.event_name == event_name
+        assert queued_event.payload == data
 
-    assert fake_redis.called_rpush_cnt == fake_redis.called_ltrim_cnt
+    assert len(fake_redis.called("rpush")) == len(fake_redis.called("ltrim"))
+    # each webhook should be queued with a single round trip to Redis.
+    assert len(fake_redis.called("rpush")) == fake_redis.executed
 
 
 def test_webhook_event_missing_github_event(
@@ -92,10 +81,10 @@ def test_webhook_event_missing_github_event(
 
     body, sha = get_body_and_hash(data)
 
-    assert fake_redis.called_rpush_cnt == 0
+    assert len(fake_redis.called("rpush")) == 0
     res = client.post("/api/github/hook", data=body, headers={"X-Hub-Signature": sha})
     assert res.status_code == status.HTTP_400_BAD_REQUEST
-    assert fake_redis.called_rpush_cnt == 0
+    assert len(fake_redis.called("rpush")) == 0
 
 
 def test_webhook_event_invalid_signature(
@@ -108,11 +97,11 @@ def test_webhook_event_invalid_signature(
     # use a different dict for the signature so we get an signature mismatch
     _, sha = get_body_and_hash({})
 
-    assert fake_redis.called_rpush_cnt == 0
+    assert len(fake_redis.called("rpush")) == 0
     res = client.post(
         "/api/github/hook",
         json=data,
         headers={"X-Github-Event": "content_reference", "X-Hub-Signature": sha},
     )
     assert res.status_code == status.HTTP_400_BAD_REQUEST
-    assert fake_redis.called_rpush_cnt == 0
+    assert len(fake_redis.called("rpush")) == 0
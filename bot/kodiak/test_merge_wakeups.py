@@ -0,0 +1,31 @@
+from __future__ import annotations
+
+from kodiak.merge_wakeups import MergeWakeups
+
+MEMBER = '["1","chdsbd","kodiak",1,"main"]'
+
+
+async def test_merge_wakeup() -> None:
+    """
+    Events that arrive between waits should wake the next wait.
+    """
+    wakeups = MergeWakeups()
+    async with wakeups.watch(MEMBER) as wakeup:
+        assert not await wakeup.wait(timeout=0.01)
+        wakeups.notify(MEMBER)
+        wakeups.notify(MEMBER)
+        assert await wakeup.wait(timeout=0.01)
+        assert not await wakeup.wait(timeout=0.01)
+        assert wakeup.wakeups == 1
+    assert wakeups.waiters == {}
+
+
+async def test_merge_wakeup_other_member() -> None:
+    """
+    Events for other pull requests shouldn't wake us.
+    """
+    wakeups = MergeWakeups()
+    wakeups.notify(MEMBER)
+    async with wakeups.watch(MEMBER) as wakeup:
+        wakeups.notify('["1","chdsbd","kodiak",2,"main"]')
+        assert not await wakeup.wait(timeout=0.01)
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import asyncio
 from typing import (
     Any,
     Awaitable,
@@ -13,13 +14,21 @@ from typing import (
 )
 
 import pytest
+import structlog
+from pytest_mock import MockFixture
 from typing_extensions import Protocol
 
 import kodiak.http as requests
 from kodiak.config import V1, Merge, MergeMethod
 from kodiak.errors import ApiCallException
 from kodiak.http import Request
-from kodiak.pull_request import PRV2, EventInfoResponse, QueueForMergeCallback
+from kodiak.pull_request import (
+    PRV2,
+    EventInfoResponse,
+    QueueForMergeCallback,
+    RequeueCallback,
+    evaluate_pr,
+)
 from kodiak.queries import (
     BranchProtectionRule,
     Client,
@@ -32,6 +41,7 @@ from kodiak.queries import (
     RepoInfo,
     ReviewThreadConnection,
 )
+from kodiak.retry import Backoff, RetryPolicy
 
 
 def create_event() -> EventInfoResponse:
@@ -262,6 +272,7 @@ async def test_pr_v2_merge() -> None:
     pr_v2 = create_prv2(client=client)
     await pr_v2.merge("squash", commit_title="my title", commit_message="my message")
     assert client.merge_pull_request.call_count == 1
+    assert pr_v2.changed_branch
 
 
 async def test_pr_v2_merge_rebase_error() -> None:
@@ -315,6 +326,7 @@ async def test_pr_v2_update_branch_ok() -> None:
     await pr_v2.update_branch()
     assert client.update_branch.call_count == 1
     assert client.update_branch.calls[0]["pull_number"] == pr_v2.number
+    assert pr_v2.changed_branch
 
 
 async def test_pr_v2_update_branch_service_unavailable() -> None:
@@ -429,3 +441,80 @@ async def test_update_ref_service_unavailable() -> None:
     assert e.value.method == "pull_request/update_ref"
     assert e.value.status_code == 503
     assert b"Service Unavailable" in e.value.response
+
+
+async def run_evaluate_pr(
+    requeue_callback: RequeueCallback = noop,
+) -> None:
+    await evaluate_pr(
+        install="88443234",
+        owner="delos",
+        repo="incite",
+        number=8634,
+        merging=False,
+        dequeue_callback=noop,
+        requeue_callback=requeue_callback,
+        queue_for_merge_callback=noop,
+        is_active_merging=False,
+        log=structlog.get_logger(),
+    )
+
+
+async def test_evaluate_pr_timeout_requeues_with_delay(mocker: MockFixture) -> None:
+    """
+    On a timeout we should requeue the pull request with a backoff instead of
+    sleeping in the queue consumer.
+    """
+    get_pr = mocker.patch(
+        "kodiak.pull_request.get_pr", side_effect=asyncio.TimeoutError
+    )
+    sleep = mocker.patch("kodiak.pull_request.asyncio.sleep")
+    delays: List[float] = []
+
+    async def requeue(*, delay: float = 0) -> None:
+        delays.append(delay)
+
+    await run_evaluate_pr(requeue_callback=requeue)
+
+    assert get_pr.call_count == 1
+    assert len(delays) == 1
+    assert delays[0] > 0
+    assert sleep.call_count == 0
+
+
+async def test_evaluate_pr_retry_budget_exhausted(mocker: MockFixture) -> None:
+    """
+    When the installation is out of retries we should report the API error
+    with the pull request we already fetched, without retrying.
+    """
+    mocker.patch(
+        "kodiak.pull_request.retry_policy",
+        RetryPolicy(
+            backoff=Backoff(base_sec=1, max_sec=8),
+            budget_per_minute=0,
+            failure_threshold=100,
+            open_sec=60,
+        ),
+    )
+    pr = create_prv2()
+    get_pr = mocker.patch("kodiak.pull_request.get_pr", return_value=pr)
+    mergeable = mocker.patch(
+        "kodiak.pull_request.mergeable",
+        side_effect=[
+            ApiCallException(
+                method="pull_request/merge", http_status_code=503, response=b""
+            ),
+            None,
+        ],
+    )
+    sleep = mocker.patch("kodiak.pull_request.asyncio.sleep")
+
+    await run_evaluate_pr()
+
+    assert get_pr.call_count == 2
+    assert get_pr.call_args_list[0].kwargs["event"] is None
+    assert get_pr.call_args_list[1].kwargs["event"] is pr.event
+    assert mergeable.call_count == 2
+    assert mergeable.call_args.kwargs["api_call_retries_remaining"] == 0
+    assert len(mergeable.call_args.kwargs["api_call_errors"]) == 1
+    assert sleep.call_count == 0
@@ -2,17 +2,25 @@ import asyncio
 import json
 import logging
 import re
-from datetime import datetime
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
-from typing import Any, AsyncGenerator, Dict, Iterable, Iterator, cast
+from types import SimpleNamespace
+from typing import Any, AsyncGenerator, Dict, Iterable, Iterator, List, Optional, cast
 
 import pytest
 from pytest_mock import MockFixture
 
-from kodiak import app_config as conf
+from kodiak import (
+    app_config as conf,
+    queries,
+)
 from kodiak.config import V1, Merge, MergeMethod
+from kodiak.config_cache import ConfigCache
 from kodiak.http import Request, Response
 from kodiak.queries import (
+    ApiFeatures,
+    ApiFeaturesRegistry,
     BranchProtectionRule,
     BypassActor,
     CheckConclusionState,
@@ -21,6 +29,7 @@ from kodiak.queries import (
     Commit,
     EventInfoResponse,
     GraphQLResponse,
+    InstallationTokenManager,
     MergeableState,
     MergeStateStatus,
     NodeListPushAllowance,
@@ -34,6 +43,7 @@ from kodiak.queries import (
     PullRequestState,
     PushAllowance,
     PushAllowanceActor,
+    QueryProfile,
     RepoInfo,
     RepositoryRuleset,
     RepositoryRulesetBypassActor,
@@ -47,7 +57,10 @@ from kodiak.queries import (
     StatusContext,
     StatusState,
     Subscription,
+    get_api_features_key,
+    get_api_host,
     get_commits,
+    invalidate_open_pull_requests,
 )
 from kodiak.queries.commits import CommitConnection, GitActor
 from kodiak.redis_client import redis_bot
@@ -65,6 +78,9 @@ def api_client(mocker: MockFixture, github_installation_id: str) -> Client:
     mocker.patch(
         "kodiak.queries.get_thottler_for_installation", return_value=FakeThottler()
     )
+    mocker.patch("kodiak.queries.open_pull_requests_cache", OrderedDict())
+    mocker.patch("kodiak.queries.api_features_registry", ApiFeaturesRegistry())
+    mocker.patch("kodiak.queries.query_profiles", OrderedDict())
     client = Client(installation_id=github_installation_id, owner="foo", repo="foo")
     mocker.patch.object(client, "send_query")
     return client
@@ -890,16 +906,25 @@ def test_get_commits_error_handling_missing_response() -> None:
     assert res == []
 
 
-def generate_page_of_prs(numbers: Iterable[int]) -> Response:
+def generate_page_of_prs(
+    numbers: Iterable[int], last_page: Optional[int] = None
+) -> Response:
     """
     Create a fake page for the list-pull-requests API.
 
     This is used by get_open_pull_requests.
     """
     prs = [{"number": number, "base": {"ref": "main"}} for number in numbers]
+    headers = {}
+    if last_page is not None:
+        headers["Link"] = (
+            f'<https://api.github.com/repositories/1234/pulls?page=2>; rel="next", '
+            f'<https://api.github.com/repositories/1234/pulls?page={last_page}>; rel="last"'
+        )
     return Response(
         status_code=200,
         content=json.dumps(prs).encode(),
+        headers=headers,
         request=Request(method="", url=""),
     )
 
@@ -908,15 +933,15 @@ async def test_get_open_pull_requests(
     mocker: MockFixture, api_client: Client, mock_get_token_for_install: None
 ) -> None:
     """
-    We should stop calling the API after reaching an empty page.
+    We should fetch the pages listed in the Link header without requesting an
+    empty page.
     """
     patched_session_get = mocker.patch(
         "kodiak.queries.http.AsyncClient.get",
         side_effect=[
-            wrap_future(generate_page_of_prs(range(1, 101))),
+            wrap_future(generate_page_of_prs(range(1, 101), last_page=3)),
             wrap_future(generate_page_of_prs(range(101, 201))),
             wrap_future(generate_page_of_prs(range(201, 251))),
-            wrap_future(generate_page_of_prs([])),
         ],
     )
 
@@ -925,7 +950,30 @@ async def test_get_open_pull_requests(
 
     assert res is not None
     assert len(res) == 250
-    assert patched_session_get.call_count == 4
+    assert [pr.number for pr in res] == list(range(1, 251))
+    assert patched_session_get.call_count == 3
+    assert [
+        call.kwargs["params"]["page"] for call in patched_session_get.call_args_list
+    ] == ["1", "2", "3"]
+
+
+async def test_get_open_pull_requests_single_page(
+    mocker: MockFixture, api_client: Client, mock_get_token_for_install: None
+) -> None:
+    """
+    A response without a Link header is the only page.
+    """
+    patched_session_get = mocker.patch(
+        "kodiak.queries.http.AsyncClient.get",
+        side_effect=[wrap_future(generate_page_of_prs(range(1, 5)))],
+    )
+
+    async with api_client as api_client:
+        res = await api_client.get_open_pull_requests(base="main")
+
+    assert res is not None
+    assert len(res) == 4
+    assert patched_session_get.call_count == 1
 
 
 async def test_get_open_pull_requests_page_limit(
@@ -938,7 +986,9 @@ async def test_get_open_pull_requests_page_limit(
     assert len(pages) == 30
     patched_session_get = mocker.patch(
         "kodiak.queries.http.AsyncClient.get",
-        side_effect=[wrap_future(generate_page_of_prs(p)) for p in pages],
+        side_effect=[
+            wrap_future(generate_page_of_prs(p, last_page=len(pages))) for p in pages
+        ],
     )
 
     async with api_client as api_client:
@@ -946,3 +996,361 @@ async def test_get_open_pull_requests_page_limit(
     assert res is not None
     assert len(res) == 2000
     assert patched_session_get.call_count == 20, "stop calling after 20 pages"
+
+
+async def test_get_open_pull_requests_cache(
+    mocker: MockFixture, api_client: Client, mock_get_token_for_install: None
+) -> None:
+    """
+    Listings should be cached per base and head until they're invalidated.
+    """
+    patched_session_get = mocker.patch(
+        "kodiak.queries.http.AsyncClient.get",
+        side_effect=lambda *_args, **_kwargs: wrap_future(generate_page_of_prs([1, 2])),
+    )
+
+    async with api_client as api_client:
+        assert await api_client.get_open_pull_requests(base="main") is not None
+        assert await api_client.get_open_pull_requests(base="main") is not None
+        assert patched_session_get.call_count == 1
+        await api_client.get_open_pull_requests(head="foo:feature")
+        assert patched_session_get.call_count == 2
+
+        invalidate_open_pull_requests(
+            installation_id=api_client.installation_id,
+            owner=api_client.owner,
+            repo=api_client.repo,
+        )
+        res = await api_client.get_open_pull_requests(base="main")
+        assert patched_session_get.call_count == 3
+    assert res is not None
+    assert [pr.number for pr in res] == [1, 2]
+
+
+async def test_get_open_pull_requests_cache_bounded(
+    mocker: MockFixture, api_client: Client, mock_get_token_for_install: None
+) -> None:
+    """
+    Expired listings and the least recently used repositories should be
+    dropped, so the cache doesn't grow without bound.
+    """
+    mocker.patch(
+        "kodiak.queries.http.AsyncClient.get",
+        side_effect=lambda *_args, **_kwargs: wrap_future(generate_page_of_prs([1, 2])),
+    )
+    mocker.patch("kodiak.queries.conf.OPEN_PULL_REQUESTS_CACHE_SIZE", 2)
+    repo_key = (api_client.installation_id, api_client.owner, api_client.repo)
+
+    async with api_client as api_client:
+        await api_client.get_open_pull_requests(head="foo:feature-1")
+        queries.open_pull_requests_cache[repo_key][
+            (None, "foo:feature-1")
+        ].expires_at = 0
+        await api_client.get_open_pull_requests(head="foo:feature-2")
+    assert list(queries.open_pull_requests_cache[repo_key]) == [(None, "foo:feature-2")]
+
+    for repo in ["bar", "baz"]:
+        async with Client(
+            installation_id=api_client.installation_id, owner="foo", repo=repo
+        ) as other_client:
+            await other_client.get_open_pull_requests(base="main")
+    assert repo_key not in queries.open_pull_requests_cache
+    assert len(queries.open_pull_requests_cache) == 2
+
+
+def generate_token_response(expires_in: timedelta) -> Response:
+    return Response(
+        status_code=201,
+        content=json.dumps(
+            dict(
+                token="v1.installation-token",
+                expires_at=(datetime.now(timezone.utc) + expires_in).isoformat(),
+            )
+        ).encode(),
+        request=Request(method="", url=""),
+    )
+
+
+@pytest.fixture
+def token_manager(mocker: MockFixture) -> InstallationTokenManager:
+    mocker.patch("kodiak.queries.installation_cache", {})
+    mocker.patch(
+        "kodiak.queries.get_thottler_for_installation", return_value=FakeThottler()
+    )
+    mocker.patch("kodiak.queries.generate_jwt", return_value="app-jwt")
+    return InstallationTokenManager()
+
+
+async def test_token_manager_singleflight(
+    mocker: MockFixture, token_manager: InstallationTokenManager
+) -> None:
+    """
+    Concurrent requests for a token should share one API call and the app JWT
+    should be reused between installations.
+    """
+    session = mocker.AsyncMock()
+    session.post.side_effect = lambda *_args, **_kwargs: wrap_future(
+        generate_token_response(timedelta(hours=1))
+    )
+
+    tokens = await asyncio.gather(
+        *(
+            token_manager.get_token(session=session, installation_id="1234")
+            for _ in range(10)
+        ),
+        token_manager.get_token(session=session, installation_id="5678"),
+    )
+
+    assert set(tokens) == {"v1.installation-token"}
+    assert session.post.call_count == 2
+    assert token_manager.fetches == 2
+    assert cast(Any, queries.generate_jwt).call_count == 1
+    assert token_manager.pending == {}
+
+
+async def test_token_manager_background_refresh(
+    mocker: MockFixture, token_manager: InstallationTokenManager
+) -> None:
+    """
+    A token close to expiry should be returned immediately and refreshed in
+    the background.
+    """
+    session = mocker.AsyncMock()
+    session.post.side_effect = [
+        wrap_future(generate_token_response(timedelta(minutes=10))),
+        wrap_future(generate_token_response(timedelta(hours=1))),
+    ]
+    await token_manager.get_token(session=session, installation_id="1234")
+    assert session.post.call_count == 1
+
+    token = await token_manager.get_token(session=session, installation_id="1234")
+    assert token == "v1.installation-token"
+    assert "1234" in token_manager.pending, "refresh should start in the background"
+    refresh = token_manager.pending["1234"]
+    await refresh
+    assert session.post.call_count == 2
+    assert not refresh.result().needs_refresh
+    assert token_manager.pending == {}
+
+    await token_manager.get_token(session=session, installation_id="1234")
+    assert session.post.call_count == 2
+
+
+@pytest.mark.parametrize(
+    "base_ref, expected_queries",
+    [("master", [2, 1]), ("some-old-base", [2, 2]), (None, [2, 2])],
+)
+async def test_get_event_info_config_in_event_query(
+    api_client: Client,
+    mocker: MockFixture,
+    base_ref: Optional[str],
+    expected_queries: List[int],
+) -> None:
+    """
+    When we know the base ref of the pull request, we should fetch the config
+    blob oid with the event info query and only download the config if we
+    haven't cached it. If the pull request has been retargeted, we need
+    another query for the config.
+    """
+    mocker.patch.object(api_client, "get_api_features", return_value=None)
+    mocker.patch.object(api_client, "get_subscription", return_value=None)
+    mocker.patch("kodiak.queries.config_cache", ConfigCache(max_size=10))
+    response = json.loads(
+        (
+            Path(__file__).parent
+            / "test"
+            / "fixtures"
+            / "api"
+            / "get_event"
+            / "no_author.json"
+        ).read_text()
+    )
+    response["data"]["repository"]["rootConfigFile"]["oid"] = (
+        "3b18e512dba79e4c8300dd08aeb37f8e728b8dad"
+    )
+
+    for expected in expected_queries:
+        send_query = mocker.patch.object(
+            api_client,
+            "send_query",
+            return_value=GraphQLResponse(data=response["data"]),
+        )
+
+        res = await api_client.get_event_info(pr_number=100, base_ref=base_ref)
+
+        assert res is not None
+        assert res.config_file_expression == "master:.kodiak.toml"
+        assert isinstance(res.config, V1)
+        assert send_query.call_count == expected
+        event_info_query = send_query.call_args_list[0].kwargs
+        assert ("rootConfigFile" in event_info_query["query"]) == (base_ref is not None)
+        if base_ref is not None:
+            assert (
+                event_info_query["variables"]["rootConfigFileExpression"]
+                == f"{base_ref}:.kodiak.toml"
+            )
+
+
+async def test_get_event_info_many(api_client: Client, mocker: MockFixture) -> None:
+    """
+    We should fetch many pull requests with one query using aliases and skip
+    the pull requests we couldn't find.
+    """
+    mocker.patch.object(api_client, "get_api_features", return_value=None)
+    mocker.patch.object(api_client, "get_subscription", return_value=None)
+    mocker.patch("kodiak.queries.config_cache", ConfigCache(max_size=10))
+    response = json.loads(
+        (
+            Path(__file__).parent
+            / "test"
+            / "fixtures"
+            / "api"
+            / "get_event"
+            / "no_author.json"
+        ).read_text()
+    )
+    repository = response["data"]["repository"]
+    repository["rootConfigFile"]["oid"] = "3b18e512dba79e4c8300dd08aeb37f8e728b8dad"
+    pull_request = repository.pop("pullRequest")
+    repository["pr0"] = pull_request
+    repository["pr1"] = json.loads(json.dumps(pull_request))
+    repository["pr2"] = None
+    send_query = mocker.patch.object(
+        api_client, "send_query", return_value=GraphQLResponse(data=response["data"])
+    )
+
+    res = await api_client.get_event_info_many([100, 101, 102], base_ref="master")
+
+    assert sorted(res) == [100, 101]
+    assert res[101].pull_request.number == 101
+    assert res[100].config_file_expression == "master:.kodiak.toml"
+    # the second query downloads the config, which is cached for the other
+    # pull requests.
+    assert send_query.call_count == 2
+    event_info_query = send_query.call_args_list[0].kwargs
+    assert "pr2: pullRequest(number: $pr2)" in event_info_query["query"]
+    assert event_info_query["variables"]["pr1"] == 101
+
+
+async def test_get_event_info_query_profile(
+    api_client: Client, mocker: MockFixture, github_installation_id: str
+) -> None:
+    """
+    We should only request the edges the last evaluation for the base ref
+    needed and refetch when the config or branch rules need more.
+    """
+    mocker.patch.object(api_client, "get_api_features", return_value=None)
+    mocker.patch.object(api_client, "get_subscription", return_value=None)
+    mocker.patch("kodiak.queries.config_cache", ConfigCache(max_size=10))
+    response = json.loads(
+        (
+            Path(__file__).parent
+            / "test"
+            / "fixtures"
+            / "api"
+            / "get_event"
+            / "no_author.json"
+        ).read_text()
+    )
+    send_query = mocker.patch.object(
+        api_client, "send_query", return_value=GraphQLResponse(data=response["data"])
+    )
+    slim_profile = QueryProfile(
+        commit_authors=False, reviews=False, ruleset_rules=False
+    )
+    key = (github_installation_id, "foo", "foo", "master")
+    queries.query_profiles[key] = slim_profile
+
+    res = await api_client.get_event_info(pr_number=100, base_ref="master")
+
+    assert res is not None
+    # the config doesn't use coauthors or auto approve, but the response
+    # doesn't tell us the base branch has no ruleset rules.
+    required_profile = QueryProfile(
+        commit_authors=False, reviews=False, ruleset_rules=True
+    )
+    assert res.required_query_profile == required_profile
+    assert res.commits == []
+    queries_sent = [call.kwargs["query"] for call in send_query.call_args_list]
+    # the fixture's config blob isn't cached, so we download the config once
+    # and reuse it when we refetch.
+    assert len(queries_sent) == 3
+    first_query, config_query, refetch_query = queries_sent
+    assert config_query == queries.GET_CONFIG_QUERY
+    assert "commitHistory" not in first_query
+    assert "reviews(" not in first_query
+    assert "rules(first: 1)" in first_query
+    assert "rules(first: 100)" in refetch_query
+    assert "commitHistory" not in refetch_query
+    assert queries.query_profiles[key] == required_profile
+
+
+def test_query_profiles_bounded(api_client: Client, mocker: MockFixture) -> None:
+    """
+    Query profiles should be kept for the most recently used base refs only.
+    """
+    mocker.patch("kodiak.queries.conf.QUERY_PROFILE_CACHE_SIZE", 2)
+    slim_profile = QueryProfile(
+        commit_authors=False, reviews=False, ruleset_rules=False
+    )
+    for base_ref in ["main", "next", "main", "release"]:
+        event_info = SimpleNamespace(
+            pull_request=SimpleNamespace(baseRefName=base_ref),
+            required_query_profile=slim_profile,
+        )
+        api_client.set_query_profile(cast(EventInfoResponse, event_info))
+
+    assert api_client.get_query_profile("main") == slim_profile
+    assert api_client.get_query_profile("release") == slim_profile
+    assert api_client.get_query_profile("next") == queries.FULL_QUERY_PROFILE
+    assert len(queries.query_profiles) == 2
+
+
+@requires_redis
+async def test_api_features_registry() -> None:
+    """
+    Concurrent misses should share one introspection query and the result
+    should be shared with other processes through Redis.
+    """
+    await redis_bot.delete(get_api_features_key(get_api_host()))
+    calls = 0
+
+    async def fetch() -> ApiFeatures:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0)
+        return ApiFeatures(requires_conversation_resolution=True)
+
+    registry = ApiFeaturesRegistry()
+    features = await asyncio.gather(*(registry.get(fetch) for _ in range(5)))
+    assert features == [ApiFeatures(requires_conversation_resolution=True)] * 5
+    assert calls == 1
+    assert registry.pending == {}
+
+    restarted = ApiFeaturesRegistry()
+    await restarted.warm()
+    assert await restarted.get(fetch) == ApiFeatures(
+        requires_conversation_resolution=True
+    )
+    assert calls == 1
+    await redis_bot.delete(get_api_features_key(get_api_host()))
+    await redis_bot.close()
+
+
+@requires_redis
+async def test_api_features_registry_caches_errors() -> None:
+    """
+    A failed introspection query shouldn't be retried on every event.
+    """
+    await redis_bot.delete(get_api_features_key(get_api_host()))
+    calls = 0
+
+    async def fetch() -> None:
+        nonlocal calls
+        calls += 1
+
+    registry = ApiFeaturesRegistry()
+    assert await registry.get(fetch) is None
+    assert await registry.get(fetch) is None
+    assert calls == 1
+    await redis_bot.close()
@@ -1,6 +1,23 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Dict, List, Optional
+
 import pytest
+import structlog
+from pytest_mock import MockFixture
 
-from kodiak.queue import installation_id_from_queue
+from kodiak.queue import (
+    RedisWebhookQueue,
+    WebhookEvent,
+    installation_id_from_queue,
+    process_repo_queue,
+    webhook_event_consumer,
+)
+from kodiak.redis_client import redis_bot
+from kodiak.supervisor import TaskSupervisor
+from kodiak.test_utils import wrap_future
+from kodiak.tests.fixtures import FakeRedis, requires_redis
 
 
 @pytest.mark.parametrize(
@@ -20,3 +37,232 @@ def test_installation_id_from_queue(
     We should gracefully parse an installation id from the queue name
     """
     assert installation_id_from_queue(queue_name) == expected_installation_id
+
+
+def create_event(number: int) -> WebhookEvent:
+    return WebhookEvent(
+        repo_owner="chdsbd",
+        repo_name="kodiak",
+        pull_request_number=number,
+        installation_id="1234",
+        target_name="main",
+    )
+
+
+async def test_enqueue_for_repo_position(mocker: MockFixture) -> None:
+    """
+    We should find the position of the event in the merge queue with ZRANK
+    instead of fetching the queue.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.queue.redis_bot", fake_redis)
+    queue = RedisWebhookQueue(TaskSupervisor())
+    mocker.patch.object(queue, "start_repo_worker")
+
+    assert await queue.enqueue_for_repo(event=create_event(1), first=False) == 0
+    assert await queue.enqueue_for_repo(event=create_event(2), first=False) == 1
+    assert await queue.enqueue_for_repo(event=create_event(3), first=True) == 0
+    assert await queue.enqueue_for_repo(event=create_event(2), first=False) == 2
+
+
+def test_webhook_event_member() -> None:
+    """
+    We should store a compact encoding of the event in our queues.
+    """
+    event = create_event(123)
+    assert event.member() == '["1234","chdsbd","kodiak",123,"main"]'
+    assert event.member() is event.member(), "we should only encode once"
+    assert "_member" not in event.json()
+
+    parsed = WebhookEvent.parse_member(event.member().encode())
+    assert parsed == event
+    assert parsed.member() == event.member()
+
+
+def test_webhook_event_parse_member_legacy() -> None:
+    """
+    We should parse events queued with the old JSON object encoding.
+    """
+    event = create_event(123)
+    legacy = event.json().encode()
+    assert legacy.startswith(b"{")
+    parsed = WebhookEvent.parse_member(legacy)
+    assert parsed == event
+    assert parsed.member() == event.member()
+
+
+@requires_redis
+async def test_process_repo_queue_cancelled(mocker: MockFixture) -> None:
+    """
+    If merging is cancelled, e.g. because we lost the queue's lease, we should
+    clear the target marker so the next worker can merge.
+    """
+    event = create_event(123)
+    target_name = event.get_merge_target_queue_name()
+    started = asyncio.Event()
+
+    async def evaluate_pr(**kwargs: Any) -> None:
+        started.set()
+        await asyncio.sleep(60)
+
+    mocker.patch("kodiak.queue.evaluate_pr", evaluate_pr)
+    task = asyncio.create_task(
+        process_repo_queue(structlog.get_logger(), event.member().encode(), 1.0)
+    )
+    await asyncio.wait_for(started.wait(), timeout=1)
+    assert await redis_bot.get(target_name) == event.member().encode()
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert await redis_bot.exists(target_name, target_name + ":time") == 0
+    await redis_bot.close()
+
+
+class BatchFixture:
+    """
+    Evaluate a batch of three related webhook events, recording the prefetched
+    event info each evaluation receives.
+    """
+
+    def __init__(self, mocker: MockFixture) -> None:
+        self.events = [create_event(1), create_event(2), create_event(3)]
+        self.queue_name = self.events[0].get_webhook_queue_name()
+        self.evaluated: List[Optional[object]] = []
+        self.changed_branch = {1: False, 2: False, 3: False}
+        mocker.patch(
+            "kodiak.queue.pop_related_webhook_events",
+            return_value=wrap_future(self.events[1:]),
+        )
+        mocker.patch("kodiak.queue.process_webhook_event", self.process_webhook_event)
+        client = mocker.patch("kodiak.queue.Client")
+        self.get_event_info_many = (
+            client.return_value.__aenter__.return_value.get_event_info_many
+        )
+
+    async def process_webhook_event(
+        self,
+        webhook_queue: object,
+        webhook_event: WebhookEvent,
+        log: object,
+        event_info: Optional[object] = None,
+    ) -> bool:
+        self.evaluated.append(event_info)
+        return self.changed_branch[webhook_event.pull_request_number]
+
+    async def run(self) -> None:
+        await webhook_event_consumer(
+            RedisWebhookQueue(TaskSupervisor()),
+            self.queue_name,
+            self.events[0].member().encode(),
+            1.0,
+        )
+
+
+async def test_webhook_event_consumer_batch_fetch_failed(
+    mocker: MockFixture,
+) -> None:
+    """
+    If we can't fetch the batch, each pull request should be fetched when it's
+    evaluated.
+    """
+    batch = BatchFixture(mocker)
+    batch.get_event_info_many.side_effect = ConnectionError
+
+    await batch.run()
+
+    assert batch.evaluated == [None, None, None]
+
+
+async def test_webhook_event_consumer_refetch_after_branch_change(
+    mocker: MockFixture,
+) -> None:
+    """
+    After an evaluation merges or updates a branch, the prefetched info for the
+    rest of the batch is stale, so we should fetch it again.
+    """
+    batch = BatchFixture(mocker)
+    batch.changed_branch[1] = True
+    batch.get_event_info_many.side_effect = [
+        wrap_future({1: "info 1", 2: "stale info 2", 3: "stale info 3"}),
+        wrap_future({2: "info 2", 3: "info 3"}),
+    ]
+
+    await batch.run()
+
+    assert batch.evaluated == ["info 1", "info 2", "info 3"]
+    assert batch.get_event_info_many.call_count == 2
+    assert batch.get_event_info_many.call_args[0][0] == [2, 3]
+
+
+@requires_redis
+async def test_webhook_event_consumer_cancelled(mocker: MockFixture) -> None:
+    """
+    If the batch is cancelled, we should put the related events we haven't
+    finished back on the queue. The dispatcher puts back the popped event.
+    """
+    batch = BatchFixture(mocker)
+    batch.get_event_info_many.return_value = wrap_future({})
+    started = asyncio.Event()
+
+    async def process_webhook_event(
+        webhook_queue: object,
+        webhook_event: WebhookEvent,
+        log: object,
+        event_info: Optional[object] = None,
+    ) -> bool:
+        if webhook_event.pull_request_number == 2:
+            started.set()
+            await asyncio.sleep(60)
+        return False
+
+    mocker.patch("kodiak.queue.process_webhook_event", process_webhook_event)
+    await redis_bot.delete(batch.queue_name)
+    task = asyncio.create_task(batch.run())
+    await asyncio.wait_for(started.wait(), timeout=1)
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert await redis_bot.zrange(batch.queue_name, 0, -1) == [
+        batch.events[1].member().encode(),
+        batch.events[2].member().encode(),
+    ]
+    await redis_bot.delete(batch.queue_name)
+    await redis_bot.close()
+
+
+@requires_redis
+async def test_webhook_event_consumer_cancelled_during_fetch(
+    mocker: MockFixture,
+) -> None:
+    """
+    If the batch is cancelled while we fetch its pull requests, we should put
+    the related events back on the queue.
+    """
+    batch = BatchFixture(mocker)
+    started = asyncio.Event()
+
+    async def get_event_info_many(*args: object, **kwargs: object) -> Dict[int, Any]:
+        started.set()
+        await asyncio.sleep(60)
+        return {}
+
+    batch.get_event_info_many.side_effect = get_event_info_many
+    await redis_bot.delete(batch.queue_name)
+    task = asyncio.create_task(batch.run())
+    await asyncio.wait_for(started.wait(), timeout=1)
+
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert batch.evaluated == []
+    assert await redis_bot.zrange(batch.queue_name, 0, -1) == [
+        batch.events[1].member().encode(),
+        batch.events[2].member().encode(),
+    ]
+    await redis_bot.delete(batch.queue_name)
+    await redis_bot.close()
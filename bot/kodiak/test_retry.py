@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import time
+
+from kodiak.retry import Backoff, RetryPolicy
+
+
+def create_policy(*, budget_per_minute: float = 2) -> RetryPolicy:
+    return RetryPolicy(
+        backoff=Backoff(base_sec=1, max_sec=8),
+        budget_per_minute=budget_per_minute,
+        failure_threshold=3,
+        open_sec=60,
+    )
+
+
+def test_backoff_delay() -> None:
+    """
+    Delays should double with each attempt up to the max, with jitter.
+    """
+    backoff = Backoff(base_sec=1, max_sec=8)
+    for attempt, expected in [(0, 1), (1, 2), (2, 4), (3, 8), (10, 8)]:
+        for _ in range(20):
+            assert expected / 2 <= backoff.delay(attempt) <= expected
+
+
+def test_retry_budget() -> None:
+    """
+    Retries should be limited per installation.
+    """
+    policy = create_policy()
+    assert policy.try_acquire_retry("1")
+    assert policy.try_acquire_retry("1")
+    assert not policy.try_acquire_retry("1")
+    assert policy.try_acquire_retry("2")
+
+    # the budget refills over a minute.
+    policy.installations["1"].updated_at -= 30
+    assert policy.try_acquire_retry("1")
+    assert (policy.metrics.retries, policy.metrics.retries_denied) == (4, 1)
+
+
+async def test_circuit_breaker() -> None:
+    """
+    Consecutive failures should open the circuit breaker for an installation.
+    """
+    policy = create_policy()
+    policy.record_failure("1")
+    policy.record_failure("1")
+    policy.record_success("1")
+    policy.record_failure("1")
+    policy.record_failure("1")
+    assert policy.installations["1"].open_until == 0
+
+    policy.record_failure("1")
+    assert policy.installations["1"].open_until > time.monotonic()
+    assert policy.metrics.circuit_opened == 1
+
+    policy.installations["1"].open_until = time.monotonic() + 0.01
+    start = time.monotonic()
+    await policy.wait_until_closed("1")
+    assert time.monotonic() - start >= 0.005
+    await policy.wait_until_closed("2")
@@ -0,0 +1,120 @@
+from __future__ import annotations
+
+from typing import List
+
+from pytest_mock import MockFixture
+
+from kodiak.events import CheckRunEvent, PullRequestEvent, StatusEvent
+from kodiak.queries import GetOpenPullRequestsResponseSchema, HeadRef, Ref
+from kodiak.queue import WebhookEvent, check_run_fork_prs, pr_event, status_event
+from kodiak.test_utils import wrap_future
+from kodiak.tests.fixtures import FakeRedis
+
+SHA = "61e583350f834739f02c8411a9b6f190a1d02724"
+
+
+class FakeQueue:
+    def __init__(self) -> None:
+        self.events: List[WebhookEvent] = []
+
+    async def enqueue(self, *, event: WebhookEvent) -> None:
+        self.events.append(event)
+
+    async def enqueue_for_repo(self, *, event: WebhookEvent, first: bool) -> None:
+        raise NotImplementedError
+
+
+def create_pull_request_event(action: str) -> PullRequestEvent:
+    return PullRequestEvent.parse_obj(
+        {
+            "action": action,
+            "installation": {"id": 1234},
+            "number": 123,
+            "pull_request": {"base": {"ref": "main"}, "head": {"sha": SHA}},
+            "repository": {"name": "kodiak", "owner": {"login": "chdsbd"}},
+        }
+    )
+
+
+EXPECTED_EVENT = WebhookEvent(
+    repo_owner="chdsbd",
+    repo_name="kodiak",
+    pull_request_number=123,
+    target_name="main",
+    installation_id="1234",
+)
+
+
+def create_status_event() -> StatusEvent:
+    return StatusEvent.parse_obj(
+        {
+            "id": 1,
+            "installation": {"id": 1234},
+            "sha": SHA,
+            "branches": [],
+            "repository": {"name": "kodiak", "owner": {"login": "chdsbd"}},
+        }
+    )
+
+
+async def test_status_event_sha_index(mocker: MockFixture) -> None:
+    """
+    Until we've listed the pull requests for a SHA, pull requests we haven't
+    indexed may share it, so we should list them once. Later status events
+    for the SHA shouldn't need any API calls.
+    """
+    mocker.patch("kodiak.sha_index.redis_bot", FakeRedis())
+    client = mocker.patch("kodiak.queue.Client")
+    api_client = client.return_value.__aenter__.return_value
+    # pull request #99 was opened before we started indexing.
+    api_client.get_open_pull_requests.return_value = wrap_future(
+        [
+            GetOpenPullRequestsResponseSchema(
+                number=99, base=Ref(ref="main"), head=HeadRef(sha=SHA)
+            )
+        ]
+    )
+    queue = FakeQueue()
+    await pr_event(queue, create_pull_request_event("synchronize"))
+    queue.events.clear()
+
+    await status_event(queue, create_status_event())
+
+    unindexed_event = EXPECTED_EVENT.copy(update=dict(pull_request_number=99))
+    assert sorted(queue.events, key=lambda e: e.pull_request_number) == [
+        unindexed_event,
+        EXPECTED_EVENT,
+    ]
+    assert api_client.get_open_pull_requests.call_count == 1
+
+    queue.events.clear()
+    await status_event(queue, create_status_event())
+
+    assert queue.events == [unindexed_event, EXPECTED_EVENT]
+    assert api_client.get_open_pull_requests.call_count == 1
+
+
+async def test_check_run_fork_prs(mocker: MockFixture) -> None:
+    """
+    Check runs for fork pull requests have no pull_requests, so we should find
+    them in the index. Closed pull requests should be removed.
+    """
+    mocker.patch("kodiak.sha_index.redis_bot", FakeRedis())
+    queue = FakeQueue()
+    event = CheckRunEvent.parse_obj(
+        {
+            "installation": {"id": 1234},
+            "check_run": {"name": "ci", "head_sha": SHA, "pull_requests": []},
+            "repository": {"id": 1, "name": "kodiak", "owner": {"login": "chdsbd"}},
+        }
+    )
+    await pr_event(queue, create_pull_request_event("opened"))
+    queue.events.clear()
+
+    await check_run_fork_prs(queue, event)
+    assert queue.events == [EXPECTED_EVENT]
+
+    await pr_event(queue, create_pull_request_event("closed"))
+    queue.events.clear()
+    await check_run_fork_prs(queue, event)
+    assert queue.events == []
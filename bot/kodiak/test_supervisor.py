@@ -0,0 +1,82 @@
+from __future__ import annotations
+
+import asyncio
+
+from kodiak.supervisor import TaskSupervisor
+
+
+async def test_supervisor_restarts_failed_task() -> None:
+    """
+    A failed task should be restarted after a backoff.
+    """
+    supervisor = TaskSupervisor(min_backoff_sec=0.01, max_backoff_sec=0.02)
+    calls = 0
+    started = asyncio.Event()
+
+    async def work() -> None:
+        nonlocal calls
+        calls += 1
+        if calls < 3:
+            raise ValueError("boom")
+        started.set()
+        await asyncio.sleep(10)
+
+    supervisor.start("webhook:1234", kind="webhook", factory=work)
+    await asyncio.wait_for(started.wait(), timeout=1)
+
+    assert calls == 3
+    assert supervisor.restarts["webhook"] == 2
+    assert supervisor.live_tasks == 1
+    assert supervisor.tasks["webhook:1234"].consecutive_failures == 2
+    supervisor.cancel()
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert supervisor.live_tasks == 0
+    assert supervisor.tasks == {}
+
+
+async def test_supervisor_backoff() -> None:
+    """
+    Consecutive failures should increase the backoff up to the max.
+    """
+    supervisor = TaskSupervisor(min_backoff_sec=5, max_backoff_sec=12)
+
+    async def work() -> None:
+        raise ValueError("boom")
+
+    supervisor.start("repo:1234", kind="repo", factory=work)
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    supervised = supervisor.tasks["repo:1234"]
+    assert supervised.restart_handle is not None
+    loop = asyncio.get_running_loop()
+    assert supervised.restart_handle.when() - loop.time() > 4
+
+    supervised.consecutive_failures = 10
+    supervised.restart_handle.cancel()
+    supervisor._run("repo:1234")
+    await asyncio.sleep(0)
+    await asyncio.sleep(0)
+    assert supervised.restart_handle is not None
+    assert supervised.restart_handle.when() - loop.time() <= 12
+    assert supervisor.live_tasks == 0
+    supervisor.cancel()
+
+
+async def test_supervisor_start_is_idempotent() -> None:
+    supervisor = TaskSupervisor()
+    calls = 0
+
+    async def work() -> None:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(10)
+
+    supervisor.start("webhook:1234", kind="webhook", factory=work)
+    supervisor.start("webhook:1234", kind="webhook", factory=work)
+    await asyncio.sleep(0)
+
+    assert calls == 1
+    assert supervisor.live_tasks == 1
+    supervisor.cancel()
+    await asyncio.sleep(0)
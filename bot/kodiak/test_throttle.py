@@ -0,0 +1,147 @@
+from __future__ import annotations
+
+import math
+from typing import Any, List, Optional, Sequence
+
+import pytest
+from pytest_mock import MockFixture
+
+from kodiak.http import Request, Response
+from kodiak.tests.fixtures import FakeRedis, encode
+from kodiak.throttle import (
+    ACQUIRE_SCRIPT,
+    BURST,
+    MIN_INTERVAL_MS,
+    UPDATE_SCRIPT,
+    Throttler,
+    get_budget,
+    record_rate_limit,
+)
+
+NOW = 1_600_000_000.0
+
+
+def get_field(redis: FakeRedis, key: str, field: str) -> Optional[float]:
+    value = redis.hashes.get(key, {}).get(field.encode())
+    return float(value) if value is not None else None
+
+
+def set_field(redis: FakeRedis, key: str, field: str, value: float) -> None:
+    redis.hashes.setdefault(key, {})[field.encode()] = encode(value)
+
+
+def acquire(redis: FakeRedis, keys: Sequence[str], args: Sequence[Any]) -> int:
+    now, default_interval, burst = args[0], args[1], args[2]
+    interval = get_field(redis, keys[0], "interval") or default_interval
+    tat = max(get_field(redis, keys[0], "tat") or now, now)
+    set_field(redis, keys[0], "tat", tat + interval)
+    return math.ceil(max(0, tat - interval * burst - now))
+
+
+def update(redis: FakeRedis, keys: Sequence[str], args: Sequence[Any]) -> int:
+    interval, pause_until, burst = args[0], args[1], args[2]
+    set_field(redis, keys[0], "interval", interval)
+    if pause_until > 0:
+        tat = pause_until + interval * burst
+        if tat > (get_field(redis, keys[0], "tat") or 0):
+            set_field(redis, keys[0], "tat", tat)
+    return 1
+
+
+@pytest.fixture
+def sleeps(mocker: MockFixture) -> List[float]:
+    mocker.patch(
+        "kodiak.throttle.redis_bot",
+        FakeRedis(scripts={ACQUIRE_SCRIPT: acquire, UPDATE_SCRIPT: update}),
+    )
+    mocker.patch("kodiak.throttle.time.time", return_value=NOW)
+    sleeps: List[float] = []
+
+    async def sleep(delay: float) -> None:
+        sleeps.append(delay)
+
+    mocker.patch("kodiak.throttle.asyncio.sleep", sleep)
+    return sleeps
+
+
+def create_response(status_code: int = 200, **headers: str) -> Response:
+    return Response(
+        status_code=status_code,
+        headers={key.replace("_", "-"): value for key, value in headers.items()},
+        request=Request(method="GET", url="https://api.github.com/"),
+    )
+
+
+async def test_throttler_burst(sleeps: List[float]) -> None:
+    """
+    After a burst of requests we should sleep until the next slot instead of
+    polling.
+    """
+    throttler = Throttler(installation_id="1234", resource="core")
+    for _ in range(BURST + 1):
+        await throttler.acquire()
+    assert sleeps == []
+
+    await throttler.acquire()
+    await throttler.acquire()
+    assert sleeps == [0.72, 1.44], "default budget is 5000 requests per hour"
+
+
+async def test_throttler_adapts_to_headers(sleeps: List[float]) -> None:
+    """
+    We should spread the remaining budget until the reset.
+    """
+    throttler = Throttler(installation_id="1234", resource="core")
+    await throttler.update(
+        create_response(
+            x_ratelimit_remaining="1000", x_ratelimit_reset=str(int(NOW + 3600))
+        )
+    )
+    for _ in range(BURST + 2):
+        await throttler.acquire()
+    assert sleeps == [4.0], "900 requests spread over an hour"
+
+
+async def test_record_rate_limit(mocker: MockFixture, sleeps: List[float]) -> None:
+    """
+    The response hook should update the throttler the request was sent with.
+    """
+    throttler = Throttler(installation_id="1234", resource="core")
+    update = mocker.spy(throttler, "update")
+    response = create_response(
+        x_ratelimit_remaining="1000", x_ratelimit_reset=str(int(NOW + 3600))
+    )
+    async with throttler:
+        await record_rate_limit(response)
+    await record_rate_limit(response)
+
+    assert update.call_count == 1
+
+
+async def test_throttler_secondary_rate_limit(sleeps: List[float]) -> None:
+    """
+    We should pause until `retry-after` when we hit a secondary rate limit.
+    """
+    throttler = Throttler(installation_id="1234", resource="graphql")
+    await throttler.update(create_response(status_code=403, retry_after="60"))
+    await throttler.acquire()
+    assert sleeps == [60.0]
+
+
+def test_get_budget() -> None:
+    assert get_budget(create_response(), now=NOW) == (None, None)
+    interval, pause_until = get_budget(
+        create_response(
+            x_ratelimit_remaining="0", x_ratelimit_reset=str(int(NOW + 120))
+        ),
+        now=NOW,
+    )
+    assert pause_until == NOW + 120
+    assert interval == 120 * 1000
+    interval, _ = get_budget(
+        create_response(
+            x_ratelimit_remaining="100000", x_ratelimit_reset=str(int(NOW + 60))
+        ),
+        now=NOW,
+    )
+    assert interval == MIN_INTERVAL_MS
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+import asyncio
+import json
+
+import zstandard as zstd
+from pytest_mock import MockFixture
+
+from kodiak.tests.fixtures import FakeRedis
+from kodiak.usage_reporting import UsageReporter
+
+
+def decode(data: bytes) -> dict[str, object]:
+    return json.loads(zstd.ZstdDecompressor().decompress(data))  # type: ignore [no-any-return]
+
+
+async def test_usage_reporter_batches(mocker: MockFixture) -> None:
+    """
+    We should push buffered events to Redis in a single round trip.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.usage_reporting.redis_web_api", fake_redis)
+    reporter = UsageReporter(flush_interval_sec=0.001, max_buffer_size=100)
+
+    for number in range(3):
+        reporter.report(event_name="pull_request", payload=dict(number=number))
+    assert fake_redis.called("rpush") == [], "we should wait for the flush interval"
+
+    await asyncio.sleep(0.01)
+    assert len(fake_redis.called("rpush")) == 1
+    assert [decode(event) for event in fake_redis.called("rpush")[0][1:]] == [
+        dict(event_name="pull_request", payload=dict(number=number))
+        for number in range(3)
+    ]
+    assert len(fake_redis.called("ltrim")) == 1
+
+
+async def test_usage_reporter_max_buffer_size(mocker: MockFixture) -> None:
+    """
+    We should flush immediately when the buffer is full and flush on close.
+    """
+    fake_redis = FakeRedis()
+    mocker.patch("kodiak.usage_reporting.redis_web_api", fake_redis)
+    reporter = UsageReporter(flush_interval_sec=60, max_buffer_size=2)
+
+    for number in range(3):
+        reporter.report(event_name="pull_request", payload=dict(number=number))
+    await reporter.close()
+
+    assert [len(args) - 1 for args in fake_redis.called("rpush")] == [2, 1]
@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+import asyncio
+from typing import Any
+
+import pytest
+from pytest_mock import MockFixture
+
+from kodiak import ingest_envelope
+from kodiak.entrypoints.worker import IngestQueueWorker, get_partition_key
+from kodiak.queue import WebhookEvent
+from kodiak.tests.fixtures import FakeRedis
+
+QUEUE_NAME = "kodiak:ingest:1"
+
+
+@pytest.mark.parametrize(
+    "event_name, payload, expected",
+    (
+        (
+            "pull_request",
+            {"repository": {"full_name": "a/b"}, "pull_request": {"number": 5}},
+            "a/b#5",
+        ),
+        (
+            "pull_request_review",
+            {"repository": {"full_name": "a/b"}, "pull_request": {"number": 5}},
+            "a/b#5",
+        ),
+        (
+            "check_run",
+            {"repository": {"full_name": "a/b"}, "check_run": {"head_sha": "abc"}},
+            "a/b@abc",
+        ),
+        ("status", {"repository": {"full_name": "a/b"}, "sha": "abc"}, "a/b@abc"),
+        (
+            "push",
+            {"repository": {"full_name": "a/b"}, "ref": "refs/heads/main"},
+            "a/b:refs/heads/main",
+        ),
+        ("unknown", {}, "None"),
+    ),
+)
+def test_get_partition_key(
+    event_name: str, payload: dict[str, Any], expected: str
+) -> None:
+    assert get_partition_key(event_name, payload) == expected
+
+
+class FakeQueue:
+    async def enqueue(self, *, event: WebhookEvent) -> None: ...
+
+    async def enqueue_for_repo(
+        self, *, event: WebhookEvent, first: bool
+    ) -> int | None: ...
+
+
+def create_fake_redis(entries: list[bytes]) -> FakeRedis:
+    fake_redis = FakeRedis()
+    fake_redis.lists[QUEUE_NAME] = entries
+    return fake_redis
+
+
+def pr_event(number: int) -> bytes:
+    return ingest_envelope.encode(
+        event_name="pull_request",
+        body=b'{"repository": {"full_name": "a/b"}, "pull_request": {"number": %d}}'
+        % number,
+    )
+
+
+async def test_ingest_queue_worker_partitions(mocker: MockFixture) -> None:
+    """
+    We should handle events for different pull requests concurrently, while
+    keeping events for the same pull request in order.
+    """
+    mocker.patch(
+        "kodiak.entrypoints.worker.redis_bot",
+        create_fake_redis([pr_event(1), pr_event(2), pr_event(1)]),
+    )
+    handled: list[int] = []
+    running = 0
+    max_running = 0
+
+    async def handle_webhook_event(
+        queue: object, event_name: str, payload: dict[str, Any]
+    ) -> None:
+        nonlocal running, max_running
+        running += 1
+        max_running = max(max_running, running)
+        await asyncio.sleep(0.01)
+        handled.append(payload["pull_request"]["number"])
+        running -= 1
+
+    mocker.patch("kodiak.entrypoints.worker.handle_webhook_event", handle_webhook_event)
+    worker = IngestQueueWorker(queue=FakeQueue(), queue_name=QUEUE_NAME, concurrency=3)
+    task = asyncio.create_task(worker.run())
+    await asyncio.sleep(0.05)
+    task.cancel()
+
+    assert max_running == 2, "events for pull request #1 should not overlap"
+    assert sorted(handled) == [1, 1, 2]
+    assert worker.in_flight == 0
+    assert worker.partitions == {}
+
+
+async def test_ingest_queue_worker_cancels_handlers(mocker: MockFixture) -> None:
+    """
+    Stopping the worker should cancel the events it's handling, including
+    events waiting on an earlier event for the same pull request.
+    """
+    mocker.patch(
+        "kodiak.entrypoints.worker.redis_bot",
+        create_fake_redis([pr_event(1), pr_event(1)]),
+    )
+    cancelled = 0
+
+    async def handle_webhook_event(
+        queue: object, event_name: str, payload: dict[str, Any]
+    ) -> None:
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            cancelled += 1
+            raise
+
+    mocker.patch("kodiak.entrypoints.worker.handle_webhook_event", handle_webhook_event)
+    worker = IngestQueueWorker(queue=FakeQueue(), queue_name=QUEUE_NAME, concurrency=3)
+    task = asyncio.create_task(worker.run())
+    await asyncio.sleep(0.01)
+    assert worker.in_flight == 2
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+    assert cancelled == 1
+    assert worker.tasks == set()
+    assert worker.in_flight == 0
@@ -1,9 +1,13 @@
-from typing import Optional
+from __future__ import annotations
+
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Sequence, Set, Tuple
 
 import pytest
 
 from kodiak import app_config as conf
 from kodiak.queries import Commit, CommitConnection, GitActor, PullRequestCommitUser
+from kodiak.redis_client import redis_bot
 
 
 def create_commit(
@@ -51,3 +55,231 @@ def redis_running() -> bool:
 
 
 requires_redis = pytest.mark.skipif(not redis_running(), reason="redis is not running")
+
+
+async def get_queue(queue_name: str) -> List[str]:
+    """
+    Members of the webhook queue `queue_name`, in order.
+    """
+    return [member.decode() for member in await redis_bot.zrange(queue_name, 0, -1)]
+
+
+# called with the fake, the script's keys and its arguments.
+FakeScript = Callable[["FakeRedis", Sequence[str], Sequence[Any]], Any]
+
+
+def encode(value: object) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode()
+
+
+class FakePipeline:
+    """
+    Queues commands and runs them against the fake on execute.
+    """
+
+    def __init__(self, redis: FakeRedis) -> None:
+        self.redis = redis
+        self.commands: List[Tuple[str, Tuple[Any, ...], Dict[str, Any]]] = []
+
+    async def __aenter__(self) -> FakePipeline:
+        return self
+
+    async def __aexit__(self, exc_type: object, exc: object, tb: object) -> None:
+        pass
+
+    def __getattr__(self, name: str) -> Callable[..., None]:
+        def queue_command(*args: Any, **kwargs: Any) -> None:
+            self.commands.append((name, args, kwargs))
+
+        return queue_command
+
+    async def execute(self) -> List[object]:
+        self.redis.executed += 1
+        commands, self.commands = self.commands, []
+        return [
+            self.redis.execute_command(name, *args, **kwargs)
+            for name, args, kwargs in commands
+        ]
+
+
+class FakeRedis:
+    """
+    In memory implementation of the Redis commands we use.
+
+    Lua scripts aren't interpreted, so tests pass Python implementations of
+    the scripts they run.
+    """
+
+    def __init__(self, *, scripts: Optional[Dict[str, FakeScript]] = None) -> None:
+        self.scripts = scripts or {}
+        self.strings: Dict[str, bytes] = {}
+        self.lists: Dict[str, List[bytes]] = {}
+        self.sets: Dict[str, Set[bytes]] = {}
+        self.hashes: Dict[str, Dict[bytes, bytes]] = {}
+        self.sorted_sets: Dict[str, Dict[bytes, float]] = {}
+        self.commands: List[Tuple[str, Tuple[Any, ...]]] = []
+        self.executed = 0
+        self.changed = asyncio.Event()
+
+    def called(self, name: str) -> List[Tuple[Any, ...]]:
+        """
+        Arguments of each call to command `name`.
+        """
+        return [args for command, args in self.commands if command == name]
+
+    def execute_command(self, name: str, *args: Any, **kwargs: Any) -> Any:
+        self.commands.append((name, args))
+        return getattr(self, f"_{name}")(*args, **kwargs)
+
+    def pipeline(self, transaction: bool = True) -> FakePipeline:
+        return FakePipeline(self)
+
+    def register_script(
+        self, script: str
+    ) -> Callable[[Sequence[str], Sequence[Any]], Awaitable[Any]]:
+        async def call(keys: Sequence[str], args: Sequence[Any]) -> Any:
+            return self.execute_command("evalsha", script, keys, args)
+
+        return call
+
+    def _evalsha(self, script: str, keys: Sequence[str], args: Sequence[Any]) -> Any:
+        return self.scripts[script](self, keys, args)
+
+    def _eval(self, script: str, numkeys: int, *keys_and_args: Any) -> Any:
+        return self._evalsha(script, keys_and_args[:numkeys], keys_and_args[numkeys:])
+
+    def _set(
+        self, key: str, value: object, nx: bool = False, px: Optional[int] = None
+    ) -> Optional[bool]:
+        if nx and key in self.strings:
+            return None
+        self.strings[key] = encode(value)
+        return True
+
+    def _expire(self, key: str, time: int) -> bool:
+        return True
+
+    def _publish(self, channel: str, message: object) -> int:
+        return 0
+
+    def _rpush(self, key: str, *values: object) -> int:
+        self.lists.setdefault(key, []).extend(encode(value) for value in values)
+        self.changed.set()
+        return len(self.lists[key])
+
+    def _ltrim(self, key: str, start: int, end: int) -> bool:
+        if key in self.lists:
+            self.lists[key] = self.lists[key][start : end + 1 if end != -1 else None]
+        return True
+
+    def _sadd(self, key: str, *values: object) -> int:
+        members = self.sets.setdefault(key, set())
+        added = {encode(value) for value in values} - members
+        members.update(added)
+        return len(added)
+
+    def _smembers(self, key: str) -> Set[bytes]:
+        return set(self.sets.get(key, set()))
+
+    def _hset(self, key: str, field: object, value: object) -> int:
+        fields = self.hashes.setdefault(key, {})
+        added = encode(field) not in fields
+        fields[encode(field)] = encode(value)
+        return int(added)
+
+    def _hdel(self, key: str, *fields: object) -> int:
+        values = self.hashes.get(key, {})
+        return sum(values.pop(encode(field), None) is not None for field in fields)
+
+    def _hgetall(self, key: str) -> Dict[bytes, bytes]:
+        return dict(self.hashes.get(key, {}))
+
+    def _zadd(self, key: str, mapping: Dict[Any, float], nx: bool = False) -> int:
+        members = self.sorted_sets.setdefault(key, {})
+        added = 0
+        for member, score in mapping.items():
+            if encode(member) in members:
+                if nx:
+                    continue
+            else:
+                added += 1
+            members[encode(member)] = score
+        self.changed.set()
+        return added
+
+    def _zrem(self, key: str, *members: object) -> int:
+        values = self.sorted_sets.get(key, {})
+        return sum(values.pop(encode(member), None) is not None for member in members)
+
+    def _zrange(self, key: str, start: int, end: int) -> List[bytes]:
+        ordered = sorted(
+            self.sorted_sets.get(key, {}).items(), key=lambda item: (item[1], item[0])
+        )
+        return [member for member, _ in ordered][start : end + 1 if end != -1 else None]
+
+    def _zrank(self, key: str, member: object) -> Optional[int]:
+        ordered = self._zrange(key, 0, -1)
+        return ordered.index(encode(member)) if encode(member) in ordered else None
+
+    def _zremrangebyscore(self, key: str, min: object, max: float) -> int:
+        values = self.sorted_sets.get(key, {})
+        removed = [member for member, score in values.items() if score <= max]
+        for member in removed:
+            del values[member]
+        return len(removed)
+
+    def _zpopmin(self, key: str) -> List[Tuple[bytes, float]]:
+        ordered = self._zrange(key, 0, 0)
+        if not ordered:
+            return []
+        return [(ordered[0], self.sorted_sets[key].pop(ordered[0]))]
+
+    async def set(self, *args: Any, **kwargs: Any) -> Optional[bool]:
+        return self.execute_command("set", *args, **kwargs)  # type: ignore [no-any-return]
+
+    async def publish(self, channel: str, message: object) -> int:
+        return self.execute_command("publish", channel, message)  # type: ignore [no-any-return]
+
+    async def smembers(self, key: str) -> Set[bytes]:
+        return self.execute_command("smembers", key)  # type: ignore [no-any-return]
+
+    async def hdel(self, key: str, *fields: object) -> int:
+        return self.execute_command("hdel", key, *fields)  # type: ignore [no-any-return]
+
+    async def hgetall(self, key: str) -> Dict[bytes, bytes]:
+        return self.execute_command("hgetall", key)  # type: ignore [no-any-return]
+
+    async def zadd(self, key: str, mapping: Dict[Any, float], nx: bool = False) -> int:
+        return self.execute_command("zadd", key, mapping, nx=nx)  # type: ignore [no-any-return]
+
+    async def zrem(self, key: str, *members: object) -> int:
+        return self.execute_command("zrem", key, *members)  # type: ignore [no-any-return]
+
+    async def zpopmin(self, key: str) -> List[Tuple[bytes, float]]:
+        return self.execute_command("zpopmin", key)  # type: ignore [no-any-return]
+
+    async def bzpopmin(
+        self, keys: Sequence[str], timeout: float = 0
+    ) -> Optional[Tuple[bytes, bytes, float]]:
+        self.commands.append(("bzpopmin", (keys, timeout)))
+        while True:
+            for key in keys:
+                popped = self._zpopmin(key)
+                if popped:
+                    member, score = popped[0]
+                    return key.encode(), member, score
+            self.changed.clear()
+            await self.changed.wait()
+
+    async def blpop(
+        self, keys: Sequence[str], timeout: float = 0
+    ) -> Optional[Tuple[bytes, bytes]]:
+        self.commands.append(("blpop", (keys, timeout)))
+        while True:
+            for key in keys:
+                if self.lists.get(key):
+                    return key.encode(), self.lists[key].pop(0)
+            self.changed.clear()
+            await self.changed.wait()
@@ -1,75 +1,178 @@
-import asyncio
-import time
-from collections import defaultdict, deque
-from typing import Deque, Mapping
-
-
-class Throttler:
-    """
-    via https://github.com/hallazzang/asyncio-throttle
-
-    The MIT License (MIT)
+"""
+Rate limit GitHub API requests per installation.
 
-    Copyright (c) 2017-2019 Hanjun Kim
+Each installation has a budget of API requests per hour, tracked separately
+for the REST ("core") and GraphQL APIs. We spread the remaining budget
+reported by the `x-ratelimit-*` response headers over the time until the
+budget resets, so installations with a larger budget go faster.
 
-    Permission is hereby granted, free of charge, to any person obtaining a copy
-    of this software and associated documentation files (the "Software"), to deal
-    in the Software without restriction, including without limitation the rights
-    to use, copy, modify, merge, publish, distribute, sublicense, and/or sell
-    copies of the Software, and to permit persons to whom the Software is
-    furnished to do so, subject to the following conditions:
+The limiter is a GCRA token bucket stored in Redis so worker processes share
+the budget of an installation. A caller reserves the next slot and sleeps
+until it instead of polling.
+"""
 
-    The above copyright notice and this permission notice shall be included in all
-    copies or substantial portions of the Software.
+from __future__ import annotations
 
-    THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
-    IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
-    FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
-    AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
-    LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
-    OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
-    SOFTWARE.
+import asyncio
+import time
+from contextvars import ContextVar
+from typing import Dict, Optional, Tuple
+
+import structlog
+
+from kodiak.http import Response
+from kodiak.redis_client import redis_bot
+
+logger = structlog.get_logger()
+
+# used until we've seen rate limit headers for an installation.
+DEFAULT_REQUESTS_PER_HOUR = 5000
+# GitHub's secondary rate limits allow ~900 REST points per minute, so we
+# don't go faster than this even with plenty of budget left.
+MIN_INTERVAL_MS = 60 * 1000 / 900
+# number of requests allowed back to back.
+BURST = 5
+# keep some of the budget for requests made outside of the limiter.
+BUDGET_FRACTION = 0.9
+STATE_TTL_MS = 2 * 60 * 60 * 1000
+
+# KEYS: state key
+# ARGV: now ms, default interval ms, burst, ttl ms
+# returns the milliseconds to wait before sending the request.
+ACQUIRE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local interval = tonumber(redis.call("hget", KEYS[1], "interval") or ARGV[2])
+local tat = math.max(tonumber(redis.call("hget", KEYS[1], "tat") or ARGV[1]), now)
+redis.call("hset", KEYS[1], "tat", tat + interval)
+redis.call("pexpire", KEYS[1], ARGV[4])
+return math.ceil(math.max(0, tat - interval * tonumber(ARGV[3]) - now))
+"""
+
+# KEYS: state key
+# ARGV: interval ms, pause until ms (0 to not pause), burst, ttl ms
+UPDATE_SCRIPT = """
+redis.call("hset", KEYS[1], "interval", ARGV[1])
+local pause_until = tonumber(ARGV[2])
+if pause_until > 0 then
+    local tat = pause_until + tonumber(ARGV[1]) * tonumber(ARGV[3])
+    if tat > tonumber(redis.call("hget", KEYS[1], "tat") or "0") then
+        redis.call("hset", KEYS[1], "tat", tat)
+    end
+end
+redis.call("pexpire", KEYS[1], ARGV[4])
+return 1
+"""
+
+
+def get_rate_limit_key(installation_id: str, resource: str) -> str:
+    return f"kodiak:rate_limit:{installation_id}:{resource}"
+
+
+def get_budget(
+    response: Response, *, now: float
+) -> Tuple[Optional[float], Optional[float]]:
     """
+    Calculate the request interval and the time to pause until from the rate
+    limit headers of `response`.
+    """
+    pause_until: Optional[float] = None
+    retry_after = response.headers.get("retry-after")
+    if response.status_code in {403, 429} and retry_after is not None:
+        # secondary rate limit.
+        pause_until = now + float(retry_after)
+    remaining = response.headers.get("x-ratelimit-remaining")
+    reset = response.headers.get("x-ratelimit-reset")
+    if remaining is None or reset is None:
+        return None, pause_until
+    window_sec = max(float(reset) - now, 1)
+    if int(remaining) == 0:
+        pause_until = max(pause_until or 0, float(reset))
+    budget = max(int(remaining) * BUDGET_FRACTION, 1)
+    return max(window_sec * 1000 / budget, MIN_INTERVAL_MS), pause_until
 
-    def __init__(
-        self, rate_limit: float, period: float = 1.0, retry_interval: float = 0.01
-    ) -> None:
-        self.rate_limit = rate_limit
-        self.period = period
-        self.retry_interval = retry_interval
-
-        self._task_logs: Deque[float] = deque()
 
-    def flush(self) -> None:
-        now = time.time()
-        while self._task_logs:
-            if now - self._task_logs[0] > self.period:
-                self._task_logs.popleft()
-            else:
-                break
+class Throttler:
+    def __init__(self, *, installation_id: str, resource: str) -> None:
+        self.installation_id = installation_id
+        self.resource = resource
+        self.key = get_rate_limit_key(installation_id, resource)
+        self.waits = 0
+        self._acquire_script = redis_bot.register_script(ACQUIRE_SCRIPT)
+        self._update_script = redis_bot.register_script(UPDATE_SCRIPT)
 
     async def acquire(self) -> None:
-        while True:
-            self.flush()
-            if len(self._task_logs) < self.rate_limit:
-                break
-            await asyncio.sleep(self.retry_interval)
-
-        self._task_logs.append(time.time())
+        wait_ms = await self._acquire_script(
+            keys=[self.key],
+            args=[
+                int(time.time() * 1000),
+                3600 * 1000 / DEFAULT_REQUESTS_PER_HOUR,
+                BURST,
+                STATE_TTL_MS,
+            ],
+        )
+        if wait_ms > 0:
+            self.waits += 1
+            await asyncio.sleep(wait_ms / 1000)
+
+    async def update(self, response: Response) -> None:
+        """
+        Adapt our rate to the budget reported by GitHub.
+        """
+        interval_ms, pause_until = get_budget(response, now=time.time())
+        if interval_ms is None and pause_until is None:
+            return
+        if pause_until is not None:
+            logger.info(
+                "github_rate_limited",
+                install=self.installation_id,
+                resource=self.resource,
+                status_code=response.status_code,
+                pause_sec=pause_until - time.time(),
+            )
+        await self._update_script(
+            keys=[self.key],
+            args=[
+                interval_ms or 3600 * 1000 / DEFAULT_REQUESTS_PER_HOUR,
+                int(pause_until * 1000) if pause_until is not None else 0,
+                BURST,
+                STATE_TTL_MS,
+            ],
+        )
 
     async def __aenter__(self) -> None:
         await self.acquire()
+        # requests are sent from the same task, so `record_rate_limit` can
+        # find the throttler for a response.
+        current_throttler.set(self)
 
     async def __aexit__(self, exc_type: object, exc: object, tb: object) -> None:
-        pass
+        current_throttler.set(None)
 
 
-# installation_id => Throttler
-THROTTLER_CACHE: Mapping[str, Throttler] = defaultdict(
-    # TODO(chdsbd): Store rate limits in redis and update via http rate limit response headers
-    lambda: Throttler(rate_limit=5000 / 60 / 60)
+current_throttler: ContextVar[Optional[Throttler]] = ContextVar(
+    "current_throttler", default=None
 )
 
 
-def get_thottler_for_installation(*, installation_id: str) -> Throttler:
-    return THROTTLER_CACHE[installation_id]
+async def record_rate_limit(response: Response) -> None:
+    """
+    httpx response hook to update the throttler of the request.
+    """
+    throttler = current_throttler.get()
+    if throttler is not None:
+        await throttler.update(response)
+
+
+# (installation_id, resource) => Throttler
+THROTTLER_CACHE: Dict[Tuple[str, str], Throttler] = {}
+
+
+def get_thottler_for_installation(
+    *, installation_id: str, resource: str = "core"
+) -> Throttler:
+    key = (installation_id, resource)
+    if key not in THROTTLER_CACHE:
+        THROTTLER_CACHE[key] = Throttler(
+            installation_id=installation_id, resource=resource
+        )
+    return THROTTLER_CACHE[key]
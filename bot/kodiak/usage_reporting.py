@@ -0,0 +1,100 @@
+"""
+Forward webhook events to the web api for usage reporting.
+
+Events are compressed and buffered for a few milliseconds so we can push them
+to Redis in a single pipelined round trip instead of two commands per event.
+"""
+
+from __future__ import annotations
+
+import asyncio
+import json
+from typing import List
+
+import structlog
+import zstandard as zstd
+
+from kodiak import (
+    app_config as conf,
+    ingest_envelope,
+)
+from kodiak.redis_client import redis_web_api
+
+logger = structlog.get_logger()
+
+USAGE_REPORTING_QUEUE = b"kodiak:webhook_event"
+
+
+class UsageReporter:
+    def __init__(
+        self,
+        *,
+        flush_interval_sec: float,
+        max_buffer_size: int,
+    ) -> None:
+        self.flush_interval_sec = flush_interval_sec
+        self.max_buffer_size = max_buffer_size
+        self._compressor: zstd.ZstdCompressor | None = None
+        self._buffer: List[bytes] = []
+        self._flush_timer: asyncio.TimerHandle | None = None
+        self._flush_tasks: set[asyncio.Task[None]] = set()
+
+    def compress(self, data: dict[str, object]) -> bytes:
+        if self._compressor is None:
+            self._compressor = ingest_envelope.create_compressor(
+                ingest_envelope.load_compression_dict(
+                    conf.USAGE_REPORTING_ZSTD_DICTIONARY_PATH
+                )
+            )
+        return self._compressor.compress(json.dumps(data).encode())
+
+    def report(self, *, event_name: str, payload: dict[str, object]) -> None:
+        """
+        Buffer an event to be pushed to Redis on the next flush.
+        """
+        self._buffer.append(self.compress(dict(event_name=event_name, payload=payload)))
+        if len(self._buffer) >= self.max_buffer_size:
+            self._start_flush()
+        elif self._flush_timer is None:
+            self._flush_timer = asyncio.get_running_loop().call_later(
+                self.flush_interval_sec, self._start_flush
+            )
+
+    def _start_flush(self) -> None:
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        events, self._buffer = self._buffer, []
+        if not events:
+            return
+        task = asyncio.create_task(self._push(events))
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+
+    async def _push(self, events: List[bytes]) -> None:
+        try:
+            # We limit the queue length to ensure that if the dequeue job fails,
+            # we won't overload Redis.
+            async with redis_web_api.pipeline(transaction=False) as pipe:
+                pipe.rpush(USAGE_REPORTING_QUEUE, *events)
+                pipe.ltrim(USAGE_REPORTING_QUEUE, 0, conf.USAGE_REPORTING_QUEUE_LENGTH)
+                await pipe.execute()
+        except Exception:
+            # usage reporting is best effort, so we drop the batch instead of
+            # interrupting webhook processing.
+            logger.exception("usage_reporting_flush_failed", event_count=len(events))
+            return
+        logger.info("usage_reporting_flushed", event_count=len(events))
+
+    async def close(self) -> None:
+        """
+        Flush any buffered events. Call on shutdown.
+        """
+        self._start_flush()
+        await asyncio.gather(*self._flush_tasks)
+
+
+usage_reporter = UsageReporter(
+    flush_interval_sec=conf.USAGE_REPORTING_FLUSH_INTERVAL_MS / 1000,
+    max_buffer_size=conf.USAGE_REPORTING_MAX_BUFFER_SIZE,
+)
@@ -1,2 +1,22 @@
+from typing import List
+
+class ZstdCompressionDict:
+    def __init__(self, data: bytes) -> None: ...
+    def as_bytes(self) -> bytes: ...
+    def dict_id(self) -> int: ...
+
+class FrameParameters:
+    dict_id: int
+
 class ZstdCompressor:
+    def __init__(
+        self, level: int = ..., dict_data: ZstdCompressionDict = ...
+    ) -> None: ...
     def compress(self, arg: object) -> bytes: ...
+
+class ZstdDecompressor:
+    def __init__(self, dict_data: ZstdCompressionDict = ...) -> None: ...
+    def decompress(self, data: bytes) -> bytes: ...
+
+def train_dictionary(dict_size: int, samples: List[bytes]) -> ZstdCompressionDict: ...
+def get_frame_parameters(data: bytes) -> FrameParameters: ...
@@ -1,2 +1,6 @@
+class ZstdCompressionDict:
+    def __init__(self, data: bytes) -> None: ...
+
 class ZstdDecompressor:
+    def __init__(self, dict_data: ZstdCompressionDict = ...) -> None: ...
     def decompress(self, data: bytes) -> bytes: ...
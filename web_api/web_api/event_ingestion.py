@@ -26,12 +26,25 @@ logger = logging.getLogger(__name__)
 INTERESTING_EVENTS = {"pull_request", "pull_request_review", "pull_request_comment"}
 
 
+def create_decompressor() -> zstd.ZstdDecompressor:
+    """
+    The bot can compress events with a shared dictionary, configured with
+    USAGE_REPORTING_ZSTD_DICTIONARY_PATH, which we need to decompress them.
+    """
+    dictionary_path = os.environ.get("USAGE_REPORTING_ZSTD_DICTIONARY_PATH")
+    if dictionary_path:
+        with open(dictionary_path, "rb") as f:
+            return zstd.ZstdDecompressor(dict_data=zstd.ZstdCompressionDict(f.read()))
+    return zstd.ZstdDecompressor()
+
+
 def ingest_events() -> None:
     """
     Pull webhook events off the queue and insert them into Postgres to calculate
     usage statistics.
     """
     r = redis.Redis.from_url(os.environ["REDIS_URL"])
+    dctx = create_decompressor()
     while True:
         time.sleep(0)
         # we don't want to lose events when we terminate the process, so we
@@ -46,7 +59,6 @@ def ingest_events() -> None:
             _, event_compressed = res
 
             logger.info("process event")
-            dctx = zstd.ZstdDecompressor()
             decompressed = dctx.decompress(event_compressed)
             event = json.loads(decompressed)
 
@@ -1,5 +1,6 @@
 from __future__ import annotations
 
+import json
 import logging
 from collections import defaultdict
 from typing import (
@@ -72,9 +73,17 @@ def queue_to_target(queue: bytes) -> bytes:
 
 
 def parse_kodiak_queue_entry(data: bytes) -> KodiakQueueEntry | None:
+    """
+    The bot stores queue entries as a compact JSON array:
+    `["848733","chdsbd","kodiak",123,"master"]`. Entries queued by older
+    versions of the bot are JSON objects.
+    """
     try:
+        if data.startswith(b"["):
+            _install, _owner, _repo, pull_request_number, _target = json.loads(data)
+            return KodiakQueueEntry(pull_request_number=pull_request_number)
         return KodiakQueueEntry.parse_raw(data)
-    except pydantic.ValidationError:
+    except (pydantic.ValidationError, ValueError):
         log.exception("failed to parse pull request")
     return None
 
@@ -1,4 +1,9 @@
-from web_api.merge_queues import QueueInfo, queue_info_from_name
+from web_api.merge_queues import (
+    KodiakQueueEntry,
+    QueueInfo,
+    parse_kodiak_queue_entry,
+    queue_info_from_name,
+)
 
 
 def test_queue_info_from_name() -> None:
@@ -11,3 +16,14 @@ def test_queue_info_from_name() -> None:
     assert queue_info_from_name(
         "merge_queue:11256551.sbdchd/squawk/chris/main.test.foo"
     ) == QueueInfo("sbdchd", "squawk", "chris/main.test.foo")
+
+
+def test_parse_kodiak_queue_entry() -> None:
+    assert parse_kodiak_queue_entry(
+        b'["11256551","sbdchd","squawk",55,"main"]'
+    ) == KodiakQueueEntry(pull_request_number="55")
+    assert parse_kodiak_queue_entry(
+        b'{"repo_owner": "sbdchd", "repo_name": "squawk", "pull_request_number": 55, "installation_id": "11256551", "target_name": "main"}'
+    ) == KodiakQueueEntry(pull_request_number="55")
+    assert parse_kodiak_queue_entry(b'["11256551"]') is None
+    assert parse_kodiak_queue_entry(b"{}") is None